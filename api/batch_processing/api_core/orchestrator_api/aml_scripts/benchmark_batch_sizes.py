@@ -0,0 +1,144 @@
+"""
+Times TFDetector.generate_detections_batch() at several batch sizes, to choose the --batch_size that score.py
+passes to the detector on a given node type. All runs share one TF session, so session creation is not timed, and
+each batch size gets an untimed warm-up run before --num_runs timed runs. Also checks that batching does not change the detections, by
+comparing each batch size's detections (confidences and boxes) to those at batch size 1.
+
+Images are read from a local folder, or are random noise of a given size if no folder is given (useful for timing
+only). With --mixed_noise_image_size, every other noise image has that size instead, to check that batching images of
+different sizes (which are grouped by size, see TFDetector.generate_detections_stream()) gives the same detections.
+
+Example usage, on CPU:
+    CUDA_VISIBLE_DEVICES= python benchmark_batch_sizes.py /path/to/md_v4.1.0.pb --image_dir /path/to/images \
+        --num_images 64 --batch_sizes 1 2 4 8
+    CUDA_VISIBLE_DEVICES= python benchmark_batch_sizes.py /path/to/md_v4.1.0.pb --noise_image_size 1920 1080 \
+        --mixed_noise_image_size 2048 1536
+"""
+
+import argparse
+import itertools
+import os
+import time
+
+import numpy as np
+import PIL.Image as Image
+
+from tf_detector import TFDetector
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_images(image_dir, num_images):
+    """Returns (images, image_ids) for up to num_images images in image_dir."""
+    image_ids = sorted(fn for fn in os.listdir(image_dir) if fn.lower().endswith(IMAGE_EXTENSIONS))[:num_images]
+    images = []
+    for image_id in image_ids:
+        image = TFDetector.open_image(os.path.join(image_dir, image_id))
+        image.load()
+        images.append(image)
+    return images, image_ids
+
+
+def make_noise_images(num_images, sizes, seed=0):
+    """Returns (images, image_ids) for num_images random noise images, cycling through sizes, a list of
+    (width, height) tuples.
+    """
+    rng = np.random.RandomState(seed)
+    images = [Image.fromarray(rng.randint(0, 256, size=(height, width, 3), dtype=np.uint8))
+              for _, (width, height) in zip(range(num_images), itertools.cycle(sizes))]
+    image_ids = ['noise_{}.png'.format(i) for i in range(num_images)]
+    return images, image_ids
+
+
+def detection_differences(detections, reference_detections):
+    """Compares two lists of detection entries for the same images.
+
+    Returns:
+        None if they are not for the same images, otherwise a tuple of
+            max_conf_difference: largest difference in the confidence of corresponding detections
+            max_bbox_difference: largest difference in a bbox coordinate of corresponding detections
+            num_count_differences: number of images with a different number of detections; their detections are
+                not compared
+    """
+    if [d['file'] for d in detections] != [d['file'] for d in reference_detections]:
+        return None
+    max_conf_difference = 0.0
+    max_bbox_difference = 0.0
+    num_count_differences = 0
+    for d, ref in zip(detections, reference_detections):
+        if len(d['detections']) != len(ref['detections']):
+            num_count_differences += 1
+            continue
+        # the order of detections with nearly equal confidences may differ, so match them in order of confidence
+        for det, ref_det in zip(sorted(d['detections'], key=lambda det: det['conf']),
+                                sorted(ref['detections'], key=lambda det: det['conf'])):
+            max_conf_difference = max(max_conf_difference, abs(det['conf'] - ref_det['conf']))
+            max_bbox_difference = max(max_bbox_difference,
+                                      max(abs(x - y) for x, y in zip(det['bbox'], ref_det['bbox'])))
+    return max_conf_difference, max_bbox_difference, num_count_differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares detector throughput across batch sizes.')
+    parser.add_argument('model_path', help='path to the detector .pb file')
+    parser.add_argument('--image_dir', help='folder of images to score; random noise images are used if omitted')
+    parser.add_argument('--num_images', type=int, default=32)
+    parser.add_argument('--noise_image_size', type=int, nargs=2, default=[1920, 1080], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--mixed_noise_image_size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='if given, every other noise image has this size instead of --noise_image_size')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--detection_threshold', type=float, default=0.05)
+    parser.add_argument('--num_runs', type=int, default=3, help='number of timed runs per batch size')
+    args = parser.parse_args()
+
+    if args.image_dir is not None:
+        images, image_ids = load_images(args.image_dir, args.num_images)
+    else:
+        sizes = [tuple(args.noise_image_size)]
+        if args.mixed_noise_image_size is not None:
+            sizes.append(tuple(args.mixed_noise_image_size))
+        images, image_ids = make_noise_images(args.num_images, sizes)
+    print('Scoring {} images'.format(len(images)))
+
+    detector = TFDetector(args.model_path)
+    sess = detector.new_session()
+
+    # batch size 1 is the reference for checking that batching doesn't change the detections
+    batch_sizes = [1] + [b for b in args.batch_sizes if b != 1]
+    reference_detections = None
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            detector.batch_size = batch_size
+
+            # the first run of a new input shape in a session is slower, so warm up on one batch before timing
+            detector.generate_detections_batch(images[:batch_size], image_ids[:batch_size], args.detection_threshold,
+                                               sess=sess)
+
+            start_time = time.time()
+            for _ in range(args.num_runs):
+                detections, failed_images, _ = detector.generate_detections_batch(images, image_ids,
+                                                                                  args.detection_threshold, sess=sess)
+            elapsed = (time.time() - start_time) / args.num_runs
+
+            if reference_detections is None:
+                reference_detections = detections
+            results.append((batch_size, elapsed, len(images) / elapsed, len(failed_images),
+                            detection_differences(detections, reference_detections)))
+    finally:
+        sess.close()
+
+    print('{:>10} {:>10} {:>10} {:>8} {:>14} {:>14} {:>14}'.format('batch_size', 'sec/run', 'images/s', 'failed',
+                                                                   'max conf diff', 'max bbox diff', 'count diffs'))
+    for batch_size, elapsed, images_per_second, num_failed, differences in results:
+        if differences is None:
+            differences = ['n/a'] * 3
+        else:
+            differences = ['{:.4f}'.format(differences[0]), '{:.4f}'.format(differences[1]), differences[2]]
+        print('{:>10} {:>10.2f} {:>10.2f} {:>8} {:>14} {:>14} {:>14}'.format(
+            batch_size, elapsed, images_per_second, num_failed, *differences))
+
+
+if __name__ == '__main__':
+    main()
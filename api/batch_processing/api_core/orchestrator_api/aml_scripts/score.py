@@ -3,6 +3,8 @@ import io
 import json
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib import request
 
@@ -10,23 +12,32 @@ import azureml.core
 from azureml.core.model import Model
 from azureml.core.run import Run
 
-from tf_detector import TFDetector
+from tf_detector import TFDetector, DEFAULT_BATCH_SIZE
 from sas_blob_utils import SasBlob
 
 print('score.py, beginning, using AML version {}'.format(azureml.core.__version__))
 
 
+# number of images to download concurrently
+DEFAULT_NUM_DOWNLOAD_THREADS = 16
+
+# maximum number of images that have been downloaded (or are being downloaded) but not yet scored, which bounds
+# the memory used by BatchScorer
+DEFAULT_MAX_IMAGES_IN_MEMORY = 64
+
+
 class BatchScorer:
     """
     Coordinates scoring a batch of images using model at model_path.
-    The images are first downloaded and all loaded before scoring is performed.
+    Images are downloaded and decoded by a pool of threads while the detector scores the images that are already
+    loaded, and only a small window of images is kept in memory.
     """
 
     def __init__(self, **kwargs):
         print('BatchScorer, __init__()')
 
         model_path = kwargs.get('model_path')
-        self.detector = TFDetector(model_path)
+        self.detector = TFDetector(model_path, batch_size=kwargs.get('batch_size') or DEFAULT_BATCH_SIZE)
 
         self.job_id = kwargs.get('job_id')
 
@@ -37,65 +48,90 @@ class BatchScorer:
 
         self.image_ids_to_score = kwargs.get('image_ids_to_score')
         self.use_url = kwargs.get('use_url')
-        self.images = []
+
+        self.num_download_threads = kwargs.get('num_download_threads') or DEFAULT_NUM_DOWNLOAD_THREADS
+        self.max_images_in_memory = max(kwargs.get('max_images_in_memory') or DEFAULT_MAX_IMAGES_IN_MEMORY,
+                                        self.num_download_threads)
 
         # determine if there is metadata attached to each image_id
         self.metadata_available = True if isinstance(self.image_ids_to_score[0], list) else False
 
+        self.blob_service = None
+        self.container_name = None
+
         self.detections = []
-        self.image_ids = []  # all the IDs of the images that PIL successfully opened
-        self.image_metas = []  # if metadata came with the list of image_ids, keep them here
         self.failed_images = []  # list of image_ids that failed to open or be processed
         self.failed_metas = []  # their corresponding metadata
 
+    def download_image(self, image_id):
+        """Downloads and decodes one image, raising an exception if it cannot be downloaded or opened."""
+        if self.use_url:
+            with request.urlopen(image_id) as response:
+                im_to_open = io.BytesIO(response.read())
+        else:
+            im_to_open = io.BytesIO()
+            _ = self.blob_service.get_blob_to_stream(self.container_name, image_id, im_to_open)
+            im_to_open.seek(0)
+
+        # open is lazy; load() loads the image so we know it can be read successfully
+        image = TFDetector.open_image(im_to_open)
+        image.load()
+        return image
 
-    def download_images(self):
+    def iter_images(self):
+        """Yields (image, image_id, image_meta) for each image that is downloaded and opened successfully, in the
+        order of image_ids_to_score. Images that fail are recorded in self.failed_images and self.failed_metas.
 
-        print('BatchScorer, download_images(), use_url is {}, metadata_available is {}'.format(
+        Downloads run concurrently in num_download_threads threads, at most max_images_in_memory images ahead of
+        the image being consumed.
+        """
+        print('BatchScorer, iter_images(), use_url is {}, metadata_available is {}'.format(
             self.use_url, self.metadata_available))
 
-        if not self.use_url:
+        if not self.use_url and self.blob_service is None:
             print('blob_service created')
-            blob_service = SasBlob.get_service_from_uri(self.input_container_sas)
-            container_name = SasBlob.get_container_from_uri(self.input_container_sas)
+            self.blob_service = SasBlob.get_service_from_uri(self.input_container_sas)
+            self.container_name = SasBlob.get_container_from_uri(self.input_container_sas)
 
-        for i in self.image_ids_to_score:
-            if self.metadata_available:
-                image_id = i[0]
-                image_meta = i[1]
-            else:
-                image_id = i
-                image_meta = None
+        items = iter(self.image_ids_to_score)
+        pending = deque()  # (image_id, image_meta, future), in order
 
+        with ThreadPoolExecutor(max_workers=self.num_download_threads) as executor:
             try:
-                if self.use_url:
-                    # im_to_open will be a tempfile with a generated name
-                    im_to_open, headers = request.urlretrieve(image_id)  # TODO do not save to disk
-                else:
-                    im_to_open = io.BytesIO()
-                    _ = blob_service.get_blob_to_stream(container_name, image_id, im_to_open)
-
-                # open is lazy; load() loads the image so we know it can be read successfully
-                image = TFDetector.open_image(im_to_open)
-                image.load()
-
-                self.images.append(image)
-                self.image_ids.append(image_id)
-                self.image_metas.append(image_meta)
-            except Exception as e:
-                print('score.py, failed to download or open image {}: {}'.format(image_id, str(e)))
-                self.failed_images.append(image_id)
-                self.failed_metas.append(image_meta)
-                continue
-
+                while True:
+                    while len(pending) < self.max_images_in_memory:
+                        i = next(items, None)
+                        if i is None:
+                            break
+                        if self.metadata_available:
+                            image_id, image_meta = i[0], i[1]
+                        else:
+                            image_id, image_meta = i, None
+                        pending.append((image_id, image_meta, executor.submit(self.download_image, image_id)))
+
+                    if len(pending) == 0:
+                        break
+
+                    image_id, image_meta, future = pending.popleft()
+                    try:
+                        image = future.result()
+                    except Exception as e:
+                        print('score.py, failed to download or open image {}: {}'.format(image_id, str(e)))
+                        self.failed_images.append(image_id)
+                        self.failed_metas.append(image_meta)
+                        continue
+                    yield image, image_id, image_meta
+            finally:
+                # if the consumer stops early, don't wait for downloads that haven't started
+                for _, _, future in pending:
+                    future.cancel()
 
     def score(self):
+        """Downloads and scores all images, overlapping downloading with scoring."""
         print('BatchScorer, score()')
-        # self.image_ids does not include any failed images; self.image_ids is overwritten here
-        self.detections, failed_images, failed_metas = self.detector.generate_detections_batch(
-            images=self.images, image_ids=self.image_ids,
-            detection_threshold=self.detection_threshold,
-            image_metas=self.image_metas, metadata_available=self.metadata_available)
+        self.detections, failed_images, failed_metas = self.detector.generate_detections_stream(
+            self.iter_images(), detection_threshold=self.detection_threshold,
+            metadata_available=self.metadata_available)
 
         self.failed_images.extend(failed_images)
         self.failed_metas.extend(failed_metas)
@@ -145,6 +181,14 @@ if __name__ == '__main__':
 
     parser.add_argument('--detection_threshold', type=float, default=0.05)
 
+    # number of images to run through the detector at once
+    parser.add_argument('--batch_size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    # images are downloaded by this many threads while previously downloaded images are scored
+    parser.add_argument('--num_download_threads', type=int, default=DEFAULT_NUM_DOWNLOAD_THREADS)
+    # at most this many images are held in memory waiting to be scored
+    parser.add_argument('--max_images_in_memory', type=int, default=DEFAULT_MAX_IMAGES_IN_MEMORY)
+
     args = parser.parse_args()
 
     # bool argument parsing is tricky - bool(any string) is True
@@ -212,18 +256,17 @@ if __name__ == '__main__':
                          image_ids_to_score=image_ids_to_score,
                          use_url=args.use_url,
                          output_dir=args.output_dir,
-                         detection_threshold=args.detection_threshold)
-
-    try:
-        scorer.download_images()
-    except Exception as e:
-        raise RuntimeError('Exception in scorer.download_images(): {}'.format(str(e)))
+                         detection_threshold=args.detection_threshold,
+                         batch_size=args.batch_size,
+                         num_download_threads=args.num_download_threads,
+                         max_images_in_memory=args.max_images_in_memory)
 
     try:
         score_start = datetime.now()
         scorer.score()
+        # downloading overlaps with inference, so this includes the downloads that inference had to wait for
         inference_duration_seconds = datetime.now() - score_start
-        print('score.py - inference_duration_seconds (inference only):', inference_duration_seconds)
+        print('score.py - inference_duration_seconds (download and inference):', inference_duration_seconds)
     except Exception as e:
         raise RuntimeError('Exception in scorer.score(): {}'.format(str(e)))
 
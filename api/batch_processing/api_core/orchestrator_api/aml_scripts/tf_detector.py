@@ -1,3 +1,5 @@
+import itertools
+
 import PIL.Image as Image
 import numpy as np
 import tensorflow as tf
@@ -6,7 +8,13 @@ print('tensorflow tf version:', tf.__version__)
 print('tf_detector.py, tf.test.is_gpu_available:', tf.test.is_gpu_available())
 
 
-batch_size = 1
+# Number of images to run through the model at once; a batch tensor has a single shape, so only images of the same
+# size are batched together
+DEFAULT_BATCH_SIZE = 1
+
+# generate_detections_stream() reads this many batches' worth of images at a time and groups them by size, so that
+# images of the same size are batched together even if they are not next to each other in the input
+STREAM_WINDOW_BATCHES = 8
 
 # Number of decimal places to round to for confidence and bbox coordinates
 CONF_DIGITS = 3
@@ -15,8 +23,9 @@ COORD_DIGITS = 4
 
 class TFDetector:
 
-    def __init__(self, model_path):
+    def __init__(self, model_path, batch_size=DEFAULT_BATCH_SIZE):
         self.detection_graph = self.load_model(model_path)
+        self.batch_size = batch_size
 
     def load_model(self, model_path):
         """Loads a detection model (i.e., create a graph) from a .pb file.
@@ -85,22 +94,18 @@ class TFDetector:
         return new
 
     def _generate_detections_batch(self, images, sess, image_tensor, box_tensor, score_tensor, class_tensor):
-        print('_generate_detections_batch')
-        np_images = [np.asarray(image, np.uint8) for image in images]
-        images_stacked = np.expand_dims(np_images[0], axis=0)
-
-        print('images_stacked shape: ', images_stacked.shape)
+        """Runs one inference call on a list of images, which all need to be the same size."""
+        images_stacked = np.stack([np.asarray(image, np.uint8) for image in images])
 
         # performs inference
         (box_tensor, score_tensor, class_tensor) = sess.run(
             [box_tensor, score_tensor, class_tensor],
             feed_dict={image_tensor: images_stacked})
 
-        print('box_tensor shape: ', box_tensor.shape)
         return box_tensor, score_tensor, class_tensor
 
     def generate_detections_batch(self, images, image_ids, detection_threshold,
-                                  image_metas=None, metadata_available=False):
+                                  image_metas=None, metadata_available=False, sess=None):
         """
         Args:
             images: resized images to be processed by the detector
@@ -108,6 +113,8 @@ class TFDetector:
             detection_threshold: detection confidence above which to record the detection result
             image_metas: list of strings, same length as image_ids
             metadata_available: is image_metas actually available (if not, image_metas can be a list of None)
+            sess: optional tf.Session on self.detection_graph to use, e.g. from new_session(); if None, a session is
+                created and closed for this call
 
         Returns:
             detections: list of detection entries with fields
@@ -119,69 +126,114 @@ class TFDetector:
             failed_images: list of image_ids for images that failed to process
             failed_metas: list of image_metas for images that failed to process
         """
-
         # number of images should be small - all are loaded at once and a copy of resized version exists at one point
         # 2000 images are okay on a NC6s_v3
-        print('tf_detector.py: generate_detections_batch...')
-
-        # group the images into batches; image_batches is a list of lists
-        image_batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
-
-        # we keep track of the image_ids (and image_metas when available) to be able to output the list of failed images
-        image_id_batches = [image_ids[i:i + batch_size] for i in range(0, len(images), batch_size)]
         if image_metas is None:
             image_metas = [None] * len(images)
-        image_meta_batches = [image_metas[i:i + batch_size] for i in range(0, len(images), batch_size)]
+        return self.generate_detections_stream(zip(images, image_ids, image_metas), detection_threshold,
+                                               metadata_available=metadata_available, sess=sess)
+
+    def new_session(self):
+        """Returns a tf.Session on the detection graph, which can be passed to generate_detections_batch() and
+        generate_detections_stream() to reuse it across calls; the caller is responsible for closing it.
+        """
+        return tf.Session(graph=self.detection_graph)
+
+    def generate_detections_stream(self, items, detection_threshold, metadata_available=False, sess=None):
+        """Same as generate_detections_batch(), but takes an iterable of (image, image_id, image_meta) tuples,
+        which is consumed batch_size * STREAM_WINDOW_BATCHES images at a time, so the images do not all need to be
+        in memory at once.
+
+        The images in each window are grouped by size, and each group is run in batches of at most batch_size
+        images, so images are never padded or resized to fit in a batch. Detections are returned in input order.
+        """
+        print('tf_detector.py: generate_detections_stream...')
+
+        # read the images in windows, keeping track of the image_ids (and image_metas when available) to be able to
+        # output the list of failed images
+        items = iter(items)
+        window_size = self.batch_size * STREAM_WINDOW_BATCHES
+        windows = iter(lambda: list(itertools.islice(items, window_size)), [])
 
         detections = []
         failed_images = []
         failed_metas = []
 
-        # start the TF session to process all images
-        with tf.Session(graph=self.detection_graph) as sess:
+        # start the TF session to process all images, unless the caller provided one
+        own_session = sess is None
+        if own_session:
+            sess = self.new_session()
+        try:
             # get the operators
             image_tensor = self.detection_graph.get_tensor_by_name('image_tensor:0')
             box_tensor = self.detection_graph.get_tensor_by_name('detection_boxes:0')
             score_tensor = self.detection_graph.get_tensor_by_name('detection_scores:0')
             class_tensor = self.detection_graph.get_tensor_by_name('detection_classes:0')
 
-            for i_batch, (image_batch, image_id_batch, image_meta_batch) in enumerate(zip(
-                    image_batches, image_id_batches, image_meta_batches)):
-                try:
-                    print('tf_detector.py, processing batch {} out of {}.'.format(i_batch + 1, len(image_batches)))
-
-                    b_box, b_score, b_class = self._generate_detections_batch(image_batch,
-                                                                              sess, image_tensor,
-                                                                              box_tensor, score_tensor, class_tensor)
-                    for i, (image_id, image_meta) in enumerate(zip(image_id_batch, image_meta_batch)):
-                        # apply the confidence threshold
-                        boxes, scores, classes = b_box[i], b_score[i], b_class[i]
-                        detections_cur_image = []  # will be empty for an image with no confident detections
-                        max_detection_conf = 0.0
-                        for b, s, c in zip(boxes, scores, classes):
-                            if s > detection_threshold:
-                                detection_entry = {
-                                    'category': str(int(c)),  # use string type for the numerical class label, not int
-                                    'conf': round(float(s), CONF_DIGITS),  # cast to float for json serialization
-                                    'bbox': TFDetector.convert_coords(b)
+            i_batch = 0
+            for window in windows:
+
+                # (width, height) -> list of indices into window
+                buckets = {}
+                for i_item, (image, _, _) in enumerate(window):
+                    buckets.setdefault(image.size, []).append(i_item)
+
+                window_detections = [None] * len(window)  # stays None for failed images
+                for indices in buckets.values():
+                    for i_start in range(0, len(indices), self.batch_size):
+                        batch_indices = indices[i_start:i_start + self.batch_size]
+                        i_batch += 1
+                        try:
+                            print('tf_detector.py, processing batch {}.'.format(i_batch))
+
+                            b_box, b_score, b_class = self._generate_detections_batch(
+                                [window[i][0] for i in batch_indices],
+                                sess, image_tensor, box_tensor, score_tensor, class_tensor)
+
+                            batch_detections = []
+                            for i, i_item in enumerate(batch_indices):
+                                _, image_id, image_meta = window[i_item]
+
+                                # apply the confidence threshold
+                                boxes, scores, classes = b_box[i], b_score[i], b_class[i]
+                                detections_cur_image = []  # will be empty for an image with no confident detections
+                                max_detection_conf = 0.0
+                                for b, s, c in zip(boxes, scores, classes):
+                                    if s > detection_threshold:
+                                        # use string type for the numerical class label, not int, and cast the
+                                        # confidence to float for json serialization
+                                        detection_entry = {
+                                            'category': str(int(c)),
+                                            'conf': round(float(s), CONF_DIGITS),
+                                            'bbox': TFDetector.convert_coords(b)
+                                        }
+                                        detections_cur_image.append(detection_entry)
+                                        if s > max_detection_conf:
+                                            max_detection_conf = s
+
+                                detection = {
+                                    'file': image_id,
+                                    'max_detection_conf': round(float(max_detection_conf), CONF_DIGITS),
+                                    'detections': detections_cur_image
                                 }
-                                detections_cur_image.append(detection_entry)
-                                if s > max_detection_conf:
-                                    max_detection_conf = s
-
-                        detection = {
-                            'file': image_id,
-                            'max_detection_conf': round(float(max_detection_conf), CONF_DIGITS),
-                            'detections': detections_cur_image
-                        }
-                        if metadata_available:
-                            detection['meta'] = image_meta
-                        detections.append(detection)
-
-                except Exception as e:
-                    failed_images.extend(image_id_batch)
-                    failed_metas.extend(image_meta_batch)
-                    print('tf_detector.py, one batch of images failed, exception: {}'.format(str(e)))
-                    continue
+                                if metadata_available:
+                                    detection['meta'] = image_meta
+                                batch_detections.append(detection)
+
+                            for i_item, detection in zip(batch_indices, batch_detections):
+                                window_detections[i_item] = detection
+
+                        except Exception as e:
+                            for i_item in batch_indices:
+                                _, image_id, image_meta = window[i_item]
+                                failed_images.append(image_id)
+                                failed_metas.append(image_meta)
+                            print('tf_detector.py, one batch of images failed, exception: {}'.format(str(e)))
+                            continue
+
+                detections.extend(d for d in window_detections if d is not None)
+        finally:
+            if own_session:
+                sess.close()
 
         return detections, failed_images, failed_metas
@@ -21,7 +21,9 @@ combine the intermediate files created by the API.
 
 import argparse
 import json
-from typing import Any, Dict, Iterable, Mapping, List, Optional
+from typing import Any, Dict, Iterable, Iterator, Mapping, List, Optional
+
+from api.batch_processing.postprocessing.load_api_results import ApiResultsReader
 
 #%% Merge functions
 
@@ -37,15 +39,10 @@ def combine_api_output_files(input_files: List[str],
         output_file: optional str, path to write merged JSON
         require_uniqueness: bool, TODO
     """
-    input_dicts = []
-    print('Loading input files')
-    for fn in input_files:
-        with open(fn, 'r') as f:
-            input_dicts.append(json.load(f))
-
     print('Merging results')
     merged_dict = combine_api_output_dictionaries(
-        input_dicts, require_uniqueness=require_uniqueness)
+        iterate_api_output_files(input_files),
+        require_uniqueness=require_uniqueness)
 
     print('Writing output')
     if output_file is not None:
@@ -55,6 +52,26 @@ def combine_api_output_files(input_files: List[str],
     return merged_dict
 
 
+def iterate_api_output_files(input_files: Iterable[str]
+                             ) -> Iterator[Dict[str, Any]]:
+    """Yields a dictionary for each of the JSON API detection files
+    *input_files*, in the format expected by combine_api_output_dictionaries(),
+    except that 'images' is a generator that reads image entries from the file
+    one at a time.  No input file is loaded into memory in its entirety, though
+    reading the fields other than 'images' may take an extra pass through each
+    file (see ApiResultsReader).
+
+    Args:
+        input_files: list of str, paths to JSON detection files
+    """
+    for fn in input_files:
+        print(f'Loading {fn}')
+        reader = ApiResultsReader(fn)
+        input_dict = dict(reader.other_fields)
+        input_dict['images'] = reader.iter_images()
+        yield input_dict
+
+
 def combine_api_output_dictionaries(input_dicts: Iterable[Mapping[str, Any]],
                                     require_uniqueness: bool = True
                                     ) -> Dict[str, Any]:
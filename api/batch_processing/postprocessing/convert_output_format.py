@@ -3,9 +3,10 @@
 # convert_output_format.py
 #
 # Converts between file formats output by our batch processing API.  Currently
-# supports json <--> csv conversion, but this should be the landing place for any
-# conversion - including between future .json versions - that we support in the 
-# future.
+# supports json <--> csv and json <--> columnar (a folder of .npy arrays, see
+# load_api_results.write_columnar_api_results) conversion, but this should be the
+# landing place for any conversion - including between future .json versions - that
+# we support in the future.
 #
 ########
 
@@ -17,7 +18,9 @@ import json
 import os
 from tqdm import tqdm
 
-from api.batch_processing.postprocessing.load_api_results import load_api_results_csv
+from api.batch_processing.postprocessing.load_api_results import (
+    ApiResultsReader, ColumnarApiResults, COLUMNAR_RESULTS_EXTENSION,
+    load_api_results_csv, write_columnar_api_results)
 from data_management.annotations import annotation_constants
 
 CONF_DIGITS = 3
@@ -31,11 +34,10 @@ def convert_json_to_csv(input_path,output_path=None,min_confidence=None,
     if output_path is None:
         output_path = os.path.splitext(input_path)[0]+'.csv'
         
-    print('Loading json results from {}...'.format(input_path))
-    json_output = json.load(open(input_path))
+    # Images are read from the .json file and written to the .csv file one at a time
+    print('Converting json results from {}...'.format(input_path))
+    reader = ApiResultsReader(input_path)
 
-    rows = []
-    
     # We add an output column for each class other than 'empty', 
     # containing the maximum probability of  that class for each image
     n_non_empty_categories = len(annotation_constants.annotation_bbox_categories) - 1
@@ -45,64 +47,64 @@ def convert_json_to_csv(input_path,output_path=None,min_confidence=None,
         cat_name = annotation_constants.annotation_bbox_category_id_to_name[cat_id]
         category_column_names.append('max_conf_' + cat_name)
         
-    print('Iterating through results...')
-    for im in tqdm(json_output['images']):
+    with open(output_path, 'w', newline='', encoding=output_encoding) as f:
+        writer = csv.writer(f, delimiter=',')
+        header = ['image_path', 'max_confidence', 'detections']
+        header.extend(category_column_names)
+        writer.writerow(header)
+    
+        print('Iterating through results...')
+        for im in tqdm(reader.iter_images()):
         
-        image_id = im['file']
-        max_conf = im['max_detection_conf']
-        detections = []
-        max_category_probabilities = [None] * n_non_empty_categories
+            image_id = im['file']
+            max_conf = im['max_detection_conf']
+            detections = []
+            max_category_probabilities = [None] * n_non_empty_categories
                 
-        for d in im['detections']:
+            for d in im['detections']:
             
-            # Skip sub-threshold detections
-            if (min_confidence is not None) and (d['conf'] < min_confidence):
-                continue
+                # Skip sub-threshold detections
+                if (min_confidence is not None) and (d['conf'] < min_confidence):
+                    continue
             
-            detection = d['bbox']
+                detection = d['bbox']
             
-            # Our .json format is xmin/ymin/w/h
-            #
-            # Our .csv format was ymin/xmin/ymax/xmax
-            xmin = detection[0]
-            ymin = detection[1]
-            xmax = detection[0] + detection[2]
-            ymax = detection[1] + detection[3]
-            detection = [ymin, xmin, ymax, xmax]
+                # Our .json format is xmin/ymin/w/h
+                #
+                # Our .csv format was ymin/xmin/ymax/xmax
+                xmin = detection[0]
+                ymin = detection[1]
+                xmax = detection[0] + detection[2]
+                ymax = detection[1] + detection[3]
+                detection = [ymin, xmin, ymax, xmax]
                 
-            detection.append(d['conf'])
+                detection.append(d['conf'])
             
-            # Category 0 is empty, for which we don't have a column, so the max
-            # confidence for category N goes in column N-1
-            category_id = int(d['category'])
-            assert category_id > 0 and category_id <= n_non_empty_categories
-            category_column = category_id - 1
-            category_max = max_category_probabilities[category_column]
-            if category_max is None or d['conf'] > category_max:
-                max_category_probabilities[category_column] = d['conf']
+                # Category 0 is empty, for which we don't have a column, so the max
+                # confidence for category N goes in column N-1
+                category_id = int(d['category'])
+                assert category_id > 0 and category_id <= n_non_empty_categories
+                category_column = category_id - 1
+                category_max = max_category_probabilities[category_column]
+                if category_max is None or d['conf'] > category_max:
+                    max_category_probabilities[category_column] = d['conf']
             
-            detection.append(category_id)
-            detections.append(detection)
+                detection.append(category_id)
+                detections.append(detection)
             
-        # ...for each detection
+            # ...for each detection
         
-        detection_string = ''
-        if not omit_bounding_boxes:
-            detection_string = json.dumps(detections)
+            detection_string = ''
+            if not omit_bounding_boxes:
+                detection_string = json.dumps(detections)
             
-        row = [image_id, max_conf, detection_string]
-        row.extend(max_category_probabilities)
-        rows.append(row)
+            row = [image_id, max_conf, detection_string]
+            row.extend(max_category_probabilities)
+            writer.writerow(row)
         
-    # ...for each image
+        # ...for each image
 
-    print('Writing to csv...')
-    with open(output_path, 'w', newline='', encoding=output_encoding) as f:
-        writer = csv.writer(f, delimiter=',')
-        header = ['image_path', 'max_confidence', 'detections']
-        header.extend(category_column_names)
-        writer.writerow(header)
-        writer.writerows(rows)
+    print('Wrote csv results to {}'.format(output_path))
 
     
 def convert_csv_to_json(input_path,output_path=None):
@@ -171,6 +173,47 @@ def convert_csv_to_json(input_path,output_path=None):
     json.dump(json_out,open(output_path,'w'),indent=1)
 
 
+def convert_json_to_columnar(input_path,output_path=None):
+    """
+    Converts a .json results file to a folder of columnar arrays, reading the .json
+    file one image at a time.
+    """
+    
+    if output_path is None:
+        output_path = os.path.splitext(input_path)[0]+COLUMNAR_RESULTS_EXTENSION
+    
+    print('Converting json results from {}...'.format(input_path))
+    reader = ApiResultsReader(input_path)
+    
+    # The other fields are requested after all the images have been read, so this
+    # doesn't take another pass through the file
+    write_columnar_api_results(tqdm(reader.iter_images()),lambda: reader.other_fields,output_path)
+    
+
+def convert_columnar_to_json(input_path,output_path=None):
+    """
+    Converts a folder of columnar arrays back to a .json results file, writing one
+    image at a time.
+    """
+    
+    if output_path is None:
+        output_path = os.path.splitext(input_path)[0]+'.json'
+        
+    results = ColumnarApiResults(input_path)
+    
+    print('Writing json results to {}...'.format(output_path))
+    with open(output_path,'w') as f:
+        f.write('{\n "images": [')
+        for i_image,im in enumerate(tqdm(results.iter_images(),total=results.n_images)):
+            f.write(',\n  ' if i_image > 0 else '\n  ')
+            f.write(json.dumps(im,indent=1).replace('\n','\n  '))
+        f.write('\n ]' if results.n_images > 0 else ']')
+        for k,v in results.other_fields.items():
+            f.write(',\n "{}": '.format(k))
+            f.write(json.dumps(v,indent=1).replace('\n','\n '))
+        f.write('\n}')
+
+
 #%% Interactive driver
 
 if False:    
@@ -205,6 +248,10 @@ def main():
         convert_csv_to_json(args.input_path,args.output_path)
     elif args.input_path.endswith('.json') and args.output_path.endswith('.csv'):
         convert_json_to_csv(args.input_path,args.output_path)
+    elif args.input_path.endswith('.json') and args.output_path.endswith(COLUMNAR_RESULTS_EXTENSION):
+        convert_json_to_columnar(args.input_path,args.output_path)
+    elif args.input_path.endswith(COLUMNAR_RESULTS_EXTENSION) and args.output_path.endswith('.json'):
+        convert_columnar_to_json(args.input_path,args.output_path)
     else:
         raise ValueError('Illegal format combination')            
 
@@ -9,15 +9,232 @@
 
 #%% Constants and imports
 
+from array import array
 from collections import defaultdict
 import json
 import os
-from typing import Dict, Mapping, Optional, Tuple
+import re
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List,
+                    Mapping, Optional, Tuple, Union)
 
+import numpy as np
 import pandas as pd
 
+if TYPE_CHECKING:
+    # typing.Literal is new in Python 3.8
+    from typing import Literal
+
 headers = ['image_path', 'max_confidence', 'detections']
 
+# Number of characters to read at a time when streaming a results file
+DEFAULT_READ_CHUNK_SIZE = 1 << 20
+
+# Columnar results are stored as a folder with this extension, see
+# write_columnar_api_results()
+COLUMNAR_RESULTS_EXTENSION = '.columnar'
+
+# Columns (.npy files) in a columnar results folder, and their dtypes
+COLUMNAR_RESULTS_COLUMNS = {
+    # utf-8 encoded filenames, concatenated; filename i is
+    # image_file_bytes[image_file_offsets[i]:image_file_offsets[i+1]]
+    'image_file_bytes': np.uint8,
+    'image_file_offsets': np.int64,
+    # NaN for images without a max_detection_conf (e.g. failed images)
+    'image_max_detection_conf': np.float32,
+    # The detections for image i are rows
+    # image_detection_offsets[i]:image_detection_offsets[i+1] of the detection columns
+    'image_detection_offsets': np.int64,
+    'detection_image_index': np.int32,
+    'detection_bbox': np.float32,
+    'detection_conf': np.float32,
+    'detection_category': np.int8
+}
+
+# Fields other than the columns above, as json: the top-level fields other than
+# 'images', plus any per-image and per-detection fields that don't have columns
+# (e.g. 'failure', 'classifications')
+COLUMNAR_RESULTS_OTHER_FIELDS_FILE = 'other_fields.json'
+
+
+#%% Streaming reader for API output files
+
+class _JsonTokenStream:
+    """
+    A buffered view of a text file that decodes one JSON value at a time, reading
+    more of the file only when the value at the current position is incomplete.
+    """
+
+    _whitespace = re.compile(r'[ \t\n\r]*')
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Discards the consumed part of the buffer and reads more of the file.  Reads at
+        least as much as is already buffered, so a value that is much larger than
+        chunk_size is re-decoded O(log(size)) times rather than O(size) times.
+        """
+        if self.eof:
+            raise ValueError('Unexpected end of file in {}'.format(self.f.name))
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        s = self.f.read(max(self.chunk_size, len(self.buffer)))
+        if len(s) == 0:
+            self.eof = True
+        self.buffer += s
+
+    def next_char(self) -> str:
+        """
+        Consumes and returns the next non-whitespace character.
+        """
+        while True:
+            # The pattern matches the empty string, so this always matches
+            match = self._whitespace.match(self.buffer, self.pos)
+            assert match is not None
+            self.pos = match.end()
+            if self.pos < len(self.buffer):
+                c = self.buffer[self.pos]
+                self.pos += 1
+                return c
+            self._fill()
+
+    def peek_char(self) -> str:
+        c = self.next_char()
+        self.pos -= 1
+        return c
+
+    def expect_char(self, expected: str) -> None:
+        c = self.next_char()
+        if c != expected:
+            raise ValueError('Expected {} at offset {} in {}, found {}'.format(
+                expected, self.pos, self.f.name, c))
+
+    def decode_value(self) -> Any:
+        """
+        Consumes and returns the next complete JSON value.
+        """
+        while True:
+            # The pattern matches the empty string, so this always matches
+            match = self._whitespace.match(self.buffer, self.pos)
+            assert match is not None
+            self.pos = match.end()
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+                # A number at the very end of the buffer may be truncated, so only
+                # accept a value that's followed by something (or by EOF)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+class ApiResultsReader:
+    """
+    Reads a batch processing API output file incrementally, so the whole file never
+    needs to be in memory at once.
+
+    iter_images() yields the entries in the 'images' array one at a time.  The other
+    top-level fields ('info', 'detection_categories', etc.) are parsed on first access
+    to other_fields; if they come after 'images' in the file (as they do in files
+    written by run_tf_detector_batch.py) and haven't been read by a complete pass
+    through iter_images(), this costs one pass through the file that decodes and
+    discards each image entry.
+    """
+
+    def __init__(self, api_output_path: str,
+                 chunk_size: int = DEFAULT_READ_CHUNK_SIZE):
+        self.api_output_path = api_output_path
+        self.chunk_size = chunk_size
+        self._other_fields: Optional[Dict[str, Any]] = None
+        self._field_names: Optional[List[str]] = None
+
+    def iter_images(self) -> Iterator[Dict[str, Any]]:
+        """Yields each entry in the 'images' array, in file order."""
+        return self._read(yield_images=True)
+
+    @property
+    def other_fields(self) -> Dict[str, Any]:
+        """Top-level fields other than 'images'."""
+        if self._other_fields is None:
+            for _ in self._read(yield_images=False):
+                pass
+        assert self._other_fields is not None
+        return self._other_fields
+
+    @property
+    def field_names(self) -> List[str]:
+        """All top-level field names (including 'images'), in file order."""
+        if self._field_names is None:
+            for _ in self._read(yield_images=False):
+                pass
+        assert self._field_names is not None
+        return self._field_names
+
+    @property
+    def info(self) -> Dict[str, Any]:
+        return self.other_fields['info']
+
+    @property
+    def detection_categories(self) -> Dict[str, str]:
+        return self.other_fields['detection_categories']
+
+    def _read(self, yield_images: bool) -> Iterator[Dict[str, Any]]:
+
+        other_fields = {}
+        field_names = []
+
+        with open(self.api_output_path) as f:
+
+            stream = _JsonTokenStream(f, self.chunk_size)
+            stream.expect_char('{')
+
+            if stream.peek_char() == '}':
+                stream.next_char()
+            else:
+                while True:
+                    key = stream.decode_value()
+                    stream.expect_char(':')
+                    field_names.append(key)
+
+                    if key == 'images':
+                        stream.expect_char('[')
+                        if stream.peek_char() == ']':
+                            stream.next_char()
+                        else:
+                            while True:
+                                image = stream.decode_value()
+                                if yield_images:
+                                    yield image
+                                c = stream.next_char()
+                                if c == ']':
+                                    break
+                                if c != ',':
+                                    raise ValueError('Expected , or ] in images array in {}, found {}'.format(
+                                        self.api_output_path, c))
+                    else:
+                        other_fields[key] = stream.decode_value()
+
+                    c = stream.next_char()
+                    if c == '}':
+                        break
+                    if c != ',':
+                        raise ValueError('Expected , or }} in {}, found {}'.format(
+                            self.api_output_path, c))
+
+                # ...for each top-level field
+
+        self._other_fields = other_fields
+        self._field_names = field_names
+
 
 #%% Functions for grouping by sequence_id
 
@@ -47,11 +264,8 @@ def api_results_groupby(api_output_path, gt_db_indexed, file_to_image_id, field=
     containing entries in the 'images' section of the output file
     """
 
-    with open(api_output_path) as f:
-        detection_results = json.load(f)
-
     res = defaultdict(list)
-    for i in detection_results['images']:
+    for i in ApiResultsReader(api_output_path).iter_images():
         image_id = file_to_image_id(i['file'])
         field_val = gt_db_indexed.image_id_to_image[image_id][field]
         res[field_val].append(i)
@@ -66,8 +280,12 @@ def load_api_results(api_output_path: str, normalize_paths: bool = True,
     """Loads the json formatted results from the batch processing API to a
     Pandas DataFrame, mainly useful for various postprocessing functions.
 
+    The file is read one image entry at a time (see ApiResultsReader), rather
+    than loading the whole file with json.load().
+
     Args:
-        api_output_path: path to the API output json file
+        api_output_path: path to the API output json file, or to a folder of
+            columnar results written by write_columnar_api_results()
         normalize_paths: whether to apply os.path.normpath to the 'file' field
             in each image entry in the output file
         filename_replacements: replace some path tokens to match local paths to
@@ -83,48 +301,43 @@ def load_api_results(api_output_path: str, normalize_paths: bool = True,
     """
     print(f'Loading API results from {api_output_path}')
 
-    with open(api_output_path) as f:
-        detection_results = json.load(f)
+    # Columnar results are also accepted, see write_columnar_api_results()
+    if os.path.isdir(api_output_path):
+        reader = ColumnarApiResults(api_output_path)
+    else:
+        reader = ApiResultsReader(api_output_path)
 
-    print('De-serializing API results')
+    images = []
+    for image in reader.iter_images():
 
-    # Sanity-check that this is really a detector output file
-    for s in ['info', 'detection_categories', 'images']:
-        assert s in detection_results
+        # Normalize paths to simplify comparisons later
+        if normalize_paths:
+            image['file'] = os.path.normpath(image['file'])
+            # image['file'] = image['file'].replace('\\','/')
+
+        # Replace some path tokens to match local paths to original blob structure
+        if filename_replacements is not None:
+            fn = image['file']
+            for string_to_replace, replacement_string in filename_replacements.items():
+                fn = fn.replace(string_to_replace, replacement_string)
+            image['file'] = fn
+
+        images.append(image)
+
+    print('De-serializing API results')
 
     # Fields in the API output json other than 'images'
-    other_fields = {}
-    for k, v in detection_results.items():
-        if k != 'images':
-            other_fields[k] = v
+    other_fields = reader.other_fields
 
-    # Normalize paths to simplify comparisons later
-    if normalize_paths:
-        for image in detection_results['images']:
-            image['file'] = os.path.normpath(image['file'])
-            # image['file'] = image['file'].replace('\\','/')
+    # Sanity-check that this is really a detector output file
+    if isinstance(reader, ApiResultsReader):
+        assert 'images' in reader.field_names
+    for s in ['info', 'detection_categories']:
+        assert s in other_fields
 
     # Pack the json output into a Pandas DataFrame
-    detection_results = pd.DataFrame(detection_results['images'])
-
-    # Replace some path tokens to match local paths to original blob structure
-    # string_to_replace = list(filename_replacements.keys())[0]
-    if filename_replacements is not None:
-        for string_to_replace in filename_replacements:
-
-            replacement_string = filename_replacements[string_to_replace]
-
-            # TODO: hit some silly issues with vectorized str() and escaped
-            # characters, vectorize this later.
-            #
-            # detection_results['image_path'].str.replace(
-            #     string_to_replace, replacement_string)
-            # i_row = 0
-            for i_row in range(len(detection_results)):
-                row = detection_results.iloc[i_row]
-                fn = row['file']
-                fn = fn.replace(string_to_replace, replacement_string)
-                detection_results.at[i_row, 'file'] = fn
+    detection_results = pd.DataFrame(images)
+    del images
 
     print('Finished loading and de-serializing API results for '
           f'{len(detection_results)} images from {api_output_path}')
@@ -132,6 +345,267 @@ def load_api_results(api_output_path: str, normalize_paths: bool = True,
     return detection_results, other_fields
 
 
+#%% Functions for the columnar results format
+
+def write_columnar_api_results(images: Iterable[Mapping[str, Any]],
+                               other_fields: Union[Mapping[str, Any],
+                                                   Callable[[], Mapping[str, Any]]],
+                               output_dir: str) -> int:
+    """Writes API results to a folder of columnar arrays (.npy files), one row per
+    image and one row per detection (see COLUMNAR_RESULTS_COLUMNS).  Bounding boxes
+    and confidences are stored as float32 and categories as int8, so the format is
+    lossy for values with more than ~7 significant digits; the detector writes
+    3 (confidences) and 4 (coordinates), which are read back exactly.
+
+    Args:
+        images: iterable of image entries in the API output format, e.g.
+            ApiResultsReader.iter_images(), read once
+        other_fields: the fields in the API output json other than 'images', or
+            a function that returns them, called after *images* has been
+            consumed (so ApiResultsReader.other_fields doesn't need an extra
+            pass through the file)
+        output_dir: folder to write to, conventionally ending in
+            COLUMNAR_RESULTS_EXTENSION
+
+    Returns: the number of images written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # array.array keeps values unboxed as we go, rather than one Python object per value
+    file_bytes = bytearray()
+    file_offsets = array('q', [0])
+    max_detection_conf = array('f')
+    detection_offsets = array('q', [0])
+    detection_image_index = array('i')
+    detection_bbox = array('f')
+    detection_conf = array('f')
+    detection_category = array('b')
+
+    # Fields that don't have columns, keyed by (string) image or detection index
+    image_extra_fields = {}
+    detection_extra_fields = {}
+    images_without_detections_field = []
+
+    for i_image, im in enumerate(images):
+
+        file_bytes += im['file'].encode('utf-8')
+        file_offsets.append(len(file_bytes))
+        max_detection_conf.append(im.get('max_detection_conf', float('nan')))
+
+        extra = {k: v for k, v in im.items()
+                 if k not in ('file', 'max_detection_conf', 'detections')}
+        if len(extra) > 0:
+            image_extra_fields[str(i_image)] = extra
+
+        if 'detections' not in im:
+            images_without_detections_field.append(i_image)
+            detections = []
+        else:
+            detections = im['detections']
+
+        for d in detections:
+            assert len(d['bbox']) == 4, 'Illegal bounding box in image {}'.format(im['file'])
+            category = int(d['category'])
+            assert -128 <= category <= 127, 'Category {} does not fit in int8'.format(category)
+            extra = {k: v for k, v in d.items() if k not in ('bbox', 'conf', 'category')}
+            if len(extra) > 0:
+                detection_extra_fields[str(len(detection_conf))] = extra
+            detection_image_index.append(i_image)
+            detection_bbox.extend(d['bbox'])
+            detection_conf.append(d['conf'])
+            detection_category.append(category)
+
+        detection_offsets.append(len(detection_conf))
+
+    # ...for each image
+
+    columns: Dict[str, np.ndarray] = {
+        'image_file_bytes': np.frombuffer(bytes(file_bytes), dtype=np.uint8),
+        'image_file_offsets': np.frombuffer(file_offsets, dtype=np.int64),
+        'image_max_detection_conf': np.frombuffer(max_detection_conf, dtype=np.float32),
+        'image_detection_offsets': np.frombuffer(detection_offsets, dtype=np.int64),
+        'detection_image_index': np.frombuffer(detection_image_index, dtype=np.int32),
+        'detection_bbox': np.frombuffer(detection_bbox, dtype=np.float32).reshape(-1, 4),
+        'detection_conf': np.frombuffer(detection_conf, dtype=np.float32),
+        'detection_category': np.frombuffer(detection_category, dtype=np.int8)
+    }
+    for column_name, dtype in COLUMNAR_RESULTS_COLUMNS.items():
+        assert columns[column_name].dtype == dtype
+        np.save(os.path.join(output_dir, column_name + '.npy'), columns[column_name])
+
+    if callable(other_fields):
+        other_fields = other_fields()
+    fields = dict(other_fields)
+    fields['image_extra_fields'] = image_extra_fields
+    fields['detection_extra_fields'] = detection_extra_fields
+    fields['images_without_detections_field'] = images_without_detections_field
+    with open(os.path.join(output_dir, COLUMNAR_RESULTS_OTHER_FIELDS_FILE), 'w') as f:
+        json.dump(fields, f, indent=1)
+
+    n_images = len(max_detection_conf)
+    print(f'Wrote {n_images} images and {len(detection_conf)} detections to {output_dir}')
+    return n_images
+
+
+class ColumnarApiResults:
+    """
+    API results loaded from a folder written by write_columnar_api_results().  The
+    columns are memory-mapped numpy arrays, so filtering by confidence, category,
+    etc. can be done with array operations without materializing per-image dicts;
+    iter_images() and to_dataframe() convert back to the usual format.
+
+    Attributes:
+        other_fields: dict, top-level fields from the API output json other than 'images'
+        n_images: int
+        max_detection_conf: float32 array of length n_images, NaN if missing
+        detection_offsets: int64 array of length n_images+1, the detections for
+            image i are rows detection_offsets[i]:detection_offsets[i+1]
+        detection_image_index, detection_conf, detection_category: arrays with one
+            row per detection
+        detection_bbox: float32 array of shape (n_detections, 4)
+    """
+
+    def __init__(self, results_dir: str,
+                 mmap_mode: "Optional[Literal['r', 'r+', 'c']]" = 'r'):
+        self.results_dir = results_dir
+
+        columns = {}
+        for column_name, dtype in COLUMNAR_RESULTS_COLUMNS.items():
+            columns[column_name] = np.load(
+                os.path.join(results_dir, column_name + '.npy'), mmap_mode=mmap_mode)
+            assert columns[column_name].dtype == dtype, \
+                f'Unexpected dtype {columns[column_name].dtype} for column {column_name}'
+
+        self._file_bytes = columns['image_file_bytes']
+        self._file_offsets = columns['image_file_offsets']
+        self.max_detection_conf = columns['image_max_detection_conf']
+        self.detection_offsets = columns['image_detection_offsets']
+        self.detection_image_index = columns['detection_image_index']
+        self.detection_bbox = columns['detection_bbox']
+        self.detection_conf = columns['detection_conf']
+        self.detection_category = columns['detection_category']
+        self.n_images = len(self.max_detection_conf)
+
+        with open(os.path.join(results_dir, COLUMNAR_RESULTS_OTHER_FIELDS_FILE)) as f:
+            fields = json.load(f)
+        self._image_extra_fields = fields.pop('image_extra_fields')
+        self._detection_extra_fields = fields.pop('detection_extra_fields')
+        self._images_without_detections_field = set(fields.pop('images_without_detections_field'))
+        self.other_fields = fields
+
+    def file(self, i_image: int) -> str:
+        start, end = self._file_offsets[i_image], self._file_offsets[i_image + 1]
+        return bytes(self._file_bytes[start:end]).decode('utf-8')
+
+    def files(self) -> List[str]:
+        all_bytes = bytes(self._file_bytes)
+        offsets = self._file_offsets.tolist()
+        return [all_bytes[offsets[i]:offsets[i + 1]].decode('utf-8')
+                for i in range(self.n_images)]
+
+    def max_conf_per_image(self, detection_mask: Optional[np.ndarray] = None
+                           ) -> np.ndarray:
+        """Returns the max confidence of each image's detections (float32 array of
+        length n_images, -1 for images with no detections), optionally
+        considering only detections where *detection_mask* is True.
+        """
+        conf = self.detection_conf
+        if detection_mask is not None:
+            conf = np.where(detection_mask, conf, np.float32(-1))
+        max_conf = np.full(self.n_images, -1, dtype=np.float32)
+
+        # Detections are stored in image order, so each image's detections are a
+        # contiguous segment starting at detection_offsets[i]
+        starts = np.asarray(self.detection_offsets[:-1])
+        has_detections = np.diff(self.detection_offsets) > 0
+        if np.any(has_detections):
+            max_conf[has_detections] = np.maximum.reduceat(conf, starts[has_detections])
+        return max_conf
+
+    def has_detections_field(self) -> np.ndarray:
+        """Returns a bool array of length n_images, False for images whose entry
+        had no 'detections' field (e.g. failed images).
+        """
+        has_field = np.ones(self.n_images, dtype=bool)
+        has_field[list(self._images_without_detections_field)] = False
+        return has_field
+
+    def image_detections(self, i_image: int,
+                         detection_mask: Optional[np.ndarray] = None
+                         ) -> List[Dict[str, Any]]:
+        """Returns the detections of image *i_image* in the API output format,
+        optionally only those where *detection_mask* is True.
+        """
+        detections = []
+        start, end = self.detection_offsets[i_image], self.detection_offsets[i_image + 1]
+        bboxes = _float32_to_floats(self.detection_bbox[start:end])
+        confs = _float32_to_floats(self.detection_conf[start:end])
+        categories = self.detection_category[start:end].tolist()
+        keep = None if detection_mask is None else detection_mask[start:end]
+        for i_detection in range(start, end):
+            j = i_detection - start
+            if keep is not None and not keep[j]:
+                continue
+            d = {'category': str(categories[j]),
+                 'conf': confs[j],
+                 'bbox': bboxes[j]}
+            d.update(self._detection_extra_fields.get(str(i_detection), {}))
+            detections.append(d)
+        return detections
+
+    def iter_images(self, image_indices: Optional[Iterable[int]] = None,
+                    detection_mask: Optional[np.ndarray] = None,
+                    max_detection_conf: Optional[np.ndarray] = None
+                    ) -> Iterator[Dict[str, Any]]:
+        """Yields image entries in the API output format, for all images or for
+        the images in *image_indices*.
+
+        Args:
+            image_indices: indices of the images to yield, default all images
+            detection_mask: optional bool array with one row per detection; only
+                detections where it's True are included
+            max_detection_conf: optional array of length n_images to use instead
+                of the stored max_detection_conf (e.g. recomputed with
+                max_conf_per_image(detection_mask))
+        """
+        if image_indices is None:
+            image_indices = range(self.n_images)
+        if max_detection_conf is None:
+            max_detection_conf = self.max_detection_conf
+        for i_image in image_indices:
+            i_image = int(i_image)
+            im: Dict[str, Any] = {'file': self.file(i_image)}
+            max_conf = _float32_to_floats(max_detection_conf[i_image])
+            if not np.isnan(max_conf):
+                im['max_detection_conf'] = max_conf
+            if i_image not in self._images_without_detections_field:
+                im['detections'] = self.image_detections(i_image, detection_mask)
+            im.update(self._image_extra_fields.get(str(i_image), {}))
+            yield im
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Returns a DataFrame in the format returned by load_api_results()."""
+        return pd.DataFrame(self.iter_images())
+
+
+def _float32_to_floats(values):
+    """Converts a float32 scalar or array to Python floats (nested lists for
+    arrays), using the shortest decimal that rounds to the same float32.  This
+    removes the noise that casting float32 to float64 would add (0.123 rather
+    than 0.12300000339746475) without rounding away any stored precision, so
+    values with up to ~7 significant digits come back exactly as written.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    if values.ndim == 0:
+        return float(str(values))
+    return values.astype(str).astype(np.float64).tolist()
+
+
+def load_columnar_api_results(results_dir: str) -> ColumnarApiResults:
+    print(f'Loading columnar API results from {results_dir}')
+    return ColumnarApiResults(results_dir)
+
+
 def write_api_results(detection_results_table, other_fields, out_path):
     """
     Writes a Pandas DataFrame back to a json that is compatible with the API output format.
@@ -142,10 +616,9 @@ def write_api_results(detection_results_table, other_fields, out_path):
     fields = other_fields
 
     # TODO: read double_precision from a config elsewhere
-    images = detection_results_table.to_json(orient='records',
-                                             double_precision=3)
-    images = json.loads(images)
-    fields['images'] = images
+    images_json = detection_results_table.to_json(orient='records',
+                                                  double_precision=3)
+    fields['images'] = json.loads(images_json)
 
     with open(out_path, 'w') as f:
         json.dump(fields, f, indent=1)
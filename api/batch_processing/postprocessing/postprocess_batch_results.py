@@ -26,7 +26,8 @@ from enum import IntEnum
 import errno
 import io
 import itertools
-from multiprocessing.pool import ThreadPool
+from functools import partial
+from multiprocessing.pool import Pool, ThreadPool
 import os
 import sys
 import time
@@ -50,6 +51,7 @@ import path_utils
 # Assumes the cameratraps repo root is on the path
 import visualization.visualization_utils as vis_utils
 import visualization.plot_utils as plot_utils
+from visualization import render_cache
 from data_management.cct_json_utils import (CameraTrapJsonUtils, IndexedJsonDb)
 from api.batch_processing.postprocessing.load_api_results import load_api_results
 from ct_utils import args_to_object
@@ -63,6 +65,9 @@ warnings.filterwarnings('ignore', '(Possibly )?corrupt EXIF data', UserWarning)
 DEFAULT_NEGATIVE_CLASSES = ['empty']
 DEFAULT_UNKNOWN_CLASSES = ['unknown', 'unlabeled', 'ambiguous']
 
+# Number of rendering threads if parallelize_rendering_n_cores isn't specified
+DEFAULT_RENDERING_THREADS = 100
+
 
 def has_overlap(set1: Iterable, set2: Iterable) -> bool:
     """Check whether 2 sets overlap."""
@@ -108,6 +113,10 @@ class PostProcessingOptions:
     # Used for summary statistics only
     target_recall = 0.9
 
+    # Confidence thresholds at which to report precision/recall/F1, overall and for
+    # each ground truth class (only used when ground truth is available)
+    threshold_sweep_values = [round(0.05 * i, 2) for i in range(1, 20)]
+
     # Number of images to sample, -1 for "all images"
     num_images_to_sample = 500
 
@@ -142,10 +151,23 @@ class PostProcessingOptions:
     include_almost_detections = False
     almost_detection_confidence_threshold = 0.75
 
-    # Control rendering parallelization
-    parallelize_rendering_n_cores: Optional[int] = 100
+    # Control rendering parallelization; if None, 100 threads or os.cpu_count()
+    # processes are used
+    parallelize_rendering_n_cores: Optional[int] = None
     parallelize_rendering = False
 
+    # Only meaningful if parallelize_rendering is True: use a thread pool (True) or a
+    # process pool (False).  Drawing and JPEG encoding are largely GIL-bound, so
+    # processes scale better across cores; threads are better when rendering is
+    # dominated by reading images from remote storage.
+    parallelize_rendering_with_threads = True
+
+    # Optionally cache rendered images in this folder, so images whose source
+    # file, detections and rendering options are unchanged since an earlier run
+    # are linked (or copied) from the cache rather than re-rendered
+    render_cache_dir: Optional[str] = None
+    render_cache_max_size_bytes = render_cache.DEFAULT_RENDER_CACHE_MAX_SIZE_BYTES
+
     # Determines whether missing images force an error
     allow_missing_images = False
 
@@ -211,64 +233,36 @@ def mark_detection_status(
     n_positive = 0
     n_negative = 0
 
+    # The status of an image only depends on its set of category IDs, and most
+    # datasets have few distinct sets, so we compute each status once; maps
+    # frozensets of category IDs to (status, unambiguous category or None)
+    status_by_categories = {}
+
     print('Preparing ground-truth annotations')
     for im in tqdm(indexed_db.db['images']):
 
         image_id = im['id']
         annotations = indexed_db.image_id_to_annotations[image_id]
-        categories = [ann['category_id'] for ann in annotations]
-        category_names = set(indexed_db.cat_id_to_name[cat] for cat in categories)
-
-        # Check whether this image has:
-        # - unknown / unassigned-type labels
-        # - negative-type labels
-        # - positive labels (i.e., labels that are neither unknown nor negative)
-        has_unknown_labels = has_overlap(category_names, unknown_classes)
-        has_negative_labels = has_overlap(category_names, negative_classes)
-        has_positive_labels = 0 < len(category_names - (unknown_classes | negative_classes))
-        # assert has_unknown_labels is False, '{} has unknown labels'.format(annotations)
-
-        # If there are no image annotations, treat this as unknown
-        if len(categories) == 0:
-            n_unknown += 1
-            im['_detection_status'] = DetectionStatus.DS_UNKNOWN
+        categories = frozenset(ann['category_id'] for ann in annotations)
 
-            # n_negative += 1
-            # im['_detection_status'] = DetectionStatus.DS_NEGATIVE
+        if categories not in status_by_categories:
+            status_by_categories[categories] = get_detection_status(
+                categories, indexed_db.cat_id_to_name, negative_classes, unknown_classes)
+        status, unambiguous_category = status_by_categories[categories]
 
-        # If the image has more than one type of labels, it's ambiguous
-        # note: bools are automatically converted to 0/1, so we can sum
-        elif (has_unknown_labels + has_negative_labels + has_positive_labels) > 1:
-            n_ambiguous += 1
-            im['_detection_status'] = DetectionStatus.DS_AMBIGUOUS
+        im['_detection_status'] = status
+        if unambiguous_category is not None:
+            im['_unambiguous_category'] = unambiguous_category
 
-        # After the check above, we can be sure it's only one of positive,
-        # negative, or unknown.
-        #
-        # Important: do not merge the following 'unknown' branch with the first
-        # 'unknown' branch above, where we tested 'if len(categories) == 0'
-        #
-        # If the image has only unknown labels
-        elif has_unknown_labels:
+        if status == DetectionStatus.DS_UNKNOWN:
             n_unknown += 1
-            im['_detection_status'] = DetectionStatus.DS_UNKNOWN
-
-        # If the image has only negative labels
-        elif has_negative_labels:
+        elif status == DetectionStatus.DS_AMBIGUOUS:
+            n_ambiguous += 1
+        elif status == DetectionStatus.DS_NEGATIVE:
             n_negative += 1
-            im['_detection_status'] = DetectionStatus.DS_NEGATIVE
-
-        # If the images has only positive labels
-        elif has_positive_labels:
-            n_positive += 1
-            im['_detection_status'] = DetectionStatus.DS_POSITIVE
-
-            # Annotate the category, if it is unambiguous
-            if len(category_names) == 1:
-                im['_unambiguous_category'] = list(category_names)[0]
-
         else:
-            raise Exception('Invalid detection state')
+            assert status == DetectionStatus.DS_POSITIVE
+            n_positive += 1
 
     # ...for each image
 
@@ -277,6 +271,164 @@ def mark_detection_status(
 # ...mark_detection_status()
 
 
+def get_detection_status(categories, cat_id_to_name, negative_classes, unknown_classes):
+    """
+    Determines whether an image with the category IDs [categories] should be treated
+    as positive, negative, ambiguous, or unknown; see mark_detection_status().
+
+    [negative_classes] and [unknown_classes] are sets of category names.
+
+    returns (DetectionStatus, the image's category name if it's positive and
+    has only one category, otherwise None)
+    """
+
+    category_names = set(cat_id_to_name[cat] for cat in categories)
+
+    # Check whether this image has:
+    # - unknown / unassigned-type labels
+    # - negative-type labels
+    # - positive labels (i.e., labels that are neither unknown nor negative)
+    has_unknown_labels = has_overlap(category_names, unknown_classes)
+    has_negative_labels = has_overlap(category_names, negative_classes)
+    has_positive_labels = 0 < len(category_names - (unknown_classes | negative_classes))
+    # assert has_unknown_labels is False, '{} has unknown labels'.format(annotations)
+
+    # If there are no image annotations, treat this as unknown
+    if len(categories) == 0:
+        return DetectionStatus.DS_UNKNOWN, None
+        # return DetectionStatus.DS_NEGATIVE, None
+
+    # If the image has more than one type of labels, it's ambiguous
+    # note: bools are automatically converted to 0/1, so we can sum
+    elif (has_unknown_labels + has_negative_labels + has_positive_labels) > 1:
+        return DetectionStatus.DS_AMBIGUOUS, None
+
+    # After the check above, we can be sure it's only one of positive,
+    # negative, or unknown.
+    #
+    # Important: do not merge the following 'unknown' branch with the first
+    # 'unknown' branch above, where we tested 'if len(categories) == 0'
+    #
+    # If the image has only unknown labels
+    elif has_unknown_labels:
+        return DetectionStatus.DS_UNKNOWN, None
+
+    # If the image has only negative labels
+    elif has_negative_labels:
+        return DetectionStatus.DS_NEGATIVE, None
+
+    # If the images has only positive labels
+    elif has_positive_labels:
+
+        # Annotate the category, if it is unambiguous
+        if len(category_names) == 1:
+            return DetectionStatus.DS_POSITIVE, list(category_names)[0]
+        return DetectionStatus.DS_POSITIVE, None
+
+    else:
+        raise Exception('Invalid detection state')
+
+# ...get_detection_status()
+
+
+def get_ground_truth_arrays(indexed_db: IndexedJsonDb, filenames: Iterable[str]
+                            ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Joins [filenames] (e.g. the 'file' column of the detector output) to the ground
+    truth by filename, after mark_detection_status() has been run on [indexed_db].
+
+    Returns:
+        gt_status: int array aligned with [filenames], the DetectionStatus of each
+            image (DS_UNASSIGNED for images that aren't in the ground truth)
+        gt_category: object array aligned with [filenames], the unambiguous ground
+            truth category name of each image, or None
+    """
+
+    filename_to_status = {}
+    filename_to_category = {}
+    for fn, image_id in indexed_db.filename_to_id.items():
+        image = indexed_db.image_id_to_image[image_id]
+        filename_to_status[fn] = int(image['_detection_status'])
+        filename_to_category[fn] = image.get('_unambiguous_category', None)
+
+    filenames = pd.Series(list(filenames), dtype=object)
+    gt_status = filenames.map(filename_to_status).fillna(
+        int(DetectionStatus.DS_UNASSIGNED)).to_numpy(dtype=int)
+    gt_category = filenames.map(filename_to_category).to_numpy(dtype=object)
+    gt_category[pd.isnull(gt_category)] = None
+
+    return gt_status, gt_category
+
+
+def compute_threshold_sweep(p_detection: np.ndarray, gt_status: np.ndarray,
+                            gt_category: np.ndarray, thresholds: Iterable[float]
+                            ) -> pd.DataFrame:
+    """
+    Computes precision, recall, and F1 at each confidence threshold in [thresholds],
+    for all positive images and separately for the positive images of each ground
+    truth category.  An image is a detection if its max confidence is above the
+    threshold.  Negatives are the same (all negative images) for every category;
+    ambiguous and unknown images are ignored.
+
+    Args:
+        p_detection: array of max detection confidence for each image
+        gt_status, gt_category: arrays aligned with [p_detection], as returned
+            by get_ground_truth_arrays()
+        thresholds: confidence thresholds
+
+    Returns: a DataFrame with one row per (category, threshold), with columns
+        category ('all' or a ground truth category name), confidence_threshold,
+        n_positive, tp, fp, fn, precision, recall, f1
+    """
+
+    thresholds = np.asarray(list(thresholds), dtype=float)
+    p_detection = np.asarray(p_detection, dtype=float)
+
+    b_positive = (gt_status == DetectionStatus.DS_POSITIVE)
+    b_negative = (gt_status == DetectionStatus.DS_NEGATIVE)
+
+    # The number of values in a sorted array of confidences above each threshold
+    def count_above_thresholds(sorted_confidences):
+        return len(sorted_confidences) - np.searchsorted(
+            sorted_confidences, thresholds, side='right')
+
+    fp = count_above_thresholds(np.sort(p_detection[b_negative]))
+
+    positive_sets = [('all', b_positive)]
+    categories = sorted(set(c for c in gt_category[b_positive] if c is not None))
+    for category in categories:
+        positive_sets.append((category, b_positive & (gt_category == category)))
+
+    tables = []
+    for category, b_category in positive_sets:
+
+        n_positive = int(np.sum(b_category))
+        tp = count_above_thresholds(np.sort(p_detection[b_category]))
+        fn = n_positive - tp
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), np.nan)
+            recall = np.where(n_positive > 0, tp / max(n_positive, 1), np.nan)
+            f1 = np.where(precision + recall > 0,
+                          2 * precision * recall / (precision + recall), np.nan)
+
+        tables.append(pd.DataFrame({
+            'category': category,
+            'confidence_threshold': thresholds,
+            'n_positive': n_positive,
+            'tp': tp,
+            'fp': fp,
+            'fn': fn,
+            'precision': precision,
+            'recall': recall,
+            'f1': f1
+        }))
+
+    # ...for each set of positives
+
+    return pd.concat(tables, ignore_index=True)
+
+
 def is_sas_url(s: str) -> bool:
     """
     Placeholder for a more robust way to verify that a link is a SAS URL.
@@ -355,17 +507,42 @@ def render_bounding_boxes(
         else:
             image_full_path = os.path.join(image_base_dir, image_relative_path)
 
+        # Render images to a flat folder... we can use os.sep here because we've
+        # already normalized paths
+        sample_name = res + '_' + path_utils.flatten_path(image_relative_path)
+        fullpath = os.path.join(options.output_dir, res, sample_name)
+
+        cache = render_cache.get_render_cache(options.render_cache_dir,
+                                              options.render_cache_max_size_bytes)
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.get_key(image_full_path, detections, {
+                'viz_target_width': options.viz_target_width,
+                'confidence_threshold': options.confidence_threshold,
+                'line_thickness': options.line_thickness,
+                'box_expansion': options.box_expansion,
+                'detection_categories': detection_categories,
+                'classification_categories': classification_categories})
+            try:
+                if cache.fetch(cache_key, fullpath):
+                    return get_html_image_info(res, sample_name, display_name)
+            except OSError:
+                # e.g. a path that's too long; fall through to rendering
+                pass
+
         # os.path.isfile() is slow when mounting remote directories; much faster
         # to just try/except on the image open.
+        #
+        # When resizing, open_resized_image() decodes JPEGs at reduced resolution.
         try:
-            image = vis_utils.open_image(image_full_path)
+            if options.viz_target_width is not None:
+                image, _ = vis_utils.open_resized_image(image_full_path, options.viz_target_width)
+            else:
+                image = vis_utils.open_image(image_full_path)
         except:
             print('Warning: could not open image file {}'.format(image_full_path))
             return ''
 
-        if options.viz_target_width is not None:
-            image = vis_utils.resize_image(image, options.viz_target_width)
-
         vis_utils.render_detection_bounding_boxes(
             detections, image,
             label_map=detection_categories,
@@ -374,12 +551,11 @@ def render_bounding_boxes(
             thickness=options.line_thickness,
             expansion=options.box_expansion)
 
-        # Render images to a flat folder... we can use os.sep here because we've
-        # already normalized paths
-        sample_name = res + '_' + path_utils.flatten_path(image_relative_path)
-        fullpath = os.path.join(options.output_dir, res, sample_name)
         try:
-            image.save(fullpath)
+            if cache is not None:
+                cache.save(image, fullpath, cache_key)
+            else:
+                image.save(fullpath)
         except OSError as e:
             # errno.ENAMETOOLONG doesn't get thrown properly on Windows, so
             # we awkwardly check against a hard-coded limit
@@ -390,6 +566,17 @@ def render_bounding_boxes(
             else:
                 raise
 
+    return get_html_image_info(res, sample_name, display_name)
+
+# ...render_bounding_boxes
+
+
+def get_html_image_info(res, sample_name, display_name):
+    """
+    Returns the html info struct for the rendered image [sample_name] in the
+    [res] folder, in the form that's used for write_html_image_list.
+    """
+
     # Use slashes regardless of os
     file_name = '{}/{}'.format(res,sample_name)
 
@@ -399,7 +586,256 @@ def render_bounding_boxes(
         'textStyle': 'font-family:verdana,arial,calibri;font-size:80%;text-align:left;margin-top:20;margin-bottom:5'
     }
 
-# ...render_bounding_boxes
+
+def render_image_with_gt(file_info, rendering_args):
+    """
+    Renders one image for the ground-truth report.
+
+    Args:
+        file_info: tuple of (relative path, max_conf, detections, gt_info), where
+            gt_info is None if the image isn't in the ground truth database,
+            otherwise a tuple of (image id, ground truth detection status, list of
+            ground truth class names, classification accuracy or None)
+        rendering_args: dict with keys 'options', 'detection_categories' and
+            'classification_categories'
+
+    Returns a list of [collection name, html info struct] pairs, or None if the
+    image wasn't rendered.
+    """
+
+    image_relative_path, max_conf, detections, gt_info = file_info
+    options = rendering_args['options']
+
+    # This should already have been normalized to either '/' or '\'
+
+    if gt_info is None:
+        print('Warning: couldn''t find ground truth for image {}'.format(image_relative_path))
+        return None
+
+    image_id, gt_status, gt_classes, classification_accuracy = gt_info
+
+    gt_presence = bool(gt_status)
+
+    gt_class_summary = ','.join(gt_classes)
+
+    if gt_status > DetectionStatus.DS_MAX_DEFINITIVE_VALUE:
+        print(f'Skipping image {image_id}, does not have a definitive '
+              f'ground truth status (status: {gt_status}, classes: {gt_class_summary})')
+        return None
+
+    detected = max_conf > options.confidence_threshold
+
+    if gt_presence and detected:
+        if classification_accuracy is None:
+            res = 'tp'
+        elif np.isclose(1, classification_accuracy):
+            res = 'tpc'
+        else:
+            res = 'tpi'
+    elif not gt_presence and detected:
+        res = 'fp'
+    elif gt_presence and not detected:
+        res = 'fn'
+    else:
+        res = 'tn'
+
+    display_name = '<b>Result type</b>: {}, <b>Presence</b>: {}, <b>Class</b>: {}, <b>Max conf</b>: {:0.3f}%, <b>Image</b>: {}'.format(
+        res.upper(), str(gt_presence), gt_class_summary,
+        max_conf * 100, image_relative_path)
+
+    rendered_image_html_info = render_bounding_boxes(
+        options.image_base_dir,
+        image_relative_path,
+        display_name,
+        detections,
+        res,
+        rendering_args['detection_categories'],
+        rendering_args['classification_categories'],
+        options)
+
+    image_result = None
+    if len(rendered_image_html_info) > 0:
+        image_result = [[res, rendered_image_html_info]]
+        for gt_class in gt_classes:
+            image_result.append(['class_{}'.format(gt_class), rendered_image_html_info])
+
+    return image_result
+
+# ...def render_image_with_gt(file_info)
+
+
+def render_image_no_gt(file_info, rendering_args):
+    """
+    Renders one image for the report without ground truth.
+
+    Args:
+        file_info: tuple of (relative path, max_conf, detections)
+        rendering_args: dict with keys 'options', 'detection_categories',
+            'classification_categories' and 'detection_categories_to_results_name'
+
+    Returns a list of [collection name, html info struct] pairs, or None if the
+    image wasn't rendered.
+    """
+
+    image_relative_path, max_conf, detections = file_info
+    options = rendering_args['options']
+    classification_categories = rendering_args['classification_categories']
+
+    detection_status = DetectionStatus.DS_UNASSIGNED
+    if max_conf >= options.confidence_threshold:
+        detection_status = DetectionStatus.DS_POSITIVE
+    else:
+        if options.include_almost_detections:
+            if max_conf >= options.almost_detection_confidence_threshold:
+                detection_status = DetectionStatus.DS_ALMOST
+            else:
+                detection_status = DetectionStatus.DS_NEGATIVE
+        else:
+            detection_status = DetectionStatus.DS_NEGATIVE
+
+    if detection_status == DetectionStatus.DS_POSITIVE:
+        if options.separate_detections_by_category:
+            # Get unique categories above the threshold for this image
+            positive_categories = set()
+            for d in detections:
+                if d['conf'] >= options.confidence_threshold:
+                    positive_categories.add(d['category'])
+            positive_categories = tuple(sorted(positive_categories))
+            res = rendering_args['detection_categories_to_results_name'][positive_categories]
+        else:
+            res = 'detections'
+
+    elif detection_status == DetectionStatus.DS_NEGATIVE:
+        res = 'non_detections'
+    else:
+        assert detection_status == DetectionStatus.DS_ALMOST
+        res = 'almost_detections'
+
+    display_name = '<b>Result type</b>: {}, <b>Image</b>: {}, <b>Max conf</b>: {:0.3f}'.format(
+        res, image_relative_path, max_conf)
+
+    rendering_options = copy.copy(options)
+    if detection_status == DetectionStatus.DS_ALMOST:
+        rendering_options.confidence_threshold = rendering_options.almost_detection_confidence_threshold
+    rendered_image_html_info = render_bounding_boxes(
+        options.image_base_dir,
+        image_relative_path,
+        display_name,
+        detections,
+        res,
+        rendering_args['detection_categories'],
+        classification_categories,
+        rendering_options)
+
+    image_result = None
+
+    if len(rendered_image_html_info) > 0:
+
+        image_result = [[res, rendered_image_html_info]]
+
+        for det in detections:
+
+            if 'classifications' in det:
+
+                # This is a list of [class,confidence] pairs, sorted by confidence
+                classifications = det['classifications']
+                top1_class_id = classifications[0][0]
+                top1_class_name = classification_categories[top1_class_id]
+                top1_class_score = classifications[0][1]
+
+                # If we either don't have a confidence threshold, or we've met our
+                # confidence threshold
+                if (options.classification_confidence_threshold < 0) or \
+                    (top1_class_score >= options.classification_confidence_threshold):
+                    image_result.append(['class_{}'.format(top1_class_name),
+                                         rendered_image_html_info])
+                else:
+                    image_result.append(['class_unreliable',
+                                         rendered_image_html_info])
+
+            # ...if this detection has classification info
+
+        # ...for each detection
+
+    return image_result
+
+# ...def render_image_no_gt(file_info)
+
+
+# The render function and its arguments in each rendering worker process, set by
+# _init_rendering_worker() so they're only sent once per process
+_rendering_worker_function = None
+_rendering_worker_args = None
+
+
+def _init_rendering_worker(render_function, rendering_args, render_cache_args=None):
+    global _rendering_worker_function, _rendering_worker_args
+    _rendering_worker_function = render_function
+    _rendering_worker_args = rendering_args
+
+    # Create this process's render cache with the size the parent computed, so
+    # each worker doesn't scan the whole cache folder
+    if render_cache_args is not None:
+        render_cache.get_render_cache(*render_cache_args)
+
+
+def _render_in_worker(file_info):
+    return _rendering_worker_function(file_info, _rendering_worker_args)
+
+
+def render_images(render_function, files_to_render, rendering_args, options):
+    """
+    Calls render_function(file_info, rendering_args) for each element of
+    files_to_render, serially or in a thread or process pool according to
+    [options], and returns the results in order.
+
+    For the process pool, render_function must be a module-level function and
+    rendering_args must be picklable; they're sent to each worker once.
+    """
+
+    if not options.parallelize_rendering:
+        # file_info = files_to_render[0]
+        return [render_function(file_info, rendering_args) for file_info in tqdm(files_to_render)]
+
+    n_workers = options.parallelize_rendering_n_cores
+    if n_workers is None:
+        if options.parallelize_rendering_with_threads:
+            n_workers = DEFAULT_RENDERING_THREADS
+        else:
+            n_workers = os.cpu_count()
+    print('Rendering images with {} {}'.format(
+        n_workers, 'threads' if options.parallelize_rendering_with_threads else 'processes'))
+
+    if options.parallelize_rendering_with_threads:
+        pool = ThreadPool(n_workers)
+        results = list(tqdm(pool.imap(partial(render_function, rendering_args=rendering_args),
+                                      files_to_render), total=len(files_to_render)))
+    else:
+        render_cache_args = None
+        cache = render_cache.get_render_cache(options.render_cache_dir,
+                                              options.render_cache_max_size_bytes)
+        if cache is not None:
+            render_cache_args = (options.render_cache_dir, options.render_cache_max_size_bytes,
+                                 cache.size_bytes)
+        pool = Pool(n_workers, initializer=_init_rendering_worker,
+                    initargs=(render_function, rendering_args, render_cache_args))
+        results = list(tqdm(pool.imap(_render_in_worker, files_to_render, chunksize=4),
+                            total=len(files_to_render)))
+    pool.close()
+    pool.join()
+
+    return results
+
+
+def get_rendering_options(options):
+    """
+    Returns a copy of [options] without the loaded API results, which rendering
+    doesn't need, so they aren't sent to each rendering process.
+    """
+    rendering_options = copy.copy(options)
+    rendering_options.api_detection_results = None
+    rendering_options.api_other_fields = None
+    return rendering_options
 
 
 def prepare_html_subpages(images_html, output_dir, options=None):
@@ -586,20 +1022,14 @@ def process_batch_results(options: PostProcessingOptions
         p_detection = detections_df['max_detection_conf'].values
         n_detections = len(p_detection)
 
-        # numpy array of bools (0.0/1.0), and -1 as null value
-        gt_detections = np.zeros(n_detections, dtype=float)
+        # Ground truth status and category for each image, aligned with p_detection
+        gt_status, gt_category = get_ground_truth_arrays(
+            ground_truth_indexed_db, detector_files)
 
-        for i_detection, fn in enumerate(detector_files):
-            image_id = ground_truth_indexed_db.filename_to_id[fn]
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            detection_status = image['_detection_status']
-
-            if detection_status == DetectionStatus.DS_NEGATIVE:
-                gt_detections[i_detection] = 0.0
-            elif detection_status == DetectionStatus.DS_POSITIVE:
-                gt_detections[i_detection] = 1.0
-            else:
-                gt_detections[i_detection] = -1.0
+        # numpy array of bools (0.0/1.0), and -1 as null value
+        gt_detections = np.full(n_detections, -1.0)
+        gt_detections[gt_status == DetectionStatus.DS_NEGATIVE] = 0.0
+        gt_detections[gt_status == DetectionStatus.DS_POSITIVE] = 1.0
 
         # Don't include ambiguous/unknown ground truth in precision/recall analysis
         b_valid_ground_truth = gt_detections >= 0.0
@@ -649,6 +1079,10 @@ def process_batch_results(options: PostProcessingOptions
         print('At a confidence threshold of {:.1%}, precision={:.1%}, recall={:.1%}, f1={:.1%}'.format(
                 options.confidence_threshold, precision_at_confidence_threshold, recall_at_confidence_threshold, f1))
 
+        # Precision/recall/F1 over a grid of thresholds, overall and per category
+        threshold_sweep = compute_threshold_sweep(
+            p_detection, gt_status, gt_category, options.threshold_sweep_values)
+
         ##%% Collect classification results, if they exist
 
         classifier_accuracies = []
@@ -774,6 +1208,11 @@ def process_batch_results(options: PostProcessingOptions
         pr_table_filename = os.path.join(output_dir, 'prec_recall.csv')
         precisions_recalls.to_csv(pr_table_filename, index=False)
 
+        # Write threshold sweep table to .csv file in output directory
+        threshold_sweep_relative_filename = 'threshold_sweep.csv'
+        threshold_sweep.to_csv(os.path.join(output_dir, threshold_sweep_relative_filename),
+                               index=False)
+
         # Write precision/recall plot to .png file in output directory
         t = 'Precision-Recall curve: AP={:0.1%}, P@{:0.1%}={:0.1%}'.format(
             average_precision, target_recall, precision_at_target_recall)
@@ -800,101 +1239,40 @@ def process_batch_results(options: PostProcessingOptions
 
         image_count = len(images_to_visualize)
 
-        # Each element will be a list of 2-tuples, with elements [collection name,html info struct]
-        rendering_results = []
-
-        # Each element will be a three-tuple with elements file,max_conf,detections
+        # Each element will be a four-tuple with elements file,max_conf,detections,gt_info
         files_to_render = []
 
         # Assemble the information we need for rendering, so we can parallelize without
-        # dealing with Pandas
+        # dealing with Pandas.  Ground truth is looked up here, so rendering workers
+        # don't need the ground truth database.
         # i_row = 0; row = images_to_visualize.iloc[0]
         for _, row in images_to_visualize.iterrows():
 
             # Filenames should already have been normalized to either '/' or '\'
-            files_to_render.append([row['file'], row['max_detection_conf'], row['detections']])
-
-        def render_image_with_gt(file_info):
-
-            image_relative_path = file_info[0]
-            max_conf = file_info[1]
-            detections = file_info[2]
-
-            # This should already have been normalized to either '/' or '\'
+            image_relative_path = row['file']
 
+            gt_info = None
             image_id = ground_truth_indexed_db.filename_to_id.get(image_relative_path, None)
-            if image_id is None:
-                print('Warning: couldn''t find ground truth for image {}'.format(image_relative_path))
-                return None
-
-            image = ground_truth_indexed_db.image_id_to_image[image_id]
-            annotations = ground_truth_indexed_db.image_id_to_annotations[image_id]
-
-            gt_status = image['_detection_status']
-
-            gt_presence = bool(gt_status)
-
-            gt_classes = CameraTrapJsonUtils.annotations_to_classnames(
-                annotations, ground_truth_indexed_db.cat_id_to_name)
-            gt_class_summary = ','.join(gt_classes)
-
-            if gt_status > DetectionStatus.DS_MAX_DEFINITIVE_VALUE:
-                print(f'Skipping image {image_id}, does not have a definitive '
-                      f'ground truth status (status: {gt_status}, classes: {gt_class_summary})')
-                return None
-
-            detected = max_conf > options.confidence_threshold
-
-            if gt_presence and detected:
-                if '_classification_accuracy' not in image.keys():
-                    res = 'tp'
-                elif np.isclose(1, image['_classification_accuracy']):
-                    res = 'tpc'
-                else:
-                    res = 'tpi'
-            elif not gt_presence and detected:
-                res = 'fp'
-            elif gt_presence and not detected:
-                res = 'fn'
-            else:
-                res = 'tn'
-
-            display_name = '<b>Result type</b>: {}, <b>Presence</b>: {}, <b>Class</b>: {}, <b>Max conf</b>: {:0.3f}%, <b>Image</b>: {}'.format(
-                res.upper(), str(gt_presence), gt_class_summary,
-                max_conf * 100, image_relative_path)
-
-            rendered_image_html_info = render_bounding_boxes(
-                options.image_base_dir,
-                image_relative_path,
-                display_name,
-                detections,
-                res,
-                detection_categories,
-                classification_categories,
-                options)
-
-            image_result = None
-            if len(rendered_image_html_info) > 0:
-                image_result = [[res, rendered_image_html_info]]
-                for gt_class in gt_classes:
-                    image_result.append(['class_{}'.format(gt_class), rendered_image_html_info])
-
-            return image_result
-
-        # ...def render_image_with_gt(file_info)
+            if image_id is not None:
+                image = ground_truth_indexed_db.image_id_to_image[image_id]
+                annotations = ground_truth_indexed_db.image_id_to_annotations[image_id]
+                gt_classes = CameraTrapJsonUtils.annotations_to_classnames(
+                    annotations, ground_truth_indexed_db.cat_id_to_name)
+                gt_info = (image_id, image['_detection_status'], gt_classes,
+                           image.get('_classification_accuracy', None))
+
+            files_to_render.append((image_relative_path, row['max_detection_conf'],
+                                    row['detections'], gt_info))
+
+        rendering_args = {
+            'options': get_rendering_options(options),
+            'detection_categories': detection_categories,
+            'classification_categories': classification_categories
+        }
 
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_with_gt, files_to_render), total=len(files_to_render)))
-        else:
-            # file_info = files_to_render[0]
-            for file_info in tqdm(files_to_render):
-                rendering_results.append(render_image_with_gt(file_info))
+        rendering_results = render_images(render_image_with_gt, files_to_render,
+                                          rendering_args, options)
         elapsed = time.time() - start_time
 
         # Map all the rendering results in the list rendering_results into the
@@ -959,6 +1337,27 @@ def process_batch_results(options: PostProcessingOptions
                 len(detections_df), pr_figure_relative_filename
            )
 
+        # Threshold sweep for all positives; the .csv file also has each category.
+        # Precision etc. are NaN when undefined (e.g. no detections above a threshold).
+        def format_rate(x):
+            return 'n/a' if np.isnan(x) else '{:0.1%}'.format(x)
+
+        sweep_rows = ''
+        for _, row in threshold_sweep[threshold_sweep['category'] == 'all'].iterrows():
+            sweep_rows += '<tr><td>{:0.2f}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n'.format(
+                row['confidence_threshold'], format_rate(row['precision']),
+                format_rate(row['recall']), format_rate(row['f1']))
+        index_page += """
+            <h3>Threshold sweep</h3>
+            <div class="contentdiv">
+            <p>Precision/recall/F1 at each confidence threshold, for all categories
+            (<a href="{}">per-category results</a>)</p>
+            <table style="text-align:right;">
+            <tr><th>Threshold</th><th>Precision</th><th>Recall</th><th>F1</th></tr>
+            {}</table>
+            </div>
+            """.format(threshold_sweep_relative_filename, sweep_rows)
+
         if len(classifier_accuracies) > 0:
             index_page = index_page.replace('CLASSIFICATION_PLACEHOLDER_1',classification_detection_results)
             index_page = index_page.replace('CLASSIFICATION_PLACEHOLDER_2',"""<p><sup>*</sup>We do not evaluate the classification result of images
@@ -1056,9 +1455,6 @@ def process_batch_results(options: PostProcessingOptions
         image_count = len(images_to_visualize)
         has_classification_info = False
 
-        # Each element will be a list of 2-tuples, with elements [collection name,html info struct]
-        rendering_results = []
-
         # list of 3-tuples with elements (file, max_conf, detections)
         files_to_render = []
 
@@ -1068,111 +1464,20 @@ def process_batch_results(options: PostProcessingOptions
         for _, row in images_to_visualize.iterrows():
 
             # Filenames should already have been normalized to either '/' or '\'
-            files_to_render.append([row['file'],
+            files_to_render.append((row['file'],
                                     row['max_detection_conf'],
-                                    row['detections']])
-
-        # Get unique categories above the threshold for this image
-        def get_positive_categories(detections):
-            positive_categories = set()
-            for d in detections:
-                if d['conf'] >= options.confidence_threshold:
-                    positive_categories.add(d['category'])
-            return sorted(positive_categories)
-
-        # Local function for parallelization
-        def render_image_no_gt(file_info):
-
-            image_relative_path = file_info[0]
-            max_conf = file_info[1]
-            detections = file_info[2]
-
-            detection_status = DetectionStatus.DS_UNASSIGNED
-            if max_conf >= options.confidence_threshold:
-                detection_status = DetectionStatus.DS_POSITIVE
-            else:
-                if options.include_almost_detections:
-                    if max_conf >= options.almost_detection_confidence_threshold:
-                        detection_status = DetectionStatus.DS_ALMOST
-                    else:
-                        detection_status = DetectionStatus.DS_NEGATIVE
-                else:
-                    detection_status = DetectionStatus.DS_NEGATIVE
-
-            if detection_status == DetectionStatus.DS_POSITIVE:
-                if options.separate_detections_by_category:
-                    positive_categories = tuple(get_positive_categories(detections))
-                    res = detection_categories_to_results_name[positive_categories]
-                else:
-                    res = 'detections'
-
-            elif detection_status == DetectionStatus.DS_NEGATIVE:
-                res = 'non_detections'
-            else:
-                assert detection_status == DetectionStatus.DS_ALMOST
-                res = 'almost_detections'
-
-            display_name = '<b>Result type</b>: {}, <b>Image</b>: {}, <b>Max conf</b>: {:0.3f}'.format(
-                res, image_relative_path, max_conf)
-
-            rendering_options = copy.copy(options)
-            if detection_status == DetectionStatus.DS_ALMOST:
-                rendering_options.confidence_threshold = rendering_options.almost_detection_confidence_threshold
-            rendered_image_html_info = render_bounding_boxes(
-                options.image_base_dir,
-                image_relative_path,
-                display_name,
-                detections,
-                res,
-                detection_categories,
-                classification_categories,
-                rendering_options)
-
-            image_result = None
-
-            if len(rendered_image_html_info) > 0:
+                                    row['detections']))
 
-                image_result = [[res, rendered_image_html_info]]
-
-                for det in detections:
-
-                    if 'classifications' in det:
-
-                        # This is a list of [class,confidence] pairs, sorted by confidence
-                        classifications = det['classifications']
-                        top1_class_id = classifications[0][0]
-                        top1_class_name = classification_categories[top1_class_id]
-                        top1_class_score = classifications[0][1]
-
-                        # If we either don't have a confidence threshold, or we've met our
-                        # confidence threshold
-                        if (options.classification_confidence_threshold < 0) or \
-                            (top1_class_score >= options.classification_confidence_threshold):
-                            image_result.append(['class_{}'.format(top1_class_name),
-                                                 rendered_image_html_info])
-                        else:
-                            image_result.append(['class_unreliable',
-                                                 rendered_image_html_info])
-
-                    # ...if this detection has classification info
-
-                # ...for each detection
-
-            return image_result
-
-        # ...def render_image_no_gt(file_info):
+        rendering_args = {
+            'options': get_rendering_options(options),
+            'detection_categories': detection_categories,
+            'classification_categories': classification_categories,
+            'detection_categories_to_results_name': detection_categories_to_results_name
+        }
 
         start_time = time.time()
-        if options.parallelize_rendering:
-            if options.parallelize_rendering_n_cores is None:
-                pool = ThreadPool()
-            else:
-                print('Rendering images with {} workers'.format(options.parallelize_rendering_n_cores))
-                pool = ThreadPool(options.parallelize_rendering_n_cores)
-            rendering_results = list(tqdm(pool.imap(render_image_no_gt, files_to_render), total=len(files_to_render)))
-        else:
-            for file_info in tqdm(files_to_render):
-                rendering_results.append(render_image_no_gt(file_info))
+        rendering_results = render_images(render_image_no_gt, files_to_render,
+                                          rendering_args, options)
         elapsed = time.time() - start_time
 
         # Map all the rendering results in the list rendering_results into the
@@ -1349,6 +1654,21 @@ def main():
     parser.add_argument(
         '--random_output_sort', action='store_true',
         help='Sort output randomly (defaults to sorting by filename)')
+    parser.add_argument(
+        '--parallelize_rendering', action='store_true',
+        help='Render images in parallel')
+    parser.add_argument(
+        '--parallelize_rendering_n_cores', type=int,
+        default=options.parallelize_rendering_n_cores,
+        help='Number of workers to use for parallel rendering (default: 100 threads, '
+             'or one process per CPU with --parallelize_rendering_with_processes)')
+    parser.add_argument(
+        '--parallelize_rendering_with_processes', action='store_true',
+        help='Use processes rather than threads for parallel rendering')
+    parser.add_argument(
+        '--render_cache_dir', type=str, default=None,
+        help='Cache rendered images in this folder, and reuse them in later runs '
+             'when the image, detections and rendering options are unchanged')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -1356,6 +1676,7 @@ def main():
 
     args = parser.parse_args()
     args.sort_html_by_filename = not args.random_output_sort
+    args.parallelize_rendering_with_threads = not args.parallelize_rendering_with_processes
 
     args_to_object(args, options)
     process_batch_results(options)
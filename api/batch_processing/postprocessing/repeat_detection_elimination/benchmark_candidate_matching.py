@@ -0,0 +1,142 @@
+########
+#
+# benchmark_candidate_matching.py
+#
+# Times find_matches_in_directory() on a synthetic folder of detections, comparing
+# the scalar, vectorized, and grid-indexed ways of matching each new detection
+# against the candidate locations found so far.  Also checks that all three
+# produce the same candidate locations.
+#
+# The synthetic folder mimics a static camera: a set of fixed "repeat" boxes
+# (e.g. a branch the detector likes), each seen with a little jitter, plus
+# animals at random positions.
+#
+########
+
+#%% Constants and imports
+
+import argparse
+import random
+import time
+
+import pandas as pd
+
+from api.batch_processing.postprocessing.repeat_detection_elimination import repeat_detections_core
+
+
+#%% Functions
+
+def make_synthetic_directory(nDetections, nRepeatLocations=50, repeatFraction=0.5,
+                             jitter=0.002, nDetectionsPerImage=2, seed=0):
+    """
+    Creates a DataFrame in the format of the rows that find_matches_in_directory()
+    expects for one directory, with [nDetections] detections in total.
+    """
+    rng = random.Random(seed)
+
+    def random_box():
+        w = rng.uniform(0.02, 0.2)
+        h = rng.uniform(0.02, 0.2)
+        return [rng.uniform(0, 1 - w), rng.uniform(0, 1 - h), w, h]
+
+    repeatBoxes = [random_box() for _ in range(nRepeatLocations)]
+
+    rows = []
+    nImages = (nDetections + nDetectionsPerImage - 1) // nDetectionsPerImage
+    for iImage in range(nImages):
+        detections = []
+        for _ in range(nDetectionsPerImage):
+            if rng.random() < repeatFraction:
+                bbox = [v + rng.uniform(-jitter, jitter) for v in rng.choice(repeatBoxes)]
+            else:
+                bbox = random_box()
+            detections.append({'category': '1', 'conf': round(rng.uniform(0.8, 1.0), 3),
+                               'bbox': [round(v, 4) for v in bbox]})
+        rows.append({'file': 'camera/image{:0>7d}.jpg'.format(iImage),
+                     'max_detection_conf': max(d['conf'] for d in detections),
+                     'detections': detections})
+
+    return pd.DataFrame(rows)
+
+
+def time_matching(rowsByDirectory, dirName, bVectorizeComparisons, nCandidateGridCells):
+    """
+    Runs find_matches_in_directory() once with the given matching options, returns
+    (elapsed seconds, list of DetectionLocations).
+    """
+    options = repeat_detections_core.RepeatDetectionOptions()
+    options.bVectorizeComparisons = bVectorizeComparisons
+    options.nCandidateGridCells = nCandidateGridCells
+    options.pbar = None
+
+    startTime = time.time()
+    candidateDetections = repeat_detections_core.find_matches_in_directory(dirName, options, rowsByDirectory)
+    return time.time() - startTime, candidateDetections
+
+
+def summarize_candidates(candidateDetections):
+    return [(c.bbox, [(i.filename, i.iDetection) for i in c.instances]) for c in candidateDetections]
+
+
+def run_benchmark(detectionCounts, maxScalarDetections, nGridCells):
+
+    dirName = 'camera'
+
+    for nDetections in detectionCounts:
+
+        rowsByDirectory = {dirName: make_synthetic_directory(nDetections)}
+
+        configurations = [('vectorized', True, 0), ('grid ({} cells)'.format(nGridCells), True, nGridCells)]
+        if nDetections <= maxScalarDetections:
+            configurations.insert(0, ('scalar', False, 0))
+
+        referenceCandidates = None
+
+        for name, bVectorizeComparisons, nCandidateGridCells in configurations:
+
+            elapsed, candidateDetections = time_matching(rowsByDirectory, dirName,
+                                                         bVectorizeComparisons, nCandidateGridCells)
+            print('{} detections, {}: {:.2f} seconds, {} candidate locations'.format(
+                nDetections, name, elapsed, len(candidateDetections)))
+
+            summary = summarize_candidates(candidateDetections)
+            if referenceCandidates is None:
+                referenceCandidates = summary
+            else:
+                assert summary == referenceCandidates, 'Matching configurations disagree'
+
+        # ...for each configuration
+
+    # ...for each folder size
+
+
+#%% Interactive driver
+
+if False:
+
+    #%%
+
+    run_benchmark([1000, 10000, 100000], maxScalarDetections=10000, nGridCells=100)
+
+
+#%% Command-line driver
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark candidate matching in repeat detection elimination on synthetic data')
+    parser.add_argument('--detectionCounts', action='store', nargs='+', type=int,
+                        default=[1000, 10000, 100000],
+                        help='Numbers of detections in the synthetic folder, separated by spaces')
+    parser.add_argument('--maxScalarDetections', action='store', type=int, default=10000,
+                        help='Skip the (slow) scalar comparison for folders larger than this')
+    parser.add_argument('--nGridCells', action='store', type=int, default=100,
+                        help='Grid cells per side for the grid-indexed comparison')
+
+    args = parser.parse_args()
+
+    run_benchmark(args.detectionCounts, args.maxScalarDetections, args.nGridCells)
+
+
+if __name__ == '__main__':
+    main()
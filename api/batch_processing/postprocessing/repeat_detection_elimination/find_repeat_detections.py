@@ -98,6 +98,11 @@ def main():
     parser.add_argument('--filterFileToLoad', action='store', type=str, default='',  # checks for string length so default needs to be the empty string
                         help='Path to detectionIndex.json, which should be inside a folder of images that are manually verified to _not_ contain valid animals')
 
+    parser.add_argument('--candidateStateFileToLoad', action='store', type=str, default='',
+                        help='Path to a .npz file written via --candidateStateFileToWrite; only images not searched in that run will be searched')
+    parser.add_argument('--candidateStateFileToWrite', action='store', type=str, default='',
+                        help='Path to a .npz file to save candidate locations to, for later incremental runs')
+
     parser.add_argument('--confidenceMax', action='store', type=float,
                         default=defaultOptions.confidenceMax,
                         help='Detection confidence threshold; don\'t process anything above this')
@@ -135,6 +140,15 @@ def main():
                         dest='bParallelizeComparisons')
     parser.add_argument('--forceSerialRendering', action='store_false',
                         dest='bParallelizeRendering')
+    parser.add_argument('--forceScalarComparisons', action='store_false',
+                        dest='bVectorizeComparisons',
+                        help='Compare detections one pair at a time rather than with vectorized IOU computation')
+    parser.add_argument('--nCandidateGridCells', action='store', type=int,
+                        default=defaultOptions.nCandidateGridCells,
+                        help='If > 0, index candidate boxes on a grid with this many cells per side, and only compare detections with nearby boxes')
+    parser.add_argument('--useDetectionTable', action='store_true',
+                        dest='bUseDetectionTable',
+                        help='Find matches in worker processes that memory-map a columnar detection table')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
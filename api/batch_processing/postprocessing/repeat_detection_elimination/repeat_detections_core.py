@@ -8,12 +8,16 @@
 
 # %% Imports and environment
 
+import json
 import os
+import shutil
+import tempfile
 import warnings
 from datetime import datetime
 from itertools import compress
 
 import jsonpickle
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
@@ -90,6 +94,17 @@ class RepeatDetectionOptions:
     # produced in the first pass
     filterFileToLoad = ''
 
+    # .npz file written by a previous run via candidateStateFileToWrite; if specified,
+    # candidate locations are loaded from this file, and only images that weren't
+    # searched in that run are compared against them.  This supports incremental runs
+    # on a results file that only adds images to the one used in the previous run; new
+    # images are matched as if they came after all the previously-searched images.
+    candidateStateFileToLoad = ''
+
+    # If specified, write the candidate locations found in each directory (and the list of
+    # images that were searched) to this .npz file, for use as candidateStateFileToLoad
+    candidateStateFileToWrite = ''
+
     # (optional) List of filenames remaining after deletion of identified 
     # repeated detections that are actually animals.  This should be a flat
     # text file, one relative filename per line.  See enumerate_images().
@@ -105,6 +120,24 @@ class RepeatDetectionOptions:
     debugMaxRenderInstance = -1
     bParallelizeComparisons = True
     bParallelizeRendering = True
+
+    # Compare each new detection against all candidate locations in a directory with one
+    # vectorized IOU computation, rather than one ct_utils.get_iou() call per candidate.
+    # Produces the same matches either way.
+    bVectorizeComparisons = True
+
+    # If > 0 (and bVectorizeComparisons is True), index candidate locations by the upper-left
+    # corner of their boxes on a uniform grid with this many cells per side, and only
+    # compare a new detection against candidates whose corners are close enough for the
+    # IOU to reach iouThreshold.  This produces the same matches, and makes the number of
+    # comparisons per detection roughly independent of the number of candidates.
+    nCandidateGridCells = 0
+
+    # Pack the eligible detections into columnar numpy arrays saved as memory-mapped .npy
+    # files, and find matches in worker processes that receive only directory indices,
+    # rather than pickling data frames to each worker.  Always uses vectorized comparisons.
+    # Uses nWorkers processes if bParallelizeComparisons is True.
+    bUseDetectionTable = False
     
     # Determines whether bounding-box rendering errors (typically network errors) should
     # be treated as failures    
@@ -205,6 +238,136 @@ class DetectionLocation:
         return detection
 
 
+class CandidateBoxArray:
+    """
+    The boxes of the DetectionLocations found so far in one directory, stored in growing
+    numpy arrays so that a new box can be compared against all of them at once.
+
+    If nGridCells > 0, candidates are also indexed by the upper-left corner of their boxes
+    on a uniform grid of nGridCells x nGridCells cells over the (relative) image.  If two
+    boxes a and b have IOU >= t > 0, each side of one is at least t times the corresponding
+    side of the other, and their x_min values differ by at most (1-t) * max(w_a, w_b), so
+    by at most (1-t)/t * w_a (likewise for y_min and height).  A new box is only compared
+    against candidates whose corners fall in the grid cells within that distance.
+    """
+
+    def __init__(self, initialCapacity=256, nGridCells=0):
+        # [x_min, y_min, x_max, y_max] for each candidate
+        self.boxes = np.zeros((initialCapacity, 4))
+        self.areas = np.zeros(initialCapacity)
+        # False for malformed boxes, which ct_utils.get_iou() refuses to compare
+        self.isValid = np.zeros(initialCapacity, dtype=bool)
+        self.nBoxes = 0
+
+        # Maps (column, row) grid cells to lists of candidate indices
+        self.nGridCells = nGridCells
+        self.grid = {}
+
+    def __len__(self):
+        return self.nBoxes
+
+    def add(self, bbox):
+        """
+        Appends a box in [x_min, y_min, width_of_box, height_of_box] format; its index
+        matches the index of the corresponding DetectionLocation.
+        """
+        if self.nBoxes == len(self.areas):
+            capacity = 2 * len(self.areas)
+            self.boxes = np.resize(self.boxes, (capacity, 4))
+            self.areas = np.resize(self.areas, capacity)
+            self.isValid = np.resize(self.isValid, capacity)
+
+        xyxy = ct_utils.convert_xywh_to_xyxy(bbox)
+        self.boxes[self.nBoxes] = xyxy
+        self.areas[self.nBoxes] = (xyxy[2] - xyxy[0]) * (xyxy[3] - xyxy[1])
+        self.isValid[self.nBoxes] = (xyxy[0] < xyxy[2]) and (xyxy[1] < xyxy[3])
+
+        # Malformed boxes never match, so they don't need to be findable
+        if self.nGridCells > 0 and self.isValid[self.nBoxes]:
+            cell = (self._to_cell(xyxy[0]), self._to_cell(xyxy[1]))
+            self.grid.setdefault(cell, []).append(self.nBoxes)
+
+        self.nBoxes += 1
+
+    def _to_cell(self, v):
+        """
+        Maps a relative coordinate to a grid column or row; coordinates outside [0,1]
+        are clamped to the edge cells.
+        """
+        return min(max(int(v * self.nGridCells), 0), self.nGridCells - 1)
+
+    def _get_nearby_candidates(self, bbox, iouThreshold):
+        """
+        Returns the sorted indices of the candidates whose upper-left corners are close
+        enough to that of [bbox] that their IOU could reach [iouThreshold].
+        """
+        # Slightly widened, so floating-point error can't exclude a match
+        maxCornerDistanceFactor = (1.0 - iouThreshold) / iouThreshold + 1e-6
+        dx = maxCornerDistanceFactor * bbox[2]
+        dy = maxCornerDistanceFactor * bbox[3]
+
+        iCandidates = []
+        for column in range(self._to_cell(bbox[0] - dx), self._to_cell(bbox[0] + dx) + 1):
+            for row in range(self._to_cell(bbox[1] - dy), self._to_cell(bbox[1] + dy) + 1):
+                iCandidates.extend(self.grid.get((column, row), []))
+
+        # Each candidate is in exactly one cell, so there are no duplicates
+        iCandidates.sort()
+        return np.array(iCandidates, dtype=int)
+
+    def get_ious(self, bbox, iCandidates=None):
+        """
+        Computes the IOU of [bbox] with each candidate box (or with the candidates in
+        [iCandidates]), using the same arithmetic as ct_utils.get_iou(), so results are
+        identical.  IOUs with malformed candidate boxes are returned as NaN.
+        """
+        x1, y1, x2, y2 = ct_utils.convert_xywh_to_xyxy(bbox)
+
+        if iCandidates is None:
+            iCandidates = slice(0, self.nBoxes)
+        boxes = self.boxes[iCandidates]
+        areas = self.areas[iCandidates]
+
+        xLeft = np.maximum(x1, boxes[:, 0])
+        yTop = np.maximum(y1, boxes[:, 1])
+        xRight = np.minimum(x2, boxes[:, 2])
+        yBottom = np.minimum(y2, boxes[:, 3])
+
+        intersectionArea = (xRight - xLeft) * (yBottom - yTop)
+        bboxArea = (x2 - x1) * (y2 - y1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ious = intersectionArea / (bboxArea + areas - intersectionArea)
+
+        ious[(xRight < xLeft) | (yBottom < yTop)] = 0.0
+        ious[~self.isValid[iCandidates]] = np.nan
+        return ious
+
+    def find_matches(self, bbox, iouThreshold):
+        """
+        Returns the indices of all candidates whose IOU with [bbox] is at least
+        [iouThreshold], in increasing order.
+        """
+        x1, y1, x2, y2 = ct_utils.convert_xywh_to_xyxy(bbox)
+        if self.nBoxes == 0 or not (x1 < x2 and y1 < y2):
+            # ct_utils.get_iou() fails on malformed boxes, which are never matched
+            return np.zeros(0, dtype=int)
+
+        # With a non-positive threshold, even boxes that don't overlap match, so
+        # we can't use the grid
+        if self.nGridCells > 0 and iouThreshold > 0:
+            iCandidates = self._get_nearby_candidates(bbox, iouThreshold)
+            if len(iCandidates) == 0:
+                return iCandidates
+            ious = self.get_ious(bbox, iCandidates)
+            with np.errstate(invalid='ignore'):
+                return iCandidates[ious >= iouThreshold]
+
+        ious = self.get_ious(bbox)
+        with np.errstate(invalid='ignore'):
+            return np.nonzero(ious >= iouThreshold)[0]
+
+
 ##%% Helper functions
 
 def enumerate_images(dirName,outputFileName=None):
@@ -235,27 +398,20 @@ def render_bounding_box(detection, inputFileName, outputFileName, lineWidth=5, e
     im.save(outputFileName)
 
 
-##%% Look for matches (one directory) (function)
-
-def find_matches_in_directory(dirName, options, rowsByDirectory):
-        
-    if options.pbar is not None:
-        options.pbar.update()
-
-    # List of DetectionLocations
-    candidateDetections = []
-
-    rows = rowsByDirectory[dirName]
-
-    # iDirectoryRow = 0; row = rows.iloc[iDirectoryRow]
-    for iDirectoryRow, row in rows.iterrows():
+def enumerate_eligible_detections(rows, options):
+    """
+    Yields (iDetection, filename, detection) for each detection in [rows] (a DataFrame
+    with the columns of the API output table) that could be considered suspicious:
+    above confidenceMin, at most confidenceMax, not in excludeClasses, and not larger
+    than maxSuspiciousDetectionSize.  Detections are yielded in the order they appear.
+    """
+    for filename, maxP, detections in zip(rows['file'], rows['max_detection_conf'], rows['detections']):
 
-        filename = row['file']
         if not ct_utils.is_image_file(filename):
             continue
 
         # Don't bother checking images with no detections above threshold
-        maxP = float(row['max_detection_conf'])
+        maxP = float(maxP)
         if maxP < options.confidenceMin:
             continue
 
@@ -266,7 +422,6 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
         #   'bbox': [x_min, y_min, width_of_box, height_of_box]  # (x_min, y_min) is upper-left,
         #                                                           all in relative coordinates and length
         # }
-        detections = row['detections']
         assert len(detections) > 0
 
         # For each detection in this image
@@ -293,7 +448,6 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                     continue
 
             bbox = detection['bbox']
-            confidence = detection['conf']
             
             # Is this detection too big to be suspicious?
             w, h = bbox[2], bbox[3]
@@ -311,13 +465,62 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                 # print('Ignoring very large detection with area {}'.format(area))
                 continue
 
-            category = detection['category']
-            
-            instance = IndexedDetection(iDetection=iDetection,
-                                        filename=row['file'], bbox=bbox, 
-                                        confidence=confidence, category=category)
+            yield iDetection, filename, detection
+
+        # ...for each detection
+
+    # ...for each row
+
+
+##%% Look for matches (one directory) (function)
 
-            bFoundSimilarDetection = False
+def find_matches_in_directory(dirName, options, rowsByDirectory, candidateDetections=None):
+    """
+    Finds candidate locations (DetectionLocations) among the detections in
+    rowsByDirectory[dirName].  If [candidateDetections] is supplied (e.g. from a previous
+    run), new detections are matched against those locations first; the list is
+    extended in place.
+    """
+        
+    if options.pbar is not None:
+        options.pbar.update()
+
+    # List of DetectionLocations
+    if candidateDetections is None:
+        candidateDetections = []
+
+    # The bboxes of candidateDetections, if we're comparing in a vectorized way
+    candidateBoxes = None
+    if options.bVectorizeComparisons:
+        candidateBoxes = CandidateBoxArray(nGridCells=options.nCandidateGridCells)
+        for candidate in candidateDetections:
+            candidateBoxes.add(candidate.bbox)
+
+    rows = rowsByDirectory[dirName]
+
+    # For each detection that could be suspicious, in the order they appear in [rows]
+    for iDetection, filename, detection in enumerate_eligible_detections(rows, options):
+
+        bbox = detection['bbox']
+        confidence = detection['conf']
+        category = detection['category']
+        
+        instance = IndexedDetection(iDetection=iDetection,
+                                    filename=filename, bbox=bbox, 
+                                    confidence=confidence, category=category)
+
+        bFoundSimilarDetection = False
+
+        if candidateBoxes is not None:
+
+            iMatchingCandidates = candidateBoxes.find_matches(bbox, options.iouThreshold)
+
+            # As below, this instance may match multiple candidates
+            for iCandidate in iMatchingCandidates:
+                candidateDetections[iCandidate].instances.append(instance)
+            bFoundSimilarDetection = (len(iMatchingCandidates) > 0)
+
+        else:
 
             # For each detection in our candidate list
             for iCandidate, candidate in enumerate(candidateDetections):
@@ -333,7 +536,7 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
                     continue
 
                 if iou >= options.iouThreshold:
-                    
+                
                     bFoundSimilarDetection = True
 
                     # If so, add this example to the list for this detection
@@ -345,20 +548,310 @@ def find_matches_in_directory(dirName, options, rowsByDirectory):
 
             # ...for each detection on our candidate list
 
-            # If we found no matches, add this to the candidate list
-            if not bFoundSimilarDetection:
-                candidate = DetectionLocation(instance, detection, dirName)
-                candidateDetections.append(candidate)
-
-        # ...for each detection
+        # If we found no matches, add this to the candidate list
+        if not bFoundSimilarDetection:
+            candidate = DetectionLocation(instance, detection, dirName)
+            candidateDetections.append(candidate)
+            if candidateBoxes is not None:
+                candidateBoxes.add(bbox)
 
-    # ...for each row
+    # ...for each eligible detection
 
     return candidateDetections
 
 # ...def find_matches_in_directory(dirName)
 
-    
+
+##%% Look for matches using a columnar detection table (functions)
+
+# Column names in the detection table, and their dtypes; see build_detection_table()
+DETECTION_TABLE_COLUMNS = {
+    'fileIndex': np.int32,
+    'iDetection': np.int32,
+    'bbox': np.float64,
+    'conf': np.float32,
+    'category': np.int16,
+    'dirOffsets': np.int64
+}
+
+# Memory-mapped detection tables already loaded in this (worker) process, keyed by folder
+loadedDetectionTables = {}
+
+
+def build_detection_table(dirsToSearch, rowsByDirectory, options):
+    """
+    Packs the detections that could be suspicious (see enumerate_eligible_detections())
+    into columnar numpy arrays, with the detections in each directory stored contiguously.
+
+    Returns:
+        table: dict mapping the column names in DETECTION_TABLE_COLUMNS to arrays:
+            fileIndex: index into [filenames] of the image containing each detection
+            iDetection: index of each detection within its image
+            bbox: n x 4, [x_min, y_min, width_of_box, height_of_box]
+            conf, category: confidence and (integer) category of each detection
+            dirOffsets: length nDirs + 1; the detections for dirsToSearch[i] are
+                rows dirOffsets[i] to dirOffsets[i+1]
+        filenames: list of image filenames
+        tableDetections: list of detection dicts, one per row of the table
+    """
+    fileIndices = []
+    iDetections = []
+    tableDetections = []
+    dirOffsets = [0]
+    filenames = []
+    filenameToIndex = {}
+
+    for dirName in dirsToSearch:
+        for iDetection, filename, detection in enumerate_eligible_detections(rowsByDirectory[dirName], options):
+            if filename not in filenameToIndex:
+                filenameToIndex[filename] = len(filenames)
+                filenames.append(filename)
+            fileIndices.append(filenameToIndex[filename])
+            iDetections.append(iDetection)
+            tableDetections.append(detection)
+        dirOffsets.append(len(tableDetections))
+
+    table = {
+        'fileIndex': np.array(fileIndices, dtype=DETECTION_TABLE_COLUMNS['fileIndex']),
+        'iDetection': np.array(iDetections, dtype=DETECTION_TABLE_COLUMNS['iDetection']),
+        'bbox': np.array([d['bbox'] for d in tableDetections],
+                         dtype=DETECTION_TABLE_COLUMNS['bbox']).reshape(-1, 4),
+        'conf': np.array([d['conf'] for d in tableDetections], dtype=DETECTION_TABLE_COLUMNS['conf']),
+        'category': np.array([int(d['category']) for d in tableDetections],
+                             dtype=DETECTION_TABLE_COLUMNS['category']),
+        'dirOffsets': np.array(dirOffsets, dtype=DETECTION_TABLE_COLUMNS['dirOffsets'])
+    }
+
+    return table, filenames, tableDetections
+
+
+def save_detection_table(table, tableDir):
+    """
+    Writes each column of [table] to [tableDir]/[column].npy
+    """
+    os.makedirs(tableDir, exist_ok=True)
+    for columnName in DETECTION_TABLE_COLUMNS:
+        np.save(os.path.join(tableDir, columnName + '.npy'), table[columnName])
+
+
+def load_detection_table(tableDir):
+    """
+    Memory-maps the columns written by save_detection_table(); each process maps a
+    given table only once.
+    """
+    if tableDir not in loadedDetectionTables:
+        loadedDetectionTables[tableDir] = {
+            columnName: np.load(os.path.join(tableDir, columnName + '.npy'), mmap_mode='r')
+            for columnName in DETECTION_TABLE_COLUMNS}
+    return loadedDetectionTables[tableDir]
+
+
+def find_matches_in_table(iDir, tableDir, iouThreshold, nCandidateGridCells=0):
+    """
+    Finds candidate locations among the detections in directory [iDir] of the detection
+    table saved in [tableDir]; equivalent to find_matches_in_directory().
+
+    Returns a list with one element per candidate location, each a list of the table
+    rows of its instances, starting with the row that created the candidate.
+    """
+    table = load_detection_table(tableDir)
+    iStart, iEnd = int(table['dirOffsets'][iDir]), int(table['dirOffsets'][iDir + 1])
+
+    # Python floats, so comparisons match those on the original boxes exactly
+    bboxes = table['bbox'][iStart:iEnd].tolist()
+
+    candidateBoxes = CandidateBoxArray(nGridCells=nCandidateGridCells)
+    candidateRows = []
+
+    for iRow, bbox in enumerate(bboxes, start=iStart):
+        iMatchingCandidates = candidateBoxes.find_matches(bbox, iouThreshold)
+        for iCandidate in iMatchingCandidates:
+            candidateRows[iCandidate].append(iRow)
+        if len(iMatchingCandidates) == 0:
+            candidateRows.append([iRow])
+            candidateBoxes.add(bbox)
+
+    return candidateRows
+
+
+def table_matches_to_detection_locations(candidateRows, dirName, table, filenames, tableDetections):
+    """
+    Converts the output of find_matches_in_table() to a list of DetectionLocations,
+    as returned by find_matches_in_directory().
+    """
+    candidateDetections = []
+    for rows in candidateRows:
+        candidate = None
+        for iRow in rows:
+            detection = tableDetections[iRow]
+            instance = IndexedDetection(iDetection=int(table['iDetection'][iRow]),
+                                        filename=filenames[table['fileIndex'][iRow]],
+                                        bbox=detection['bbox'], confidence=detection['conf'],
+                                        category=detection['category'])
+            if candidate is None:
+                candidate = DetectionLocation(instance, detection, dirName)
+            else:
+                candidate.instances.append(instance)
+        candidateDetections.append(candidate)
+    return candidateDetections
+
+
+def find_matches_with_detection_table(dirsToSearch, rowsByDirectory, options):
+    """
+    Finds candidate locations in each directory in [dirsToSearch] via a detection table
+    (see build_detection_table()) that worker processes memory-map, so each worker
+    only receives a directory index.
+
+    Returns a list with one list of DetectionLocations per directory.
+    """
+    print('Building detection table...')
+    table, filenames, tableDetections = build_detection_table(dirsToSearch, rowsByDirectory, options)
+    print('Packed {} eligible detections from {} images'.format(len(tableDetections), len(filenames)))
+
+    tableDir = tempfile.mkdtemp(prefix='detection_table_')
+
+    try:
+
+        save_detection_table(table, tableDir)
+
+        if options.bParallelizeComparisons:
+            allCandidateRows = Parallel(n_jobs=options.nWorkers, prefer='processes')(
+                delayed(find_matches_in_table)(iDir, tableDir, options.iouThreshold, options.nCandidateGridCells)
+                for iDir in tqdm(range(len(dirsToSearch))))
+        else:
+            allCandidateRows = [find_matches_in_table(iDir, tableDir, options.iouThreshold,
+                                                      options.nCandidateGridCells)
+                                for iDir in tqdm(range(len(dirsToSearch)))]
+
+    finally:
+
+        # Release our own memory maps before deleting the files
+        loadedDetectionTables.pop(tableDir, None)
+        shutil.rmtree(tableDir, ignore_errors=True)
+
+    return [table_matches_to_detection_locations(candidateRows, dirName, table, filenames, tableDetections)
+            for candidateRows, dirName in zip(allCandidateRows, dirsToSearch)]
+
+
+##%% Save and load candidate locations for incremental runs (functions)
+
+# Options that determine which detections are candidates and how they match; a
+# candidate state file can only be loaded with the same values
+CANDIDATE_STATE_OPTIONS = ['confidenceMin', 'confidenceMax', 'iouThreshold', 'maxSuspiciousDetectionSize',
+                           'excludeClasses', 'nDirLevelsFromLeaf']
+
+
+def save_candidate_state(stateFilename, dirNames, allCandidateDetections, searchedFilenames, options):
+    """
+    Writes the candidate locations for each directory in [dirNames] (a list of
+    lists of DetectionLocations, parallel to [dirNames]) and the list of images that were
+    searched to a compressed .npz file of columnar arrays:
+
+    dirNames, filenames: strings
+    candidateDir, candidateBbox: the directory index and bbox of each candidate
+    instanceCandidate, instanceFileIndex, instanceIDetection, instanceBbox,
+        instanceConf, instanceCategory: one row per IndexedDetection, in order
+    searchedFileIndices: indices into filenames of all searched images
+    options: json string with the values of CANDIDATE_STATE_OPTIONS
+    """
+    filenames = []
+    filenameToIndex = {}
+
+    def get_file_index(filename):
+        if filename not in filenameToIndex:
+            filenameToIndex[filename] = len(filenames)
+            filenames.append(filename)
+        return filenameToIndex[filename]
+
+    candidateDirs = []
+    candidateBboxes = []
+    instanceColumns = {'instanceCandidate': [], 'instanceFileIndex': [], 'instanceIDetection': [],
+                       'instanceBbox': [], 'instanceConf': [], 'instanceCategory': []}
+
+    for iDir, candidateDetections in enumerate(allCandidateDetections):
+        for candidate in candidateDetections:
+            iCandidate = len(candidateBboxes)
+            candidateDirs.append(iDir)
+            candidateBboxes.append(candidate.bbox)
+            for instance in candidate.instances:
+                instanceColumns['instanceCandidate'].append(iCandidate)
+                instanceColumns['instanceFileIndex'].append(get_file_index(instance.filename))
+                instanceColumns['instanceIDetection'].append(instance.iDetection)
+                instanceColumns['instanceBbox'].append(instance.bbox)
+                instanceColumns['instanceConf'].append(instance.confidence)
+                instanceColumns['instanceCategory'].append(instance.category)
+
+    searchedFileIndices = [get_file_index(filename) for filename in searchedFilenames]
+
+    stateOptions = {optionName: getattr(options, optionName) for optionName in CANDIDATE_STATE_OPTIONS}
+
+    np.savez_compressed(
+        stateFilename,
+        dirNames=np.array(dirNames, dtype=str),
+        filenames=np.array(filenames, dtype=str),
+        candidateDir=np.array(candidateDirs, dtype=np.int32),
+        candidateBbox=np.array(candidateBboxes, dtype=np.float64).reshape(-1, 4),
+        instanceCandidate=np.array(instanceColumns['instanceCandidate'], dtype=np.int32),
+        instanceFileIndex=np.array(instanceColumns['instanceFileIndex'], dtype=np.int32),
+        instanceIDetection=np.array(instanceColumns['instanceIDetection'], dtype=np.int32),
+        instanceBbox=np.array(instanceColumns['instanceBbox'], dtype=np.float64).reshape(-1, 4),
+        instanceConf=np.array(instanceColumns['instanceConf'], dtype=np.float64),
+        instanceCategory=np.array(instanceColumns['instanceCategory'], dtype=str),
+        searchedFileIndices=np.array(searchedFileIndices, dtype=np.int32),
+        options=np.array(json.dumps(stateOptions)))
+
+    print('Wrote {} candidate locations ({} instances) for {} searched images to {}'.format(
+        len(candidateBboxes), len(instanceColumns['instanceCandidate']), len(searchedFileIndices),
+        stateFilename))
+
+
+def load_candidate_state(stateFilename, options):
+    """
+    Loads a file written by save_candidate_state().
+
+    Returns:
+        candidatesByDirectory: dict mapping directory names to lists of DetectionLocations
+        searchedFilenames: set of images that were searched in the run that wrote the file
+    """
+    with np.load(stateFilename, allow_pickle=False) as state:
+        state = dict(state)
+
+    stateOptions = json.loads(state['options'].item())
+    for optionName in CANDIDATE_STATE_OPTIONS:
+        assert stateOptions[optionName] == getattr(options, optionName), \
+            'Option {} ({}) does not match the value used to write {} ({})'.format(
+                optionName, getattr(options, optionName), stateFilename, stateOptions[optionName])
+
+    dirNames = state['dirNames'].tolist()
+    filenames = state['filenames'].tolist()
+    candidateBboxes = state['candidateBbox'].tolist()
+    candidateDirs = state['candidateDir'].tolist()
+    instanceBboxes = state['instanceBbox'].tolist()
+    instanceConfs = state['instanceConf'].tolist()
+
+    candidates = [None] * len(candidateBboxes)
+
+    for iInstance, iCandidate in enumerate(state['instanceCandidate'].tolist()):
+        instance = IndexedDetection(iDetection=int(state['instanceIDetection'][iInstance]),
+                                    filename=filenames[state['instanceFileIndex'][iInstance]],
+                                    bbox=instanceBboxes[iInstance],
+                                    confidence=instanceConfs[iInstance],
+                                    category=str(state['instanceCategory'][iInstance]))
+        if candidates[iCandidate] is None:
+            candidates[iCandidate] = DetectionLocation(instance, {'bbox': candidateBboxes[iCandidate]},
+                                                       dirNames[candidateDirs[iCandidate]])
+        else:
+            candidates[iCandidate].instances.append(instance)
+
+    candidatesByDirectory = {dirName: [] for dirName in dirNames}
+    for candidate in candidates:
+        candidatesByDirectory[candidate.relativeDir].append(candidate)
+
+    searchedFilenames = set(filenames[i] for i in state['searchedFileIndices'].tolist())
+
+    return candidatesByDirectory, searchedFilenames
+
+
 ##%% Render problematic locations to html (function)
 
 def render_images_for_directory(iDir, directoryHtmlFiles, suspiciousDetections, options):
@@ -713,21 +1206,60 @@ def find_repeat_detections(inputFilename, outputFilename=None, options=None):
 
         allCandidateDetections = [None] * len(dirsToSearch)
 
-        if not options.bParallelizeComparisons:
+        # Are we continuing from the candidate locations found in a previous run?
+        #
+        # If so, only search the images that weren't searched in that run.
+        previousCandidateDetections = {}
+        rowsToSearchByDirectory = rowsByDirectory
+        if len(options.candidateStateFileToLoad) > 0:
+
+            assert not options.bUseDetectionTable, \
+                'Loading a candidate state file is not supported with bUseDetectionTable'
+
+            print('Loading candidate locations from {}'.format(options.candidateStateFileToLoad))
+            previousCandidateDetections, searchedFilenames = load_candidate_state(
+                options.candidateStateFileToLoad, options)
+
+            rowsToSearchByDirectory = {}
+            nImagesToSearch = 0
+            for dirName in dirsToSearch:
+                rows = rowsByDirectory[dirName]
+                rows = rows[~rows['file'].isin(searchedFilenames)]
+                rowsToSearchByDirectory[dirName] = rows
+                nImagesToSearch += len(rows)
+
+            print('Loaded {} candidate locations, searching {} new images'.format(
+                sum([len(x) for x in previousCandidateDetections.values()]), nImagesToSearch))
+
+        if options.bUseDetectionTable:
+
+            options.pbar = None
+            allCandidateDetections = find_matches_with_detection_table(dirsToSearch, rowsByDirectory, options)
+
+        elif not options.bParallelizeComparisons:
 
             options.pbar = None
             # iDir = 0; dirName = dirsToSearch[iDir]
             for iDir, dirName in enumerate(tqdm(dirsToSearch)):
-                allCandidateDetections[iDir] = find_matches_in_directory(dirName, options, rowsByDirectory)
+                allCandidateDetections[iDir] = find_matches_in_directory(
+                    dirName, options, rowsToSearchByDirectory, previousCandidateDetections.get(dirName))
 
         else:
 
             options.pbar = tqdm(total=len(dirsToSearch))
             allCandidateDetections = Parallel(n_jobs=options.nWorkers, prefer='threads')(
-                delayed(find_matches_in_directory)(dirName, options, rowsByDirectory) for dirName in tqdm(dirsToSearch))
+                delayed(find_matches_in_directory)(dirName, options, rowsToSearchByDirectory,
+                                                   previousCandidateDetections.get(dirName))
+                for dirName in tqdm(dirsToSearch))
 
         print('\nFinished looking for similar bounding boxes')
 
+        if len(options.candidateStateFileToWrite) > 0:
+            searchedFilenames = [filename for dirName in dirsToSearch
+                                 for filename in rowsByDirectory[dirName]['file']]
+            save_candidate_state(options.candidateStateFileToWrite, dirsToSearch, allCandidateDetections,
+                                 searchedFilenames, options)
+
         ##%% Find suspicious locations based on match results
 
         print('Filtering out repeat detections...')
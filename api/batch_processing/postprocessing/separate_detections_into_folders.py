@@ -47,8 +47,10 @@ import itertools
 from multiprocessing.pool import ThreadPool
 from functools import partial
         
+import numpy as np
 from tqdm import tqdm
 
+from api.batch_processing.postprocessing.load_api_results import ApiResultsReader, ColumnarApiResults
 from ct_utils import args_to_object
 
 friendly_folder_names = {'animal':'animals','person':'people','vehicle':'vehicles'}
@@ -58,6 +60,10 @@ friendly_folder_names = {'animal':'animals','person':'people','vehicle':'vehicle
 # confidence, we just ignore them.
 invalid_category_epsilon = 0.00001
 
+# When using multiple threads, image entries are read and processed this many per
+# thread at a time, so only one chunk of the results file is in memory
+images_per_thread_per_chunk = 100
+
 
 #%% Options class
 
@@ -124,31 +130,42 @@ def process_detection(d,options):
     categories_above_threshold = []
     for category_name in category_names:
         
-        threshold = default_threshold
-        
-        # Do we have a custom threshold for this category?
-        if category_name in options.category_name_to_threshold:
-            threshold = options.category_name_to_threshold[category_name]
+        threshold = get_threshold(category_name,options)
             
         max_confidence_this_category = category_name_to_max_confidence[category_name]
         if max_confidence_this_category > threshold:
             categories_above_threshold.append(category_name)
     
-    target_folder = ''
+    target_folder = get_target_folder(categories_above_threshold,options)
+    copy_to_target_folder(relative_filename,target_folder,options)
+    
+# ...def process_detection()
+
+
+def get_threshold(category_name,options):
+    
+    if category_name in options.category_name_to_threshold:
+        return options.category_name_to_threshold[category_name]
+    return default_threshold
+
+
+def get_target_folder(categories_above_threshold,options):
     
-    categories_above_threshold.sort()
+    categories_above_threshold = sorted(categories_above_threshold)
     
     # If this is above multiple thresholds
     if len(categories_above_threshold) > 1:
-        target_folder = options.category_name_to_folder['_'.join(categories_above_threshold)]
+        return options.category_name_to_folder['_'.join(categories_above_threshold)]
 
     elif len(categories_above_threshold) == 0:
-        target_folder = options.category_name_to_folder['empty']
+        return options.category_name_to_folder['empty']
         
     else:
-        target_folder = options.category_name_to_folder[categories_above_threshold[0]]
-        
-            
+        return options.category_name_to_folder[categories_above_threshold[0]]
+    
+
+def copy_to_target_folder(relative_filename,target_folder,options):
+    
     source_path = os.path.join(options.base_input_folder,relative_filename)
     assert os.path.isfile(source_path), 'Cannot find file {}'.format(source_path)
     
@@ -157,7 +174,31 @@ def process_detection(d,options):
     os.makedirs(target_dir,exist_ok=True)
     shutil.copyfile(source_path,target_path)
     
-# ...def process_detection()
+
+def get_columnar_target_folders(results,options):
+    """
+    For columnar results (see write_columnar_api_results()), finds the target folder
+    of every image with array operations on the detection columns, rather than
+    building a dict for each image.  Returns a list of (relative filename, target
+    folder) tuples.
+    """
+    
+    above_threshold = {}
+    for category_id,category_name in options.category_id_to_category_name.items():
+        category_mask = (results.detection_category == int(category_id))
+        max_conf = results.max_conf_per_image(category_mask)
+        # Confidences are stored as float32; compare in float32 so that e.g. a
+        # confidence of 0.725 isn't above a threshold of 0.725
+        threshold = np.float32(get_threshold(category_name,options))
+        above_threshold[category_name] = max_conf > threshold
+    
+    files = results.files()
+    target_folders = []
+    for i_image,fn in enumerate(files):
+        categories_above_threshold = [category_name for category_name,above 
+                                      in above_threshold.items() if above[i_image]]
+        target_folders.append((fn,get_target_folder(categories_above_threshold,options)))
+    return target_folders
     
     
 #%% Main function
@@ -173,18 +214,31 @@ def separate_detections_into_folders(options):
             raise ValueError('Target folder exists and is not empty')
     os.makedirs(options.base_output_folder,exist_ok=True)    
     
-    # Load detection results    
+    # Read detection results one image at a time, rather than loading the whole file.
+    #
+    # This first pass validates paths and reads the categories (which usually follow
+    # the image list); the second pass (below) processes each image.
+    #
+    # Columnar results (a folder written by write_columnar_api_results()) are
+    # filtered with array operations instead, see get_columnar_target_folders().
     print('Loading detection results')
-    results = json.load(open(options.results_file))
-    detections = results['images']
-    
-    for d in detections:
-        fn = d['file']
-        assert not path_is_abs(fn), 'Cannot process results with absolute image paths'
+    if os.path.isdir(options.results_file):
+        results = ColumnarApiResults(options.results_file)
+        for fn in results.files():
+            assert not path_is_abs(fn), 'Cannot process results with absolute image paths'
+        n_detections = results.n_images
+        detection_categories = results.other_fields['detection_categories']
+    else:
+        results = ApiResultsReader(options.results_file)
+        n_detections = 0
+        for d in results.iter_images():
+            fn = d['file']
+            assert not path_is_abs(fn), 'Cannot process results with absolute image paths'
+            n_detections += 1
+        detection_categories = results.detection_categories
         
-    print('Processing {} detections'.format(len(detections)))
+    print('Processing {} detections'.format(n_detections))
     
-    detection_categories = results['detection_categories']    
     options.category_id_to_category_name = detection_categories
     
     # Map class names to output folders
@@ -219,9 +273,27 @@ def separate_detections_into_folders(options):
     for folder in options.category_name_to_folder.values():
         os.makedirs(folder,exist_ok=True)            
         
-    if options.n_threads <= 1 or options.debug_max_images is not None:
+    if isinstance(results,ColumnarApiResults):
+        
+        target_folders = get_columnar_target_folders(results,options)
+        if options.debug_max_images is not None:
+            target_folders = target_folders[:options.debug_max_images+1]
+            
+        def copy_image(fn_and_folder):
+            copy_to_target_folder(fn_and_folder[0],fn_and_folder[1],options)
+            
+        if options.n_threads <= 1:
+            for fn_and_folder in tqdm(target_folders):
+                copy_image(fn_and_folder)
+        else:
+            pool = ThreadPool(options.n_threads)
+            list(tqdm(pool.imap(copy_image,target_folders),total=len(target_folders)))
+            pool.close()
+            pool.join()
+            
+    elif options.n_threads <= 1 or options.debug_max_images is not None:
     
-        for i_detection,d in enumerate(tqdm(detections)):
+        for i_detection,d in enumerate(tqdm(results.iter_images(),total=n_detections)):
             if options.debug_max_images is not None and i_detection > options.debug_max_images:
                 break
             process_detection(d,options)
@@ -231,7 +303,20 @@ def separate_detections_into_folders(options):
         pool = ThreadPool(options.n_threads)        
         
         process_detection_with_options = partial(process_detection, options=options)
-        results = list(tqdm(pool.imap(process_detection_with_options, detections), total=len(detections)))
+        
+        # Hand images to the pool in bounded chunks; pool.imap() would read the whole
+        # generator into its task queue, i.e. load all image entries into memory
+        images = results.iter_images()
+        chunk_size = options.n_threads * images_per_thread_per_chunk
+        with tqdm(total=n_detections) as pbar:
+            while True:
+                chunk = list(itertools.islice(images, chunk_size))
+                if len(chunk) == 0:
+                    break
+                pool.map(process_detection_with_options, chunk)
+                pbar.update(len(chunk))
+        pool.close()
+        pool.join()
         
         
 #%% Interactive driver
@@ -272,7 +357,8 @@ if False:
 def main():
     
     parser = argparse.ArgumentParser()
-    parser.add_argument('results_file', type=str, help='Input .json filename')
+    parser.add_argument('results_file', type=str,
+                        help='Input .json filename, or folder of columnar results')
     parser.add_argument('base_input_folder', type=str, help='Input image folder')
     parser.add_argument('base_output_folder', type=str, help='Output image folder')
 
@@ -44,6 +44,9 @@
 #
 ###
 #
+# The input can also be a folder of columnar results (see convert_output_format.py),
+# in which case the confidence threshold is applied to the detection arrays directly.
+#
 # To subset a COCO Camera Traps .json database, see subset_json_db.py
 #
 
@@ -52,12 +55,17 @@
 import argparse
 import sys
 import copy
+import itertools
 import json
 import os
 import re
 
 from tqdm import tqdm
 
+import numpy as np
+
+from api.batch_processing.postprocessing.load_api_results import (
+    ApiResultsReader, ColumnarApiResults)
 from ct_utils import args_to_object
 from data_management.annotations import annotation_constants
 
@@ -167,15 +175,51 @@ def write_detection_results(data, output_filename, options):
     else:
         os.makedirs(basedir, exist_ok=True)
     
-    print('Serializing to {}...'.format(output_filename), end='')
-    s = json.dumps(data, indent=1)
-    print(' ...done')
-    print('Writing output file...', end='')
+    # json.dump() writes as it serializes, so we never build the whole output string
+    print('Writing output file {}...'.format(output_filename), end='')
     with open(output_filename, "w") as f:
-        f.write(s)
+        json.dump(data, f, indent=1)
     print(' ...done')
 
 
+def subset_image_by_confidence(im, options):
+    """
+    Remove all detections below options.confidence_threshold from the single image
+    entry *im* (in-place), updating its max confidence accordingly.
+    
+    Returns True if the max confidence changed.
+    """
+    
+    p_orig = im['max_detection_conf']
+
+    # Find all detections above threshold for this image
+    detections = [d for d in im['detections'] if d['conf'] >= options.confidence_threshold]
+
+    # If there are no detections above threshold, set the max probability
+    # to -1, unless it already had a negative probability.
+    if len(detections) == 0:
+        if p_orig <= 0:                
+            p = p_orig
+        else:
+            p = -1
+
+    # Otherwise find the max confidence
+    else:
+        p = max(d['conf'] for d in detections)
+    
+    im['detections'] = detections
+    im['max_detection_conf'] = p
+
+    # Did this thresholding result in a max-confidence change?
+    if abs(p_orig - p) > 0.00001:
+
+        # We should only be *lowering* max confidence values (i.e., making them negative)
+        assert (p_orig <= 0) or (p < p_orig), 'Confidence changed from {} to {}'.format(p_orig, p)
+        return True
+    
+    return False
+
+
 def subset_json_detector_output_by_confidence(data, options):
     """
     Remove all detections below options.confidence_threshold, update max confidences accordingly.
@@ -194,32 +238,8 @@ def subset_json_detector_output_by_confidence(data, options):
     # iImage = 0; im = images_in[0]
     for iImage, im in tqdm(enumerate(images_in), total=len(images_in)):
         
-        p_orig = im['max_detection_conf']
-
-        # Find all detections above threshold for this image
-        detections = [d for d in im['detections'] if d['conf'] >= options.confidence_threshold]
-
-        # If there are no detections above threshold, set the max probability
-        # to -1, unless it already had a negative probability.
-        if len(detections) == 0:
-            if p_orig <= 0:                
-                p = p_orig
-            else:
-                p = -1
-
-        # Otherwise find the max confidence
-        else:
-            p = max(d['conf'] for d in detections)
-        
-        im['detections'] = detections
-
-        # Did this thresholding result in a max-confidence change?
-        if abs(p_orig - p) > 0.00001:
-
-            # We should only be *lowering* max confidence values (i.e., making them negative)
-            assert (p_orig <= 0) or (p < p_orig), 'Confidence changed from {} to {}'.format(p_orig, p)
+        if subset_image_by_confidence(im, options):
             n_max_changes += 1
-        im['max_detection_conf'] = p
         images_out.append(im)
         
     # ...for each image        
@@ -231,6 +251,30 @@ def subset_json_detector_output_by_confidence(data, options):
     return data
 
 
+def subset_image_by_query(im, options):
+    """
+    Returns False if the filename of the single image entry *im* doesn't match
+    options.query; otherwise replaces options.query with options.replacement in its
+    filename (in-place) and returns True.
+    """
+    
+    fn = im['file']
+    
+    # Only take images that match the query
+    if (options.query is not None) and (options.query not in fn):
+        return False
+    
+    if options.replacement is not None:
+        if options.query is not None:
+            fn = fn.replace(options.query, options.replacement)
+        else:
+            fn = options.replacement + fn
+        
+    im['file'] = fn
+    
+    return True
+
+
 def subset_json_detector_output_by_query(data, options):
     """
     Subset to images whose filename matches options.query; replace all instances of 
@@ -245,21 +289,8 @@ def subset_json_detector_output_by_query(data, options):
     # i_image = 0; im = images_in[0]
     for i_image, im in tqdm(enumerate(images_in), total=len(images_in)):
         
-        fn = im['file']
-        
-        # Only take images that match the query
-        if (options.query is not None) and (options.query not in fn):
-            continue
-        
-        if options.replacement is not None:
-            if options.query is not None:
-                fn = fn.replace(options.query, options.replacement)
-            else:
-                fn = options.replacement + fn
-            
-        im['file'] = fn
-        
-        images_out.append(im)
+        if subset_image_by_query(im, options):
+            images_out.append(im)
         
     # ...for each image        
     
@@ -323,6 +354,124 @@ if False:
     p = r'c:\foo/bar'; s = top_level_folder(p); print(s); assert s == 'c:\\foo'
     
     
+def read_and_subset_detector_output(input_filename, options):
+    """
+    Reads the detector output file *input_filename* one image at a time, applying
+    the query and confidence subsetting in *options* to each image as it's read, so
+    images and detections that are dropped are never all in memory at once.
+    
+    Returns a detector-output-formatted dict containing the remaining images.
+    """
+    
+    print('Reading and subsetting json...')
+    
+    reader = ApiResultsReader(input_filename)
+    images_in = reader.iter_images()
+    if options.debug_max_images > 0:
+        print('Trimming to {} images'.format(options.debug_max_images))
+        images_in = itertools.islice(images_in, options.debug_max_images)
+    
+    if options.query is not None:
+        print('Subsetting by query {}, replacement {}'.format(options.query, options.replacement))
+    
+    if options.confidence_threshold:
+        print('Subsetting by confidence >= {}'.format(options.confidence_threshold))
+    
+    images_out = []
+    n_images = 0
+    n_max_changes = 0
+    
+    for im in tqdm(images_in):
+        
+        n_images += 1
+        
+        if options.query is not None and not subset_image_by_query(im, options):
+            continue
+        
+        if options.confidence_threshold:
+            if subset_image_by_confidence(im, options):
+                n_max_changes += 1
+        
+        images_out.append(im)
+    
+    # ...for each image
+    
+    print('done, found {} matches (of {}), {} max conf changes'.format(
+            len(images_out), n_images, n_max_changes))
+    
+    # When trimming to debug_max_images, the fields after 'images' haven't been read yet,
+    # so this may need another pass through the file
+    data = {}
+    for field_name in reader.field_names:
+        data[field_name] = images_out if field_name == 'images' else reader.other_fields[field_name]
+    
+    return data
+    
+    
+def read_and_subset_columnar_detector_output(input_dir, options):
+    """
+    Applies the query and confidence subsetting in *options* to a folder of columnar
+    results (see load_api_results.write_columnar_api_results).  The confidence
+    threshold and the new max confidences are computed on the detection arrays, and
+    image entries are only built for the images that remain.
+    
+    Returns a detector-output-formatted dict containing the remaining images.
+    """
+    
+    print('Reading and subsetting columnar results...')
+    
+    results = ColumnarApiResults(input_dir)
+    n_images = results.n_images
+    if options.debug_max_images > 0:
+        print('Trimming to {} images'.format(options.debug_max_images))
+        n_images = min(n_images, options.debug_max_images)
+    image_indices = np.arange(n_images)
+    
+    if options.query is not None:
+        print('Subsetting by query {}, replacement {}'.format(options.query, options.replacement))
+        files = results.files()
+        image_indices = np.array([i for i in image_indices if options.query in files[i]],
+                                 dtype=np.int64)
+    
+    detection_mask = None
+    max_detection_conf = None
+    n_max_changes = 0
+    
+    if options.confidence_threshold:
+        
+        print('Subsetting by confidence >= {}'.format(options.confidence_threshold))
+        
+        # Same rules as subset_image_by_confidence(): images with no detections above
+        # threshold get a max confidence of -1, unless it was already <= 0
+        detection_mask = np.asarray(results.detection_conf) >= options.confidence_threshold
+        p_orig = np.asarray(results.max_detection_conf)
+        p = results.max_conf_per_image(detection_mask)
+        p = np.where((p < 0) & (p_orig <= 0), p_orig, p)
+        
+        # Images without a 'detections' field aren't thresholded
+        has_detections_field = results.has_detections_field()
+        p = np.where(has_detections_field, p, p_orig)
+        max_detection_conf = p
+        
+        changed = np.abs(p_orig - p)[image_indices] > 0.00001
+        n_max_changes = int(np.count_nonzero(changed))
+    
+    images_out = []
+    for im in tqdm(results.iter_images(image_indices, detection_mask, max_detection_conf),
+                   total=len(image_indices)):
+        if options.query is not None:
+            subset_image_by_query(im, options)
+        images_out.append(im)
+    
+    print('done, found {} matches (of {}), {} max conf changes'.format(
+            len(images_out), n_images, n_max_changes))
+    
+    data = dict(results.other_fields)
+    data['images'] = images_out
+    
+    return data
+    
+    
 def subset_json_detector_output(input_filename, output_filename, options, data=None):
     """
     Main internal entry point
@@ -342,26 +491,27 @@ def subset_json_detector_output(input_filename, output_filename, options, data=N
         if os.path.isfile(output_filename):
             raise ValueError('When splitting by folders, output must be a valid directory name, you specified an existing file')
             
-    if data is None:
-        print('Reading json...', end='')
-        with open(input_filename) as f:
-            data = json.load(f)
-        print(' ...done, read {} images'.format(len(data['images'])))
-        if options.debug_max_images > 0:
-            print('Trimming to {} images'.format(options.debug_max_images))
-            data['images'] = data['images'][:options.debug_max_images]
+    if data is None and os.path.isdir(input_filename):
+        
+        data = read_and_subset_columnar_detector_output(input_filename, options)
+        
+    elif data is None:
+        
+        data = read_and_subset_detector_output(input_filename, options)
+        
     else:
+        
         data = copy.deepcopy(data)
         
-    # data = add_missing_detection_results_fields(data)
-    
-    if options.query is not None:
+        # data = add_missing_detection_results_fields(data)
         
-        data = subset_json_detector_output_by_query(data, options)
-    
-    if options.confidence_threshold is not None:
+        if options.query is not None:
+            
+            data = subset_json_detector_output_by_query(data, options)
         
-        data = subset_json_detector_output_by_confidence(data, options)
+        if options.confidence_threshold is not None:
+            
+            data = subset_json_detector_output_by_confidence(data, options)
         
     if not options.split_folders:
         
@@ -524,7 +674,7 @@ if False:
 def main():
     
     parser = argparse.ArgumentParser()
-    parser.add_argument('input_file', type=str, help='Input .json filename')
+    parser.add_argument('input_file', type=str, help='Input .json filename, or folder of columnar results')
     parser.add_argument('output_file', type=str, help='Output .json filename')
     parser.add_argument('--query', type=str, default=None, help='Query string to search for (omitting this matches all)')
     parser.add_argument('--replacement', type=str, default=None, help='Replace [query] with this')
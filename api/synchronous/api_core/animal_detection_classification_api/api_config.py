@@ -8,6 +8,12 @@ MAX_IMAGES_ACCEPTED = 8
 
 IMAGE_CONTENT_TYPES = ['image/png', 'application/octet-stream', 'image/jpeg']
 
+# number of threads for decoding uploaded images and rendering and encoding output images, shared by all requests
+IMAGE_PROCESSING_THREADS = 8
+
+# the multipart response is sent in chunks of this size, instead of being built in memory all at once
+RESPONSE_CHUNK_SIZE_BYTES = 64 * 1024
+
 
 # classification configurations
 # TODO
@@ -36,6 +42,13 @@ NUM_ANNOTATED_CLASSES = 3
 # Number of significant float digits in JSON output
 NUM_SIGNIFICANT_DIGITS = 3
 
+# Crops are resized to this size (the input size of the InceptionV4 classifiers) so that all the crops of a request
+# can be classified in one batch
+CLASSIFICATION_CROP_SIZE = 299
+
+# Number of crops of a batch the classifier works on at once
+CLASSIFICATION_PARALLEL_ITERATIONS = 8
+
 
 
 # detection configurations
@@ -45,3 +58,13 @@ DETECTOR_MODEL_PATH = '/app/animal_detection_classification_api/model/md_v4.1.0.
 DETECTOR_MODEL_VERSION = 'v4.1.0'
 
 DEFAULT_DETECTION_CONFIDENCE = 0.9
+
+# images from concurrent /detect requests are collected for up to DETECTOR_MAX_BATCH_WAIT_MS milliseconds and run
+# through the detector in batches of at most DETECTOR_MAX_BATCH_SIZE images
+DETECTOR_MAX_BATCH_SIZE = 8
+
+DETECTOR_MAX_BATCH_WAIT_MS = 10
+
+# if the number of /detect requests being processed exceeds this limit, a 503 is returned to the caller; needs to be
+# at most the number of gunicorn threads in supervisord.conf
+MAXIMUM_CONCURRENT_DETECT_REQUESTS = 8
@@ -0,0 +1,98 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+"""
+Micro-batching of detector calls across concurrent requests.
+
+Each /detect request used to run the detector on its images one at a time, so
+the model ran with a batch size of 1 and the host sat idle between calls.
+DetectionBatcher runs the detector in one background thread. Request threads
+add their images to a shared queue and wait for their results. The background
+thread takes the first queued image, keeps collecting images from any request
+for up to max_wait_ms (or until it has max_batch_size images), runs them
+through TFDetector.generate_detections_batch(), and hands each result back to
+the request that sent the image.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DetectionBatcher:
+
+    def __init__(self, detector, max_batch_size=8, max_wait_ms=10):
+        """
+        Args:
+            detector: run_tf_detector.TFDetector
+            max_batch_size: int, maximum number of images per inference call
+            max_wait_ms: float, how long to wait for more images after the first
+                image of a batch arrives
+        """
+        assert max_batch_size > 0, 'max_batch_size needs to be > 0'
+        self.detector = detector
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000.0
+
+        # items are (image, image_id, Future)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='DetectionBatcher', daemon=True)
+        self._thread.start()
+
+    def detect(self, images, image_ids):
+        """Runs the detector on images, batched with images from other requests.
+
+        Blocks until all the images are scored.
+
+        Args:
+            images: list of PIL Image objects
+            image_ids: list of str, in the same order as images
+
+        Returns: list of dict, one per image and in the same order as images, in
+            the format returned by TFDetector.generate_detections_one_image()
+        """
+        assert len(images) == len(image_ids), 'images and image_ids need to be the same length'
+        futures = []
+        for image, image_id in zip(images, image_ids):
+            future = Future()
+            self._queue.put((image, image_id, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _next_batch(self):
+        """Blocks until an image is queued, then collects images until the batch
+        is full or max_wait_seconds has passed since the first image was taken.
+        """
+        batch = [self._queue.get()]
+        deadline = time.time() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    # still take any images that are already waiting
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            images = [image for image, _, _ in batch]
+            image_ids = [image_id for _, image_id, _ in batch]
+            try:
+                results = self.detector.generate_detections_batch(images, image_ids,
+                                                                  batch_size=self.max_batch_size)
+            except Exception as e:
+                # generate_detections_batch() records inference failures in its
+                # results, so this is unexpected; fail this batch but keep serving
+                print('DetectionBatcher: batch of {} images failed: {}'.format(len(batch), str(e)))
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
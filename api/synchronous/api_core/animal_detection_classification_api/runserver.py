@@ -3,8 +3,9 @@
 # # /ai4e_api_tools has been added to the PYTHONPATH, so we can reference those libraries directly.
 
 import json
+import os
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 from ai4e_app_insights_wrapper import AI4EAppInsights
@@ -13,8 +14,9 @@ from flask import Flask, Response, jsonify, make_response
 from requests_toolbelt.multipart.encoder import MultipartEncoder
 
 import api_config
+from detection_batcher import DetectionBatcher
 from run_tf_detector import TFDetector
-# from tf_classifer import TFClassifier
+from tf_classifer import TFClassifier
 import visualization.visualization_utils as viz_utils
 
 print('Creating application')
@@ -38,7 +40,24 @@ elapsed = time.time() - start_time
 log.log_info('detector loading time', elapsed)
 print('detector loading time: ', elapsed)
 
-# TODO classifier = TFClassifier(api_config.CLASSIFICATION_MODEL_PATHS, api_config.CLASSIFICATION_CLASS_NAMES)
+# images from concurrent requests are scored together in batches
+batcher = DetectionBatcher(detector, max_batch_size=api_config.DETECTOR_MAX_BATCH_SIZE,
+                           max_wait_ms=api_config.DETECTOR_MAX_BATCH_WAIT_MS)
+
+# Decoding uploaded images and rendering/encoding the output images are run on this pool; PIL releases the GIL
+# while decoding and encoding, so images of a request are processed in parallel
+image_pool = ThreadPoolExecutor(max_workers=api_config.IMAGE_PROCESSING_THREADS)
+
+# only load the classifiers whose model files have been downloaded
+start_time = time.time()
+classifier = TFClassifier({name: path for name, path in api_config.CLASSIFICATION_MODEL_PATHS.items()
+                           if os.path.exists(path)},
+                          api_config.CLASSIFICATION_CLASS_NAMES)
+elapsed = time.time() - start_time
+log.log_info('classifier loading time', elapsed)
+print('classifier loading time: ', elapsed, ', classifiers loaded: ', list(classifier.models.keys()))
+for name, error in classifier.failed_models.items():
+    log.log_exception('Classifier {} failed to load and is not available: {}'.format(name, error))
 
 
 def _make_error_object(error_code, error_message):
@@ -104,8 +123,8 @@ def _detect_process_request_data(request):
     if 'classification' in params:
         classification = params['classification']
 
-        if classification not in api_config.CLASSIFICATION_CLASS_NAMES.keys():
-            supported = str(list(api_config.CLASSIFICATION_CLASS_NAMES.keys())
+        if classification not in classifier.models.keys():
+            supported = str(list(classifier.models.keys())
                                         ).replace('[', '').replace(']', '')
 
             error_message = 'Classification name provided is not supported, The classifiers supported are {}'.format(supported)
@@ -116,12 +135,13 @@ def _detect_process_request_data(request):
     # read input images and parameters
     try:
         print('runserver, _detect_process_request_data, reading input images...')
-        images, image_names = [], []
+        image_futures, image_names = [], []
         for k, file in files.items():
             # file of type SpooledTemporaryFile has attributes content_type and a read() method
             if file.content_type in api_config.IMAGE_CONTENT_TYPES:
-                images.append(viz_utils.load_image(file))
+                image_futures.append(image_pool.submit(viz_utils.load_image, file))
                 image_names.append(k)
+        images = [future.result() for future in image_futures]
     except Exception as e:
         log.log_exception('Error reading the images: ' + str(e))
         return _make_error_object(500, 'Error reading the images: ' + str(e))
@@ -135,6 +155,25 @@ def _detect_process_request_data(request):
     }
 
 
+def _render_and_encode(image, detections, detection_confidence):
+    """Renders detections on image (in place) and returns it as a JPEG in a BytesIO stream."""
+    viz_utils.render_detection_bounding_boxes(detections, image, confidence_threshold=detection_confidence)
+
+    output_img_stream = BytesIO()
+    image.save(output_img_stream, format='jpeg')
+    output_img_stream.seek(0)
+    return output_img_stream
+
+
+def _stream_multipart(m):
+    """Yields the body of MultipartEncoder m in chunks, so the response is not built in memory all at once."""
+    while True:
+        chunk = m.read(api_config.RESPONSE_CHUNK_SIZE_BYTES)
+        if not chunk:
+            break
+        yield chunk
+
+
 def _convert_numpy_floats(np_array):
     new = []
     for i in np_array:
@@ -146,7 +185,7 @@ def _convert_numpy_floats(np_array):
                             methods=['POST'],
                             request_processing_function=_detect_process_request_data,  # data process function
                             # if the number of requests exceed this limit, a 503 is returned to the caller.
-                            maximum_concurrent_requests=2,
+                            maximum_concurrent_requests=api_config.MAXIMUM_CONCURRENT_DETECT_REQUESTS,
                             trace_name='post:detect_sync')
 def detect_sync(*args, **kwargs):
     # check if the request_processing_function had an error while parsing user specified parameters
@@ -159,20 +198,16 @@ def detect_sync(*args, **kwargs):
     images = kwargs.get('images')
     image_names = kwargs.get('image_names')
 
-    detection_results = []
-    inference_time_detector = []
-
     try:
         print('runserver, post_detect_sync, scoring images...')
 
-        for image_name, image in zip(image_names, images):
-            start_time = time.time()
-
-            result = detector.generate_detections_one_image(image, image_name)
-            detection_results.append(result)
+        start_time = time.time()
+        detection_results = batcher.detect(images, image_names)
 
-            elapsed = time.time() - start_time
-            inference_time_detector.append(elapsed)
+        # images are batched with other requests' images, so this is the time per image this request waited,
+        # including time queued behind other batches
+        elapsed = time.time() - start_time
+        inference_time_detector = [elapsed / len(images)] * len(images)
 
     except Exception as e:
         print('Error performing detection on the images: ' + str(e))
@@ -205,24 +240,20 @@ def detect_sync(*args, **kwargs):
 
     # classification
     classification_result = {}
-    # TODO
-    # try:
-    #     if classification:
-    #         print('runserver, classification...')
-    #         tic = datetime.now()
-    #         classification_result = classifier.classify_boxes(images, image_names, result, classification)
-    #         toc = datetime.now()
-    #         classification_inference_duration = toc - tic
-    #         print('runserver, classification, classifcation inference duraction: {}' \
-    #               .format({classification_inference_duration}))
-    #
-    #     else:
-    #         classification_result = {}
-    #
-    # except Exception as e:
-    #     print('Error performing classification on the images: ' + str(e))
-    #     log.log_exception('Error performing classification on the images: ' + str(e))
-    #     abort(500, 'Error performing classification on the images: ' + str(e))
+    classification_inference_duration = -1
+    try:
+        if classification:
+            print('runserver, classification...')
+            tic = time.time()
+            classification_result = classifier.classify_boxes(images, image_names, filtered_results, classification)
+            classification_inference_duration = time.time() - tic
+            print('runserver, classification, classification inference duration: {}'.format(
+                classification_inference_duration))
+
+    except Exception as e:
+        print('Error performing classification on the images: ' + str(e))
+        log.log_exception('Error performing classification on the images: ' + str(e))
+        return _make_error_response(500, 'Error performing classification on the images: ' + str(e))
 
     # return results; optionally render the detections on the images and send the annotated images back
     try:
@@ -233,16 +264,16 @@ def detect_sync(*args, **kwargs):
         }
 
         if render_boxes:
+            render_futures = []
             for image_name, image, result in zip(image_names, images, detection_results):
                 detections = result.get('detections', None)
                 if detections is None:
                     continue
-                viz_utils.render_detection_bounding_boxes(detections, image, confidence_threshold=detection_confidence)
+                render_futures.append((image_name, image_pool.submit(
+                    _render_and_encode, image, detections, detection_confidence)))
 
-                output_img_stream = BytesIO()
-                image.save(output_img_stream, format='jpeg')
-                output_img_stream.seek(0)
-                fields[image_name] = (image_name, output_img_stream, 'image/jpeg')
+            for image_name, future in render_futures:
+                fields[image_name] = (image_name, future.result(), 'image/jpeg')
 
         m = MultipartEncoder(fields=fields)
 
@@ -254,12 +285,12 @@ def detect_sync(*args, **kwargs):
         log.log_info('detector mean inference time', mean_inference_time_detector,
                      additionalProperties={
                          'detector mean inference time': str(mean_inference_time_detector),
-                         # TODO 'classification mean inference time': str(''),
+                         'classification inference time': str(classification_inference_duration),
                          'num_images': len(image_names),
                          'render_boxes': render_boxes,
                          'detection_confidence': detection_confidence
                      })
-        return Response(m.to_string(), mimetype=m.content_type)
+        return Response(_stream_multipart(m), mimetype=m.content_type, headers={'Content-Length': str(m.len)})
     except Exception as e:
         print('Error returning result or rendering the detection boxes: ' + str(e))
         log.log_exception('Error returning result or rendering the detection boxes: ' + str(e))
@@ -277,16 +308,15 @@ def get_model_detector_version(*args, **kwargs):
         return 'Detection model version unknown. Error: {}'.format(str(e))
 
 
-# TODO
-# @ai4e_service.api_sync_func(api_path='/supported_classifiers',
-#                             methods=['GET'],
-#                             maximum_concurrent_requests=1000,
-#                             trace_name='get:get_supported_classifiers')
-# def get_supported_classifiers(*args, **kwargs):
-#     try:
-#         return list(api_config.CLASSIFICATION_CLASS_NAMES.keys())
-#     except Exception as e:
-#         return 'Supported classifiers unknown. Error: {}'.format(str(e))
+@ai4e_service.api_sync_func(api_path='/supported_classifiers',
+                            methods=['GET'],
+                            maximum_concurrent_requests=1000,
+                            trace_name='get:get_supported_classifiers')
+def get_supported_classifiers(*args, **kwargs):
+    try:
+        return jsonify(list(classifier.models.keys()))
+    except Exception as e:
+        return 'Supported classifiers unknown. Error: {}'.format(str(e))
 
 
 if __name__ == '__main__':
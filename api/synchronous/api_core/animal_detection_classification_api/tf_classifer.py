@@ -6,55 +6,102 @@ duplicated functions
 import math
 
 import numpy as np
+import PIL.Image as Image
 import tensorflow as tf
-import tqdm
-from animal_detection_classification_api import api_config
+
+import api_config
 
 
 class TFClassifier(object):
     def __init__(self, checkpoints, class_names):
         self.models = {}
+        self.sessions = {}
         self.class_names = {}
+        self.failed_models = {}  # name of each classifier that failed to load -> error message
+
+        # Crops are resized to this size so they can be stacked into one batch
+        self.crop_size = api_config.CLASSIFICATION_CROP_SIZE
+
         for name, checkpoint in checkpoints.items():
-            self.models[name] = self.load_model(checkpoint)
+            # a classifier that fails to load is skipped, so the API (including detection) still starts
+            try:
+                graph = self.load_model(checkpoint)
+                # one long-lived session per model, reused across requests
+                sess = tf.Session(graph=graph)
+                self.check_model(graph, sess)
+            except Exception as e:
+                print('TFClassifier: failed to load classifier {} from {}, skipping it: {}'.format(
+                    name, checkpoint, str(e)))
+                self.failed_models[name] = str(e)
+                continue
+
+            self.models[name] = graph
+            self.sessions[name] = sess
             if name in class_names:
                 self.class_names[name] = self.load_class_names(class_names[name])
             else:
                 self.class_names[name] = []
 
-            
-            self.detection_category_whitelist = api_config.DETECTION_CATEGORY_WHITELIST
-            assert all([isinstance(x, str) for x in self.detection_category_whitelist])
+        self.detection_category_whitelist = api_config.DETECTION_CATEGORY_WHITELIST
+        assert all([isinstance(x, str) for x in self.detection_category_whitelist])
 
-            self.padding_factor = api_config.PADDING_FACTOR
+        self.padding_factor = api_config.PADDING_FACTOR
 
-            # Minimum detection confidence for showing a bounding box on the output image
-            self.default_confidence_threshold = api_config.DEFAULT_CONFIDENCE_THRESHOLD
+        # Minimum detection confidence for showing a bounding box on the output image
+        self.default_confidence_threshold = api_config.DEFAULT_CONFIDENCE_THRESHOLD
 
-            # Number of top-scoring classes to show at each bounding box
-            self.num_annotated_classes = api_config.NUM_ANNOTATED_CLASSES
+        # Number of top-scoring classes to show at each bounding box
+        self.num_annotated_classes = api_config.NUM_ANNOTATED_CLASSES
 
-            # Number of significant float digits in JSON output
-            self.num_significant_digits = api_config.NUM_SIGNIFICANT_DIGITS
+        # Number of significant float digits in JSON output
+        self.num_significant_digits = api_config.NUM_SIGNIFICANT_DIGITS
 
 
     def load_model(self, checkpoint):
         """
-        Load a classification model (i.e., create a graph) from a .pb file
+        Load a classification model (i.e., create a graph) from a .pb file, wrapped so that it classifies a batch
+        of crops in one session call.
+
+        The frozen graph takes a single image ('input:0', shape [height, width, 3], values in [0, 1]) and includes
+        its own preprocessing, so the graph is imported inside a tf.map_fn() over the batch; the returned graph has
+        the placeholder 'crops:0' (shape [num_crops, height, width, 3]) and the output 'batch_predictions:0'
+        (shape [num_crops, num_classes]).
         """
 
         print('Creating Graph...')
+        od_graph_def = tf.GraphDef()
+        with tf.gfile.GFile(checkpoint, 'rb') as fid:
+            serialized_graph = fid.read()
+            od_graph_def.ParseFromString(serialized_graph)
+
         graph = tf.Graph()
         with graph.as_default():
-            od_graph_def = tf.GraphDef()
-            with tf.gfile.GFile(checkpoint, 'rb') as fid:
-                serialized_graph = fid.read()
-                od_graph_def.ParseFromString(serialized_graph)
-                tf.import_graph_def(od_graph_def, name='')
+            crops = tf.placeholder(tf.float32, shape=[None, None, None, 3], name='crops')
+
+            def classify_crop(crop):
+                predictions, = tf.import_graph_def(od_graph_def, input_map={'input:0': crop},
+                                                   return_elements=['output:0'], name='classifier')
+                return tf.squeeze(predictions, [0])
+
+            tf.identity(tf.map_fn(classify_crop, crops, dtype=tf.float32,
+                                  parallel_iterations=api_config.CLASSIFICATION_PARALLEL_ITERATIONS),
+                        name='batch_predictions')
         print('...done')
         return graph
 
 
+    def check_model(self, graph, sess):
+        """
+        Runs a batch of 2 blank crops through a graph from load_model(), raising an exception if the batched graph
+        cannot be run or doesn't return one row of predictions per crop.
+        """
+        crops = np.zeros((2, self.crop_size, self.crop_size, 3), dtype=np.float32)
+        predictions = sess.run(graph.get_tensor_by_name('batch_predictions:0'),
+                               feed_dict={graph.get_tensor_by_name('crops:0'): crops})
+        assert predictions.ndim == 2 and predictions.shape[0] == 2, \
+            'Unexpected shape of batch predictions: {}'.format(predictions.shape)
+
+
     def load_class_names(self, file_path):
         """
         Load a class name json file
@@ -94,85 +141,92 @@ class TFClassifier(object):
             return math.floor(x * factor)/factor
 
 
+    def get_crop(self, image_data, detection):
+        """
+        Returns the square crop, padded by padding_factor, around one detection, resized to crop_size, or None if
+        the crop is empty.
+
+        Args:
+        image_data (np.ndarray) Image as an array of shape [height, width, 3], type uint8
+        detection  (list)       [ymin, xmin, ymax, xmax, confidence, category] with relative coordinates, as in
+                                the detection_result of the /detect endpoint
+        """
+        image_height, image_width, _ = image_data.shape
+
+        # Convert normalized coordinates to pixel coordinates
+        box_coords_abs = np.array(detection[:4]) * [image_height, image_width, image_height, image_width]
+        # Pad the detected animal to a square box and additionally by PADDING_FACTOR, making sure that the box
+        # coordinates are still within the image
+        bbox_size = box_coords_abs[2:] - box_coords_abs[:2]
+        offsets = (self.padding_factor * np.max(bbox_size) - bbox_size) / 2
+        crop_box = box_coords_abs + np.hstack([-offsets, offsets])
+        crop_box = np.clip(crop_box, 0, [image_height, image_width, image_height, image_width]).astype(int)
+
+        cropped_img = image_data[crop_box[0]:crop_box[2], crop_box[1]:crop_box[3]]
+        if cropped_img.size == 0:
+            return None
+        cropped_img = Image.fromarray(cropped_img).resize((self.crop_size, self.crop_size), Image.BILINEAR)
+        return np.asarray(cropped_img, np.float32) / 255
+
+
     def classify_boxes(self, images, image_names, detection_json, classification):
-        classification_graph = self.models[classification]
+        """
+        Classifies the confident, whitelisted detections in all the images of a request in one batch.
+
+        Args:
+        images         (list) PIL images
+        image_names    (list) Names of the images, in the same order as images
+        detection_json (dict) Maps image name to a list of detections, each
+                              [ymin, xmin, ymax, xmax, confidence, category]
+        classification (str)  Name of the classifier to use
+
+        Returns a dict mapping each image name to a list with, for each classified detection, a list of the
+        num_annotated_classes top-scoring [class name, confidence] pairs.
+        """
+        graph = self.models[classification]
+        sess = self.sessions[classification]
         class_names = self.class_names[classification]
-        # json_with_classes = self.add_classification_categories(detection_json, class_names)
         classification_predictions = {}
 
-        with classification_graph.as_default():
-            with tf.Session(graph=classification_graph) as sess:
-                # Get input and output tensors of classification model
-                image_tensor = classification_graph.get_tensor_by_name('input:0')
-                predictions_tensor = classification_graph.get_tensor_by_name('output:0')
-                predictions_tensor = tf.squeeze(predictions_tensor, [0])
-                
-                # For each image
-                n_images = len(images)
-                for i_image in tqdm.tqdm(list(range(0,n_images))):
-                    images = [np.asarray(image, np.uint8) for image in images]
-                    image_data = images[i_image]
-                    
-                    # Scale pixel values to [0,1]
-                    image_data = image_data / 255
-                    image_height, image_width, _ = image_data.shape
-
-                    image_description = detection_json[image_names[i_image]]
-                    classification_predictions[image_names[i_image]] = list()
-                    # For each box
-                    n_detections = len(image_description)
-                    for i_box in range(n_detections):
-
-                        cur_detection = image_description[i_box]
-
-                        # Skip detections with low confidence
-                        if cur_detection[4] < self.default_confidence_threshold:
-                            continue
-
-                        # Skip if detection category is not in whitelist
-                        if not str(cur_detection[5]) in self.detection_category_whitelist:
-                            continue
-
-                        # box ymin, xim, ymax, xmax
-                        x_min = cur_detection[1]
-                        y_min = cur_detection[0]
-                        width_of_box = cur_detection[1] + cur_detection[3]
-                        height_of_box = cur_detection[0] + cur_detection[2]
-
-                        # Get current box in relative coordinates and format [x_min, y_min, width_of_box, height_of_box]
-                        box_orig = [x_min, y_min, width_of_box, height_of_box]
-                        # Convert to [ymin, xmin, ymax, xmax] and
-                        # store it as 1x4 numpy array so we can re-use the generic multi-box padding code
-                        box_coords = np.array([[box_orig[1],
-                                                box_orig[0],
-                                                box_orig[1]+box_orig[3],
-                                                box_orig[0]+box_orig[2]
-                                            ]])
-                        # Convert normalized coordinates to pixel coordinates
-                        box_coords_abs = (box_coords * np.tile([image_height, image_width], (1,2)))
-                        # Pad the detected animal to a square box and additionally by PADDING_FACTOR, the result will be in crop_boxes
-                        # However, we need to make sure that it box coordinates are still within the image
-                        bbox_sizes = np.vstack([box_coords_abs[:,2] - box_coords_abs[:,0], box_coords_abs[:,3] - box_coords_abs[:,1]]).T
-                        offsets = (self.padding_factor * np.max(bbox_sizes, axis=1, keepdims=True) - bbox_sizes) / 2
-                        crop_boxes = box_coords_abs + np.hstack([-offsets,offsets])
-                        crop_boxes = np.maximum(0,crop_boxes).astype(int)
-                        # Get the first (and only) row as our bbox to classify
-                        crop_box = crop_boxes[0]
-                        # Get the image data for that box
-                        cropped_img = image_data[crop_box[0]:crop_box[2], crop_box[1]:crop_box[3]]
-
-                        # Run inference
-                        predictions = sess.run(predictions_tensor, feed_dict={image_tensor: cropped_img})
-                        current_predicitions = []        
-                        # Add the *num_annotated_classes* top scoring classes
-                        for class_idx in np.argsort(-predictions)[:self.num_annotated_classes]:
-                            class_conf = self.truncate_float(predictions[class_idx].item())         
-                            for idx, name in enumerate(class_names):
-                                if class_idx == idx:
-                                    current_predicitions.append([f'{name}', class_conf])
-                                
-
-                        classification_predictions[image_names[i_image]].append(current_predicitions)
-                        
+        # gather the crops of all images, converting each image to an array once
+        crops = []
+        crop_image_names = []
+        for image, image_name in zip(images, image_names):
+            classification_predictions[image_name] = list()
+            image_data = None
+            for cur_detection in detection_json[image_name]:
+                # Skip detections with low confidence
+                if cur_detection[4] < self.default_confidence_threshold:
+                    continue
+
+                # Skip if detection category is not in whitelist
+                if not str(cur_detection[5]) in self.detection_category_whitelist:
+                    continue
+
+                if image_data is None:
+                    image_data = np.asarray(image, np.uint8)
+                cropped_img = self.get_crop(image_data, cur_detection)
+                if cropped_img is None:
+                    continue
+                crops.append(cropped_img)
+                crop_image_names.append(image_name)
+
+        if len(crops) == 0:
+            return classification_predictions
+
+        # Run inference on all crops at once
+        batch_predictions = sess.run(graph.get_tensor_by_name('batch_predictions:0'),
+                                     feed_dict={graph.get_tensor_by_name('crops:0'): np.stack(crops)})
+
+        for image_name, predictions in zip(crop_image_names, batch_predictions):
+            current_predictions = []
+            # Add the *num_annotated_classes* top scoring classes
+            for class_idx in np.argsort(-predictions)[:self.num_annotated_classes]:
+                if class_idx < len(class_names):
+                    class_conf = self.truncate_float(predictions[class_idx].item(),
+                                                     precision=self.num_significant_digits)
+                    current_predictions.append([f'{class_names[class_idx]}', class_conf])
+
+            classification_predictions[image_name].append(current_predictions)
+
         return classification_predictions
-    
@@ -357,6 +357,48 @@ class TestSynchronousAPI(unittest.TestCase):
         self.assertEqual(results_string, API_RESULT_PNG)
 
 
+# path to a frozen classifier (e.g. one of api_config.CLASSIFICATION_MODEL_PATHS); the classifier check below is
+# skipped if this is not set
+CLASSIFIER_MODEL_PATH = os.environ.get('CLASSIFIER_MODEL_PATH', None)
+
+
+@unittest.skipIf(CLASSIFIER_MODEL_PATH is None, 'set CLASSIFIER_MODEL_PATH to check the batched classifier')
+class TestTFClassifierBatching(unittest.TestCase):
+    """Checks locally (no API calls) that TFClassifier's batched graph, which imports the frozen classifier inside
+    tf.map_fn, gives the same predictions as running the frozen graph directly on each crop.
+    """
+
+    def test_batch_predictions_match_single_crop(self):
+        import numpy as np
+        import tensorflow as tf
+
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api_core',
+                                        'animal_detection_classification_api'))
+        from tf_classifer import TFClassifier
+
+        classifier = TFClassifier({'test': CLASSIFIER_MODEL_PATH}, {})
+        graph = classifier.models['test']
+
+        rng = np.random.RandomState(0)
+        crops = rng.uniform(size=(3, classifier.crop_size, classifier.crop_size, 3)).astype(np.float32)
+        batch_predictions = classifier.sessions['test'].run(
+            graph.get_tensor_by_name('batch_predictions:0'),
+            feed_dict={graph.get_tensor_by_name('crops:0'): crops})
+
+        # the frozen graph as used before batching: one crop per session call
+        single_graph = tf.Graph()
+        with single_graph.as_default():
+            graph_def = tf.GraphDef()
+            with tf.gfile.GFile(CLASSIFIER_MODEL_PATH, 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            tf.import_graph_def(graph_def, name='')
+        with tf.Session(graph=single_graph) as sess:
+            for crop, predictions in zip(crops, batch_predictions):
+                single_predictions = sess.run(single_graph.get_tensor_by_name('output:0'),
+                                              feed_dict={single_graph.get_tensor_by_name('input:0'): crop})
+                np.testing.assert_allclose(predictions, np.squeeze(single_predictions, 0), atol=1e-5)
+
+
 if __name__ == '__main__':
 
     # https://stackoverflow.com/questions/11380413/python-unittest-passing-arguments
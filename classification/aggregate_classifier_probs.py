@@ -1,8 +1,9 @@
 r"""Aggregate probabilities from a classifier's outputs according to a mapping
 from the desired (target) categories to the classifier's categories.
 
-Using the mapping, create a new version of the classifier output CSV with
-probabilities summed within each target category. Also output a new
+Using the mapping, create a new version of the classifier output CSV (or npy
+shards directory, see classifier_outputs.py) with probabilities summed within
+each target category. Also output a new
 "index-to-name" JSON file which identifies the sequential order of the target
 categories.
 
@@ -21,6 +22,8 @@ from typing import Set
 import pandas as pd
 from tqdm import tqdm
 
+from classification import classifier_outputs
+
 def main(classifier_results_csv_path: str,
          target_mapping_json_path: str,
          output_csv_path: str,
@@ -30,9 +33,8 @@ def main(classifier_results_csv_path: str,
     Because the output CSV is often very large, we process it in chunks of 1000
     rows at a time.
     """
-    chunked_df_iterator = pd.read_csv(
-        classifier_results_csv_path, chunksize=1000, float_precision='high',
-        index_col='path')
+    chunked_df_iterator = classifier_outputs.iter_classifier_outputs(
+        classifier_results_csv_path, chunksize=1000)
 
     with open(target_mapping_json_path, 'r') as f:
         target_mapping = json.load(f)
@@ -69,7 +71,8 @@ def _parse_args() -> argparse.Namespace:
         description='Aggregate classifier probabilities to target classes.')
     parser.add_argument(
         'classifier_results_csv',
-        help='path to CSV with classifier probabilities')
+        help='path to CSV or npy shards directory with classifier '
+             'probabilities')
     parser.add_argument(
         '-t', '--target-mapping', required=True,
         help='path to JSON file mapping target categories to classifier labels')
@@ -0,0 +1,138 @@
+"""
+Reading and writing classifier outputs (per-crop probabilities).
+
+Classifier outputs are stored either as a CSV file (optionally gzipped), with a
+'path' column followed by one column per label, or as a directory of npy
+shards. Formatting millions of probabilities as text is slow, so
+run_classifier.py can write the shard format instead:
+
+    <output_dir>/
+        label_names.json             # list of str, one per probability column
+        shard_00000_probs.npy        # float16 or float32, shape [n, num_labels]
+        shard_00000_paths.npy        # str, shape [n], crop paths
+        shard_00001_probs.npy
+        ...
+
+Each shard's probs file is written before its paths file, so a shard is only
+read once its paths file exists.
+
+This file should not depend on PyTorch, so that scripts which only consume
+classifier outputs don't need it.
+"""
+import json
+import os
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+
+LABEL_NAMES_FILENAME = 'label_names.json'
+SHARD_PATHS_SUFFIX = '_paths.npy'
+SHARD_PROBS_SUFFIX = '_probs.npy'
+
+
+def is_csv_path(path: str) -> bool:
+    """Returns True if [path] refers to a CSV file, False if it refers to a
+    directory of npy shards.
+    """
+    return path.endswith('.csv') or path.endswith('.csv.gz')
+
+
+class ShardedOutputsWriter:
+    """Writes classifier outputs to a directory of npy shards.
+
+    Rows are buffered in memory and written out as a new shard every
+    shard_size rows, and when close() is called.
+    """
+
+    def __init__(self, output_dir: str, label_names: Sequence[str],
+                 dtype: str = 'float32', shard_size: int = 100000):
+        """Creates a ShardedOutputsWriter, overwriting any existing shards in
+        output_dir.
+        """
+        self.output_dir = output_dir
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self.num_shards = 0
+        self.num_rows = 0
+        self._paths: List[str] = []
+        self._probs: List[np.ndarray] = []
+        self._num_buffered = 0
+
+        os.makedirs(output_dir, exist_ok=True)
+        for fn in os.listdir(output_dir):
+            if fn.endswith(SHARD_PATHS_SUFFIX) or fn.endswith(SHARD_PROBS_SUFFIX):
+                os.remove(os.path.join(output_dir, fn))
+        with open(os.path.join(output_dir, LABEL_NAMES_FILENAME), 'w') as f:
+            json.dump(list(label_names), f, indent=1)
+
+    def write(self, paths: Sequence[str], probs: np.ndarray) -> None:
+        """Adds rows for [paths], whose probabilities are the rows of [probs]."""
+        assert len(paths) == len(probs)
+        self._paths.extend(paths)
+        self._probs.append(probs.astype(self.dtype, copy=False))
+        self._num_buffered += len(paths)
+        if self._num_buffered >= self.shard_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        """Writes buffered rows to a new shard."""
+        if self._num_buffered == 0:
+            return
+        prefix = os.path.join(self.output_dir, f'shard_{self.num_shards:05d}')
+        np.save(prefix + SHARD_PROBS_SUFFIX, np.concatenate(self._probs))
+        np.save(prefix + SHARD_PATHS_SUFFIX, np.array(self._paths))
+        self.num_shards += 1
+        self.num_rows += self._num_buffered
+        self._paths = []
+        self._probs = []
+        self._num_buffered = 0
+
+    def close(self) -> None:
+        """Writes any remaining buffered rows."""
+        self._flush()
+
+
+def iter_classifier_outputs(path: str, chunksize: Optional[int] = None
+                            ) -> Iterator[pd.DataFrame]:
+    """Yields classifier outputs from a CSV file or a directory of npy shards
+    as pd.DataFrames indexed by crop path, with one column per label.
+
+    For CSV files, each DataFrame has up to chunksize rows (all rows if
+    chunksize is None). For shards, each DataFrame is one shard.
+    """
+    if not os.path.isdir(path):
+        if chunksize is None:
+            yield pd.read_csv(path, float_precision='high', index_col='path')
+        else:
+            yield from pd.read_csv(path, chunksize=chunksize,
+                                   float_precision='high', index_col='path')
+        return
+
+    with open(os.path.join(path, LABEL_NAMES_FILENAME), 'r') as f:
+        label_names = json.load(f)
+    shard_prefixes = sorted(
+        fn[:-len(SHARD_PATHS_SUFFIX)] for fn in os.listdir(path)
+        if fn.endswith(SHARD_PATHS_SUFFIX))
+    for prefix in shard_prefixes:
+        prefix = os.path.join(path, prefix)
+        paths = np.load(prefix + SHARD_PATHS_SUFFIX)
+        probs = np.load(prefix + SHARD_PROBS_SUFFIX)
+        yield pd.DataFrame(data=probs, columns=label_names,
+                           index=pd.Index(paths, name='path'))
+
+
+def load_classifier_outputs(path: str) -> pd.DataFrame:
+    """Loads classifier outputs from a CSV file or a directory of npy shards
+    into a pd.DataFrame indexed by crop path, with one column per label.
+    """
+    dfs = list(iter_classifier_outputs(path))
+    if len(dfs) == 1:
+        return dfs[0]
+    if len(dfs) == 0:
+        with open(os.path.join(path, LABEL_NAMES_FILENAME), 'r') as f:
+            label_names = json.load(f)
+        return pd.DataFrame(columns=label_names,
+                            index=pd.Index([], name='path'))
+    return pd.concat(dfs)
@@ -0,0 +1,359 @@
+r"""Crop detections and run a species classifier on the crops, without saving
+crops to disk.
+
+This script does the same work as crop_detections.py followed by
+run_classifier.py, but decodes each full image once and crops all of its
+bounding boxes in memory, so each crop is never JPEG-encoded, written to disk,
+read back and decoded again.
+
+This script takes as input:
+1) a detections JSON file, usually the output of run_tf_detector_batch.py or the
+    output of the Batch API in the "Batch processing API output format"
+2) a path to a local directory containing the images in the detections JSON
+3) a path to a PyTorch TorchScript compiled model file
+4) (if the model is EfficientNet) an image size
+
+Like crop_detections.py, only "animal" bounding boxes above the confidence
+threshold are classified. Crops are named as crop_detections.py would name
+them, "<img_file>___cropXX_mdvY.Y.jpg", so the output can be passed to
+merge_classification_detection_output.py. Like run_classifier.py, results are
+written either to a CSV file (if the output path ends in .csv or .csv.gz) or to
+a directory of npy shards (see classifier_outputs.py).
+
+If --output-json is given, the classification results are also merged into the
+detections JSON, as merge_classification_detection_output.py would do, and
+saved to that path.
+
+Example usage:
+    python crop_and_classify.py \
+        detections.json \
+        /path/to/images \
+        /path/to/model.pt \
+        classifier_output.csv.gz \
+        --classifier-categories /path/to/index_to_name.json \
+        --image-size 300 --batch-size 64 --num-workers 8 \
+        --threshold 0.8 --square-crops \
+        --output-json detections_with_classifications.json \
+        --classifier-name "efficientnet-b3-megaclassifier-v0.1"
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    Optional, Sequence, Tuple)
+
+import pandas as pd
+import PIL
+import torch
+import torch.utils
+
+from classification import (classifier_outputs, crop_detections,
+                            merge_classification_detection_output,
+                            run_classifier, train_classifier)
+
+
+class ImageCropsDataset(torch.utils.data.Dataset):
+    """Dataset of images, where each item is all of the crops of one image."""
+
+    def __init__(self,
+                 images: Sequence[Mapping[str, Any]],
+                 images_dir: str,
+                 detection_categories: Mapping[str, str],
+                 detector_version: str,
+                 confidence_threshold: float,
+                 square_crops: bool,
+                 transform: Callable[[PIL.Image.Image], torch.Tensor],
+                 img_size: int):
+        """Creates an ImageCropsDataset.
+
+        Args:
+            images: list of dict, the 'images' field of a detections JSON
+            images_dir: str, path to local directory of images
+            detection_categories: dict, detection category ID => name
+            detector_version: str, detector version string, e.g., '4.1'
+            confidence_threshold: float, only crop bounding boxes above this
+                value
+            square_crops: bool, whether to crop bounding boxes as squares
+            transform: callable, transforms a crop to the classifier's input
+            img_size: int, size of the classifier's input
+        """
+        self.images = images
+        self.images_dir = images_dir
+        self.detection_categories = detection_categories
+        self.detector_version = detector_version
+        self.confidence_threshold = confidence_threshold
+        self.square_crops = square_crops
+        self.transform = transform
+        self.img_size = img_size
+
+    def __getitem__(self, index: int
+                    ) -> Tuple[torch.Tensor, List[str], str, bool]:
+        """
+        Returns: tuple, (crops, crop_files, img_file, failed)
+            crops: torch.Tensor, shape [num_crops, 3, img_size, img_size]
+            crop_files: list of str, crop path for each crop
+            img_file: str, image path
+            failed: bool, whether the image failed to load
+        """
+        img_file = self.images[index]['file']
+        crop_files = []
+        crops = []
+
+        # crop_file => normalized bbox coordinates [xmin, ymin, width, height]
+        bboxes_tocrop: Dict[str, List[float]] = {}
+        for i, bbox_dict in enumerate(self.images[index].get('detections', [])):
+            if bbox_dict['conf'] < self.confidence_threshold:
+                continue
+            if self.detection_categories[bbox_dict['category']] != 'animal':
+                continue
+            crop_file = (img_file + f'___crop{i:02d}_'
+                         f'mdv{self.detector_version}.jpg')
+            bboxes_tocrop[crop_file] = bbox_dict['bbox']
+
+        failed = False
+        if len(bboxes_tocrop) > 0:
+            img = crop_detections.load_local_image(
+                os.path.join(self.images_dir, img_file))
+            if img is None:
+                failed = True
+                bboxes_tocrop = {}
+            elif img.mode != 'RGB':
+                img = img.convert(mode='RGB')
+
+        for crop_file, bbox in bboxes_tocrop.items():
+            crop = crop_detections.crop_image(
+                img, bbox_norm=bbox, square_crop=self.square_crops)
+            if crop is None:
+                continue
+            crops.append(self.transform(crop))
+            crop_files.append(crop_file)
+
+        if len(crops) == 0:
+            return (torch.empty(0, 3, self.img_size, self.img_size),
+                    crop_files, img_file, failed)
+        return torch.stack(crops), crop_files, img_file, failed
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+
+def batch_crops(loader: Iterable[Tuple[torch.Tensor, List[str], str, bool]],
+                batch_size: int,
+                images_failed: List[str]
+                ) -> Iterator[Tuple[torch.Tensor, List[str]]]:
+    """Regroups the crops of each image from an ImageCropsDataset loader into
+    batches of batch_size crops (the last batch may be smaller).
+
+    Args:
+        loader: iterable over ImageCropsDataset items
+        batch_size: int, number of crops per batch
+        images_failed: list, paths of images that failed to load are appended
+            to this list
+
+    Yields: tuple, (inputs, crop_files)
+    """
+    buffered_crops: List[torch.Tensor] = []
+    buffered_files: List[str] = []
+    num_buffered = 0
+    for crops, crop_files, img_file, failed in loader:
+        if failed:
+            images_failed.append(img_file)
+            continue
+        if len(crop_files) == 0:
+            continue
+        buffered_crops.append(crops)
+        buffered_files.extend(crop_files)
+        num_buffered += len(crop_files)
+        while num_buffered >= batch_size:
+            inputs = torch.cat(buffered_crops)
+            yield inputs[:batch_size], buffered_files[:batch_size]
+            buffered_crops = [inputs[batch_size:]]
+            buffered_files = buffered_files[batch_size:]
+            num_buffered -= batch_size
+    if num_buffered > 0:
+        yield torch.cat(buffered_crops), buffered_files
+
+
+def main(detections_json_path: str,
+         images_dir: str,
+         model_path: str,
+         output_path: str,
+         classifier_categories_json_path: Optional[str],
+         detector_version: Optional[str],
+         confidence_threshold: float,
+         square_crops: bool,
+         img_size: int,
+         batch_size: int,
+         num_workers: int,
+         probs_dtype: str,
+         output_json_path: Optional[str],
+         classifier_name: Optional[str],
+         classification_threshold: float) -> None:
+    """Main function."""
+    # error checking
+    assert 0 <= confidence_threshold <= 1, \
+        'Invalid confidence threshold {}'.format(confidence_threshold)
+    if output_json_path is not None:
+        assert classifier_categories_json_path is not None, \
+            '--output-json requires --classifier-categories'
+        assert classifier_name is not None, \
+            '--output-json requires --classifier-name'
+
+    # load detections JSON
+    with open(detections_json_path, 'r') as f:
+        js = json.load(f)
+
+    # get detector version
+    if 'info' in js and 'detector' in js['info']:
+        api_det_version = js['info']['detector'].rsplit('v', maxsplit=1)[1]
+        if detector_version is not None:
+            assert api_det_version == detector_version
+        else:
+            detector_version = api_det_version
+    assert detector_version is not None
+
+    label_names = None
+    if classifier_categories_json_path is not None:
+        with open(classifier_categories_json_path, 'r') as f:
+            idx_to_label = json.load(f)
+        label_names = [idx_to_label[str(i)] for i in range(len(idx_to_label))]
+
+    # create dataset, each item is all of the crops of one image
+    print('Creating data loader')
+    dataset = ImageCropsDataset(
+        images=js['images'], images_dir=images_dir,
+        detection_categories=js['detection_categories'],
+        detector_version=detector_version,
+        confidence_threshold=confidence_threshold, square_crops=square_crops,
+        transform=run_classifier.create_transform(img_size), img_size=img_size)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=None, num_workers=num_workers, pin_memory=True)
+
+    # create model
+    print('Loading saved model')
+    model = torch.jit.load(model_path)
+    model, device = train_classifier.prep_device(model)
+
+    images_failed: List[str] = []
+    start = time.time()
+    num_crops = run_classifier.test_epoch(
+        model, batch_crops(loader, batch_size, images_failed), device=device,
+        label_names=label_names, output_path=output_path,
+        probs_dtype=probs_dtype)
+    elapsed = time.time() - start
+    print(f'Classified {num_crops} crops from {len(dataset)} images in '
+          f'{elapsed:.1f}s ({num_crops / elapsed:.1f} crops/s)')
+    print(f'{len(images_failed)} images failed to load.')
+
+    if output_json_path is not None:
+        assert label_names is not None and classifier_name is not None
+        print('Merging classification results with detections')
+        if num_crops > 0:
+            df = classifier_outputs.load_classifier_outputs(output_path)
+        else:
+            # nothing was written to output_path, so there are no
+            # classifications to add to the detections
+            df = pd.DataFrame(columns=label_names)
+        js['images'] = {img['file']: img for img in js['images']}
+        classifier_timestamp = datetime.datetime.now().strftime(
+            '%Y-%m-%d %H:%M:%S')
+        classification_js = (
+            merge_classification_detection_output
+            .combine_classification_with_detection(
+                detection_js=js, df=df, idx_to_label=idx_to_label,
+                label_names=label_names, classifier_name=classifier_name,
+                classifier_timestamp=classifier_timestamp,
+                threshold=classification_threshold))
+        output_json_dir = os.path.dirname(output_json_path)
+        if output_json_dir != '':
+            os.makedirs(output_json_dir, exist_ok=True)
+        with open(output_json_path, 'w') as f:
+            json.dump(classification_js, f, indent=1)
+
+
+def _parse_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Crop detections and run classifier, without saving crops '
+                    'to disk.')
+    parser.add_argument(
+        'detections_json',
+        help='path to detections JSON file')
+    parser.add_argument(
+        'images_dir',
+        help='path to local directory where images are saved')
+    parser.add_argument(
+        'model',
+        help='path to TorchScript compiled model')
+    parser.add_argument(
+        'output',
+        help='path to save CSV file with classifier results (can use .csv.gz '
+             'extension for compression), or if the path does not end in .csv '
+             'or .csv.gz, path to a directory in which to save results as npy '
+             'shards')
+    parser.add_argument(
+        '-c', '--classifier-categories',
+        help='path to JSON file for classifier categories. If not given, '
+             'classes are numbered "0", "1", "2", ...')
+    parser.add_argument(
+        '-v', '--detector-version',
+        help='detector version string, e.g., "4.1", used if detector version '
+             'cannot be inferred from detections JSON')
+    parser.add_argument(
+        '-t', '--threshold', type=float, default=0.0,
+        help='confidence threshold above which to crop bounding boxes')
+    parser.add_argument(
+        '--square-crops', action='store_true',
+        help='crop bounding boxes as squares')
+    parser.add_argument(
+        '--image-size', type=int, default=224,
+        help='size of input image to model, usually 224px, but may be larger '
+             'especially for EfficientNet models')
+    parser.add_argument(
+        '--batch-size', type=int, default=1,
+        help='batch size (number of crops) for evaluating model')
+    parser.add_argument(
+        '--num-workers', type=int, default=8,
+        help='# of workers for loading and cropping images')
+    parser.add_argument(
+        '--probs-dtype', choices=['float32', 'float16'], default='float32',
+        help='dtype of probabilities saved in npy shards, ignored for CSV '
+             'output')
+
+    merge_group = parser.add_argument_group(
+        'arguments for merging classification results with detections')
+    merge_group.add_argument(
+        '-o', '--output-json',
+        help='path to save detections JSON with classification results, '
+             'requires --classifier-categories')
+    merge_group.add_argument(
+        '-n', '--classifier-name',
+        help='name of classifier, required if --output-json is given')
+    merge_group.add_argument(
+        '--classification-threshold', type=float, default=0.1,
+        help='Confidence threshold between 0 and 1. In the output JSON, omit '
+             'classifier results on classes whose confidence is below this '
+             'threshold.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    main(detections_json_path=args.detections_json,
+         images_dir=args.images_dir,
+         model_path=args.model,
+         output_path=args.output,
+         classifier_categories_json_path=args.classifier_categories,
+         detector_version=args.detector_version,
+         confidence_threshold=args.threshold,
+         square_crops=args.square_crops,
+         img_size=args.image_size,
+         batch_size=args.batch_size,
+         num_workers=args.num_workers,
+         probs_dtype=args.probs_dtype,
+         output_json_path=args.output_json,
+         classifier_name=args.classifier_name,
+         classification_threshold=args.classification_threshold)
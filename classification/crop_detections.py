@@ -29,8 +29,21 @@ bounding box width or height. In the case that the square crop boundaries exceed
 the original image size, the crop is padded with 0s.
 
 This script outputs a log file to
-    <output_dir>/crop_detections_log_{timestamp}.json
-which contains images that failed to download and crop properly.
+    <logdir>/crop_detections_log_{timestamp}.json
+which contains images that failed to download and crop properly, and a manifest
+of the crops it saved, one path (relative to cropped_images_dir) per line, to
+    <logdir>/crop_detections_manifest_{timestamp}.txt
+
+Downloading images is I/O-bound, so by default images are loaded and cropped
+with a pool of threads. Decoding, cropping and encoding local images is
+CPU-bound, so if all images are local (i.e., no --container-url is given), pass
+--processes to use a pool of processes instead; images are sent to the
+processes in chunks of --chunk-size images.
+
+To check whether each crop already exists, this script calls os.path.exists()
+on each crop, which is slow for millions of crops (especially on network
+drives). Pass --list-existing-crops to instead list cropped_images_dir once,
+up front.
 
 Example command:
 
@@ -51,8 +64,8 @@ from datetime import datetime
 import io
 import json
 import os
-from typing import (Any, BinaryIO, Dict, Iterable, List, Mapping, Optional,
-                    Sequence, Tuple, Union)
+from typing import (Any, BinaryIO, Container, Dict, Iterable, List, Mapping,
+                    Optional, Sequence, Set, Tuple, Union)
 
 from azure.storage.blob import ContainerClient
 from PIL import Image, ImageOps
@@ -69,7 +82,10 @@ def main(detections_json_path: str,
          check_crops_valid: bool,
          confidence_threshold: float,
          threads: int,
-         logdir: str) -> None:
+         logdir: str,
+         processes: int = 0,
+         chunk_size: int = 100,
+         list_existing_crops: bool = False) -> None:
     """
     Args:
         detections_json_path: str, path to detections JSON file
@@ -88,7 +104,13 @@ def main(detections_json_path: str,
             valid (i.e., not truncated)
         confidence_threshold: float, only crop bounding boxes above this value
         threads: int, number of threads to use for downloading images
-        logdir: str, path to directory to save log file
+        logdir: str, path to directory to save log file and manifest
+        processes: int, if > 0, use this many processes instead of threads to
+            load and crop images, only supported if container_url is None
+        chunk_size: int, number of images to send to a process at a time, only
+            used if processes > 0
+        list_existing_crops: bool, whether to list cropped_images_dir once to
+            find existing crops, instead of checking each crop separately
     """
     # error checking
     assert 0 <= confidence_threshold <= 1, \
@@ -126,7 +148,7 @@ def main(detections_json_path: str,
         for d in info_dict['detections']:
             d['category'] = detection_categories[d['category']]
 
-    images_failed_dload_crop, num_downloads, num_crops = download_and_crop(
+    images_failed_dload_crop, num_downloads, new_crop_paths = download_and_crop(
         detections=detections,
         cropped_images_dir=cropped_images_dir,
         images_dir=images_dir,
@@ -136,18 +158,29 @@ def main(detections_json_path: str,
         save_full_images=save_full_images,
         square_crops=square_crops,
         check_crops_valid=check_crops_valid,
-        threads=threads)
+        threads=threads,
+        processes=processes,
+        chunk_size=chunk_size,
+        list_existing_crops=list_existing_crops)
     print(f'{len(images_failed_dload_crop)} images failed to download or crop.')
 
+    os.makedirs(logdir, exist_ok=True)
+    date = datetime.now().strftime('%Y%m%d_%H%M%S')  # e.g., '20200722_110816'
+
+    # save manifest of new crops
+    manifest_path = os.path.join(logdir, f'crop_detections_manifest_{date}.txt')
+    with open(manifest_path, 'w') as f:
+        for crop_path in sorted(new_crop_paths):
+            f.write(os.path.relpath(crop_path, cropped_images_dir) + '\n')
+
     # save log of bad images
     log = {
         'images_missing_detections': images_missing_detections,
         'images_failed_download_or_crop': images_failed_dload_crop,
         'num_new_downloads': num_downloads,
-        'num_new_crops': num_crops
+        'num_new_crops': len(new_crop_paths),
+        'new_crops_manifest': manifest_path
     }
-    os.makedirs(logdir, exist_ok=True)
-    date = datetime.now().strftime('%Y%m%d_%H%M%S')  # e.g., '20200722_110816'
     log_path = os.path.join(logdir, f'crop_detections_log_{date}.json')
     with open(log_path, 'w') as f:
         json.dump(log, f, indent=1)
@@ -163,8 +196,11 @@ def download_and_crop(
         save_full_images: bool,
         square_crops: bool,
         check_crops_valid: bool,
-        threads: int = 1
-        ) -> Tuple[List[str], int, int]:
+        threads: int = 1,
+        processes: int = 0,
+        chunk_size: int = 100,
+        list_existing_crops: bool = False
+        ) -> Tuple[List[str], int, List[str]]:
     """
     Saves crops to a file with the same name as the original image with an
     additional suffix appended, starting with 3 underscores:
@@ -197,12 +233,19 @@ def download_and_crop(
         check_crops_valid: bool, whether to load each crop to ensure the file is
             valid (i.e., not truncated)
         threads: int, number of threads to use for downloading images
+        processes: int, if > 0, use this many processes instead of threads to
+            load and crop images, only supported if container_url is None
+        chunk_size: int, number of images to send to a process at a time, only
+            used if processes > 0
+        list_existing_crops: bool, whether to list cropped_images_dir once to
+            find existing crops, instead of checking each crop separately
 
     Returns:
         images_failed_download: list of str, images with bounding boxes that
             failed to download or crop properly
         total_downloads: int, number of images downloaded
-        total_new_crops: int, number of new crops saved to cropped_images_dir
+        new_crop_paths: list of str, paths of new crops saved to
+            cropped_images_dir
     """
     # True for ground truth, False for MegaDetector
     # always save as .jpg for consistency
@@ -213,9 +256,26 @@ def download_and_crop(
             '{img_path}___crop{n:>02d}_' + f'mdv{detector_version}.jpg')
     }
 
+    existing_crops = None
+    if list_existing_crops:
+        print(f'Listing existing crops in {cropped_images_dir}...')
+        existing_crops = list_files(cropped_images_dir)
+        print(f'Found {len(existing_crops)} existing crops.')
+
+    if processes > 0:
+        assert container_url is None, \
+            'processes are only supported for local images'
+        return crop_local_images_in_processes(
+            detections=detections, crop_path_template=crop_path_template,
+            images_dir=images_dir, confidence_threshold=confidence_threshold,
+            square_crops=square_crops, check_crops_valid=check_crops_valid,
+            processes=processes, chunk_size=chunk_size,
+            existing_crops=existing_crops)
+
     pool = futures.ThreadPoolExecutor(max_workers=threads)
     future_to_img_path = {}
     images_failed_download = []
+    new_crop_paths: List[str] = []
 
     container_client = None
     if container_url is not None:
@@ -232,19 +292,18 @@ def download_and_crop(
         future = pool.submit(
             load_and_crop, img_path, images_dir, container_client, bbox_dicts,
             confidence_threshold, crop_path_template[is_ground_truth],
-            save_full_images, square_crops, check_crops_valid)
+            save_full_images, square_crops, check_crops_valid,
+            existing_crops=existing_crops, new_crop_paths=new_crop_paths)
         future_to_img_path[future] = img_path
 
     total = len(future_to_img_path)
     total_downloads = 0
-    total_new_crops = 0
     print(f'Reading/downloading {total} images and cropping...')
     for future in tqdm(futures.as_completed(future_to_img_path), total=total):
         img_path = future_to_img_path[future]
         try:
-            did_download, num_new_crops = future.result()
+            did_download, _ = future.result()
             total_downloads += did_download
-            total_new_crops += num_new_crops
         except Exception as e:  # pylint: disable=broad-except
             exception_type = type(e).__name__
             tqdm.write(f'{img_path} - generated {exception_type}: {e}')
@@ -257,8 +316,117 @@ def download_and_crop(
             pass
 
     print(f'Downloaded {total_downloads} images.')
-    print(f'Made {total_new_crops} new crops.')
-    return images_failed_download, total_downloads, total_new_crops
+    print(f'Made {len(new_crop_paths)} new crops.')
+    return images_failed_download, total_downloads, new_crop_paths
+
+
+def crop_local_images_in_processes(
+        detections: Mapping[str, Mapping[str, Any]],
+        crop_path_template: Mapping[bool, str],
+        images_dir: Optional[str],
+        confidence_threshold: float,
+        square_crops: bool,
+        check_crops_valid: bool,
+        processes: int,
+        chunk_size: int,
+        existing_crops: Optional[Set[str]] = None
+        ) -> Tuple[List[str], int, List[str]]:
+    """Loads and crops local images with a pool of processes, sending images
+    to the processes in chunks of chunk_size images.
+
+    See download_and_crop() for a description of the arguments and return
+    values. crop_path_template maps whether an image's bounding boxes are
+    ground truth to the crop path template for that image.
+    """
+    img_paths = sorted(detections.keys())
+    chunks = []
+    for i in range(0, len(img_paths), chunk_size):
+        chunk = []
+        for img_path in img_paths[i:i + chunk_size]:
+            info_dict = detections[img_path]
+            is_ground_truth = info_dict.get('is_ground_truth', False)
+            chunk.append((img_path, info_dict['detections'],
+                          crop_path_template[is_ground_truth]))
+        chunks.append(chunk)
+
+    images_failed_download = []
+    new_crop_paths: List[str] = []
+
+    # existing_crops may be large, so it is sent to each process once, rather
+    # than with each chunk
+    pool = futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_crop_process,
+        initargs=(existing_crops,))
+    future_list = [
+        pool.submit(load_and_crop_chunk, chunk, images_dir,
+                    confidence_threshold, square_crops, check_crops_valid)
+        for chunk in chunks
+    ]
+
+    print(f'Reading {len(img_paths)} images and cropping, in {len(chunks)} '
+          f'chunks...')
+    for future in tqdm(futures.as_completed(future_list), total=len(chunks)):
+        chunk_failed, chunk_new_crop_paths = future.result()
+        images_failed_download.extend(chunk_failed)
+        new_crop_paths.extend(chunk_new_crop_paths)
+
+    pool.shutdown()
+
+    print(f'Made {len(new_crop_paths)} new crops.')
+    return images_failed_download, 0, new_crop_paths
+
+
+# set of existing crop paths in each process started by
+# crop_local_images_in_processes()
+_process_existing_crops: Optional[Set[str]] = None
+
+
+def _init_crop_process(existing_crops: Optional[Set[str]]) -> None:
+    """Initializes a process started by crop_local_images_in_processes()."""
+    global _process_existing_crops  # pylint: disable=global-statement
+    _process_existing_crops = existing_crops
+
+
+def load_and_crop_chunk(
+        chunk: Sequence[Tuple[str, Iterable[Mapping[str, Any]], str]],
+        images_dir: Optional[str],
+        confidence_threshold: float,
+        square_crops: bool,
+        check_crops_valid: bool) -> Tuple[List[str], List[str]]:
+    """Loads and crops a chunk of local images, in a process started by
+    crop_local_images_in_processes().
+
+    Args:
+        chunk: list of tuples, (img_path, bbox_dicts, crop_path_template)
+        see load_and_crop() for the other arguments
+
+    Returns:
+        images_failed: list of str, images that failed to load or crop properly
+        new_crop_paths: list of str, paths of new crops saved
+    """
+    images_failed = []
+    new_crop_paths: List[str] = []
+    for img_path, bbox_dicts, crop_path_template in chunk:
+        try:
+            load_and_crop(
+                img_path, images_dir, None, bbox_dicts, confidence_threshold,
+                crop_path_template, False, square_crops, check_crops_valid,
+                existing_crops=_process_existing_crops,
+                new_crop_paths=new_crop_paths)
+        except Exception as e:  # pylint: disable=broad-except
+            exception_type = type(e).__name__
+            tqdm.write(f'{img_path} - generated {exception_type}: {e}')
+            images_failed.append(img_path)
+    return images_failed, new_crop_paths
+
+
+def list_files(dir_path: str) -> Set[str]:
+    """Returns the set of normalized paths of all files under dir_path."""
+    paths = set()
+    for root, _, files in os.walk(dir_path):
+        for file_name in files:
+            paths.add(os.path.normpath(os.path.join(root, file_name)))
+    return paths
 
 
 def load_local_image(img_path: Union[str, BinaryIO]) -> Optional[Image.Image]:
@@ -281,7 +449,10 @@ def load_and_crop(img_path: str,
                   crop_path_template: str,
                   save_full_image: bool,
                   square_crops: bool,
-                  check_crops_valid: bool) -> Tuple[bool, int]:
+                  check_crops_valid: bool,
+                  existing_crops: Optional[Container[str]] = None,
+                  new_crop_paths: Optional[List[str]] = None
+                  ) -> Tuple[bool, int]:
     """Given an image and a list of bounding boxes, checks if the crops already
     exist. If not, loads the image locally or Azure Blob Storage, then crops it.
 
@@ -306,6 +477,10 @@ def load_and_crop(img_path: str,
         square_crops: bool, whether to crop bounding boxes as squares
         check_crops_valid: bool, whether to load each crop to ensure the file is
             valid (i.e., not truncated)
+        existing_crops: optional set of str, normalized paths of existing
+            crops, used instead of checking whether each crop exists
+        new_crop_paths: optional list, paths of new crops are appended to this
+            list
 
     Returns:
         did_download: bool, whether image was downloaded from Azure Blob Storage
@@ -323,7 +498,11 @@ def load_and_crop(img_path: str,
         if bbox_dict['category'] != 'animal':
             continue
         crop_path = crop_path_template.format(img_path=img_path, n=i)
-        if not os.path.exists(crop_path) or (
+        if existing_crops is not None:
+            crop_exists = os.path.normpath(crop_path) in existing_crops
+        else:
+            crop_exists = os.path.exists(crop_path)
+        if not crop_exists or (
                 check_crops_valid and load_local_image(crop_path) is None):
             bboxes_tocrop[crop_path] = bbox_dict['bbox']
     if len(bboxes_tocrop) == 0:
@@ -358,8 +537,11 @@ def load_and_crop(img_path: str,
 
     # crop the image
     for crop_path, bbox in bboxes_tocrop.items():
-        num_new_crops += save_crop(
+        did_save = save_crop(
             img, bbox_norm=bbox, square_crop=square_crops, save=crop_path)
+        num_new_crops += did_save
+        if did_save and new_crop_paths is not None:
+            new_crop_paths.append(crop_path)
     return did_download, num_new_crops
 
 
@@ -376,6 +558,28 @@ def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
 
     Returns: bool, True if a crop was saved, False otherwise
     """
+    crop = crop_image(img, bbox_norm=bbox_norm, square_crop=square_crop)
+    if crop is None:
+        tqdm.write(f'Skipping size-0 crop at {save}')
+        return False
+
+    os.makedirs(os.path.dirname(save), exist_ok=True)
+    crop.save(save)
+    return True
+
+
+def crop_image(img: Image.Image, bbox_norm: Sequence[float],
+               square_crop: bool) -> Optional[Image.Image]:
+    """Crops an image.
+
+    Args:
+        img: PIL.Image.Image object, already loaded
+        bbox_norm: list or tuple of float, [xmin, ymin, width, height] all in
+            normalized coordinates
+        square_crop: bool, whether to crop bounding boxes as a square
+
+    Returns: PIL.Image.Image, the crop, or None if the crop has size 0
+    """
     img_w, img_h = img.size
     xmin = int(bbox_norm[0] * img_w)
     ymin = int(bbox_norm[1] * img_h)
@@ -395,8 +599,7 @@ def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
         box_h = min(img_h, box_size)
 
     if box_w == 0 or box_h == 0:
-        tqdm.write(f'Skipping size-0 crop (w={box_w}, h={box_h}) at {save}')
-        return False
+        return None
 
     # Image.crop() takes box=[left, upper, right, lower]
     crop = img.crop(box=[xmin, ymin, xmin + box_w, ymin + box_h])
@@ -405,9 +608,7 @@ def save_crop(img: Image.Image, bbox_norm: Sequence[float], square_crop: bool,
         # pad to square using 0s
         crop = ImageOps.pad(crop, size=(box_size, box_size), color=0)
 
-    os.makedirs(os.path.dirname(save), exist_ok=True)
-    crop.save(save)
-    return True
+    return crop
 
 
 def _parse_args() -> argparse.Namespace:
@@ -448,6 +649,18 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         '-n', '--threads', type=int, default=1,
         help='number of threads to use for downloading and cropping images')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=0,
+        help='if > 0, number of processes to use for cropping local images, '
+             'instead of threads, not supported with --container-url')
+    parser.add_argument(
+        '--chunk-size', type=int, default=100,
+        help='number of images to send to a process at a time, only used with '
+             '--processes')
+    parser.add_argument(
+        '--list-existing-crops', action='store_true',
+        help='list cropped_images_dir once to find existing crops, instead of '
+             'checking whether each crop exists')
     parser.add_argument(
         '--logdir', default='.',
         help='path to directory to save log file')
@@ -466,4 +679,7 @@ if __name__ == '__main__':
          check_crops_valid=args.check_crops_valid,
          confidence_threshold=args.threshold,
          threads=args.threads,
-         logdir=args.logdir)
+         logdir=args.logdir,
+         processes=args.processes,
+         chunk_size=args.chunk_size,
+         list_existing_crops=args.list_existing_crops)
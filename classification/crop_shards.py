@@ -0,0 +1,258 @@
+r"""Pack image crops into large shard files, for faster training.
+
+Reading millions of small crop files in random order is slow, especially from a
+shared filesystem. This script packs the crops listed in a classification
+dataset CSV (the output of create_classification_dataset.py) into a few large
+shard files, resizing each crop so that its longer side is at most --max-side
+pixels. train_classifier.py and evaluate_model.py read crops from the shards if
+given --crop-shards-dir.
+
+Each crop is stored as JPEG-encoded bytes. The output directory contains:
+
+    <output_dir>/
+        info.json                    # {"max_side": int, "quality": int}
+        index.npz                    # arrays 'paths', 'shards', 'offsets',
+                                     #   'lengths', one entry per crop
+        shard_00000.bin              # concatenated JPEG bytes
+        shard_00001.bin
+        ...
+
+The shards are memory-mapped when read, so the OS page cache holds the
+recently read parts of each shard.
+
+Crops are resized before the training augmentations (e.g., RandomResizedCrop)
+are applied, so --max-side should be at least the model's input image size.
+
+Example usage:
+    python crop_shards.py \
+        $BASE_LOGDIR/classification_ds.csv \
+        /path/to/crops \
+        /path/to/crop_shards \
+        --max-side 512 --num-workers 16
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import PIL.Image
+from tqdm import tqdm
+
+
+INFO_FILENAME = 'info.json'
+INDEX_FILENAME = 'index.npz'
+
+# start a new shard once the current shard reaches this size
+DEFAULT_SHARD_SIZE_BYTES = 2 ** 30
+
+
+def get_shard_path(shards_dir: str, shard: int) -> str:
+    """Returns the path to shard number [shard] in shards_dir."""
+    return os.path.join(shards_dir, f'shard_{shard:05d}.bin')
+
+
+def load_and_encode_crop(crop_path: str, max_side: int, quality: int
+                         ) -> Optional[bytes]:
+    """Loads a crop, resizes it so its longer side is at most max_side, and
+    returns it as JPEG-encoded bytes, or None if it fails to load.
+    """
+    try:
+        with PIL.Image.open(crop_path) as img:
+            img.draft('RGB', (max_side, max_side))
+            img = img.convert('RGB')
+    except OSError as e:  # PIL.UnidentifiedImageError is a subclass of OSError
+        tqdm.write(f'Unable to load {crop_path}. {type(e).__name__}: {e}.')
+        return None
+    img.thumbnail((max_side, max_side), PIL.Image.BICUBIC)
+    with io.BytesIO() as f:
+        img.save(f, format='JPEG', quality=quality)
+        return f.getvalue()
+
+
+def _load_and_encode_crop_star(args: Tuple[str, int, int]) -> Optional[bytes]:
+    return load_and_encode_crop(*args)
+
+
+def pack_crops(crop_files: Sequence[str],
+               cropped_images_dir: str,
+               output_dir: str,
+               max_side: int,
+               quality: int = 95,
+               num_workers: int = 8,
+               shard_size_bytes: int = DEFAULT_SHARD_SIZE_BYTES
+               ) -> None:
+    """Packs crops into shards.
+
+    Args:
+        crop_files: list of str, paths to crops, relative to cropped_images_dir
+        cropped_images_dir: str, path to local directory of crops
+        output_dir: str, path to directory to save shards, see module docstring
+        max_side: int, crops are resized so their longer side is at most this
+            many pixels
+        quality: int, JPEG quality of packed crops
+        num_workers: int, number of processes for loading and resizing crops
+        shard_size_bytes: int, start a new shard once the current shard reaches
+            this size
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, INFO_FILENAME), 'w') as f:
+        json.dump({'max_side': max_side, 'quality': quality}, f, indent=1)
+
+    paths = []
+    shards = []
+    offsets = []
+    lengths = []
+    num_failed = 0
+
+    shard = 0
+    offset = 0
+    shard_file = open(get_shard_path(output_dir, shard), 'wb')
+
+    tasks = ((os.path.join(cropped_images_dir, crop_file), max_side, quality)
+             for crop_file in crop_files)
+    with multiprocessing.Pool(num_workers) as pool:
+        # imap() preserves order, so crops are packed in the order given
+        encoded_crops = pool.imap(_load_and_encode_crop_star, tasks,
+                                  chunksize=64)
+        for crop_file, encoded in tqdm(zip(crop_files, encoded_crops),
+                                       total=len(crop_files)):
+            if encoded is None:
+                num_failed += 1
+                continue
+            if offset > 0 and offset + len(encoded) > shard_size_bytes:
+                shard_file.close()
+                shard += 1
+                offset = 0
+                shard_file = open(get_shard_path(output_dir, shard), 'wb')
+            shard_file.write(encoded)
+            paths.append(crop_file)
+            shards.append(shard)
+            offsets.append(offset)
+            lengths.append(len(encoded))
+            offset += len(encoded)
+    shard_file.close()
+
+    np.savez(os.path.join(output_dir, INDEX_FILENAME),
+             paths=np.array(paths), shards=np.array(shards, dtype=np.int32),
+             offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int64))
+    print(f'Packed {len(paths)} crops into {shard + 1} shards. '
+          f'{num_failed} crops failed to load.')
+
+
+class CropShards:
+    """Reads crops from shards written by pack_crops().
+
+    Shards are memory-mapped on first use, so a CropShards object can be
+    pickled (e.g., sent to DataLoader worker processes) before any crops are
+    read.
+    """
+
+    def __init__(self, shards_dir: str, crop_files: Sequence[str]):
+        """Creates a CropShards object for reading the given crops.
+
+        Args:
+            shards_dir: str, path to directory of shards
+            crop_files: list of str, paths to crops (as given to pack_crops()),
+                crops are read by their position in this list
+        """
+        self.shards_dir = shards_dir
+        with np.load(os.path.join(shards_dir, INDEX_FILENAME)) as npz:
+            index = pd.Series(np.arange(len(npz['paths'])), index=npz['paths'])
+            rows = index.reindex(crop_files)
+            missing = rows.index[rows.isna()]
+            assert len(missing) == 0, (
+                f'{len(missing)} crops are not in the shards, '
+                f'e.g., {missing[0]}')
+            rows = rows.to_numpy(dtype=np.int64)
+            self.shards = npz['shards'][rows]
+            self.offsets = npz['offsets'][rows]
+            self.lengths = npz['lengths'][rows]
+        self._mmaps: Dict[int, np.memmap] = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_mmaps'] = {}
+        return state
+
+    def read(self, i: int) -> bytes:
+        """Returns the encoded bytes of crop i."""
+        shard = int(self.shards[i])
+        if shard not in self._mmaps:
+            self._mmaps[shard] = np.memmap(
+                get_shard_path(self.shards_dir, shard), dtype=np.uint8,
+                mode='r')
+        offset = self.offsets[i]
+        return self._mmaps[shard][offset:offset + self.lengths[i]].tobytes()
+
+    def load(self, i: int) -> PIL.Image.Image:
+        """Returns crop i as a RGB PIL image."""
+        with io.BytesIO(self.read(i)) as f:
+            img = PIL.Image.open(f)
+            img.load()
+        return img
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+
+def main(dataset_csv_path: str,
+         cropped_images_dir: str,
+         output_dir: str,
+         max_side: int,
+         quality: int,
+         num_workers: int,
+         shard_size_mb: int) -> None:
+    """Main function."""
+    df = pd.read_csv(dataset_csv_path, index_col=False, usecols=['path'])
+    crop_files = df['path'].drop_duplicates().tolist()
+    pack_crops(crop_files, cropped_images_dir=cropped_images_dir,
+               output_dir=output_dir, max_side=max_side, quality=quality,
+               num_workers=num_workers,
+               shard_size_bytes=shard_size_mb * 2 ** 20)
+
+
+def _parse_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Packs image crops into shards for training.')
+    parser.add_argument(
+        'dataset_csv',
+        help='path to classification dataset CSV, whose "path" column lists '
+             'the crops to pack')
+    parser.add_argument(
+        'cropped_images_dir',
+        help='path to local directory where image crops are saved')
+    parser.add_argument(
+        'output_dir',
+        help='path to directory to save shards')
+    parser.add_argument(
+        '--max-side', type=int, default=512,
+        help='resize crops so their longer side is at most this many pixels, '
+             'should be at least the model input image size')
+    parser.add_argument(
+        '--quality', type=int, default=95,
+        help='JPEG quality of packed crops')
+    parser.add_argument(
+        '--num-workers', type=int, default=8,
+        help='# of processes for loading and resizing crops')
+    parser.add_argument(
+        '--shard-size-mb', type=int, default=1024,
+        help='approximate size of each shard, in MiB')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    main(dataset_csv_path=args.dataset_csv,
+         cropped_images_dir=args.cropped_images_dir,
+         output_dir=args.output_dir,
+         max_side=args.max_side,
+         quality=args.quality,
+         num_workers=args.num_workers,
+         shard_size_mb=args.shard_size_mb)
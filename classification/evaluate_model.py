@@ -162,7 +162,9 @@ def main(params_json_path: str, ckpt_path: str, output_dir: str,
         weight_by_detection_conf=False,
         batch_size=params['batch_size'],
         num_workers=params['num_workers'],
-        augment_train=False)
+        augment_train=False,
+        crop_shards_dir=params.get('crop_shards_dir'),
+        eval_cache_dir=params.get('eval_cache_dir'))
     num_labels = len(label_names)
 
     # create model, compile with TorchScript if given checkpoint is not compiled
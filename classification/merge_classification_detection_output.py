@@ -5,7 +5,8 @@ This script takes 2 main files as input:
 1) Either a "dataset CSV" (output of create_classification_dataset.py) or a
     "classification results CSV" (output of evaluate_model.py). The CSV is
     expected to have columns listed below. The 'label' and [label names] columns
-    are optional, but at least one of them must be proided.
+    are optional, but at least one of them must be proided. The output of
+    run_classifier.py in npy shards format is also accepted.
     - 'path': str, path to cropped image
         - if passing in a detections JSON, must match
             <img_file>___cropXX_mdvY.Y.jpg
@@ -68,6 +69,7 @@ from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
 import pandas as pd
 from tqdm import tqdm
 
+from classification import classifier_outputs
 from ct_utils import truncate_float
 
 
@@ -147,8 +149,7 @@ def main(classification_csv_path: str,
 
     # load classification CSV
     print('Loading classification CSV...')
-    df = pd.read_csv(classification_csv_path, float_precision='high',
-                     index_col='path')
+    df = classifier_outputs.load_classifier_outputs(classification_csv_path)
     if relative_conf or label_pos is not None:
         assert 'label' in df.columns
 
@@ -385,7 +386,8 @@ def _parse_args() -> argparse.Namespace:
                     'outputs.')
     parser.add_argument(
         'classification_csv',
-        help='path to classification CSV')
+        help='path to classification CSV, or to npy shards directory output '
+             'by run_classifier.py')
     parser.add_argument(
         'label_names_json',
         help='path to JSON file mapping label index to label name')
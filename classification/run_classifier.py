@@ -9,8 +9,9 @@ This script takes as input:
 3) a path to a PyTorch TorchScript compiled model file
 4) (if the model is EfficientNet) an image size
 
-By default, this script overwrites the detections JSON file, adding in
-classification results. To output a new JSON file, use the --output argument.
+Results are written either to a CSV file (if the output path ends in .csv or
+.csv.gz), or to a directory of npy shards (see classifier_outputs.py), which is
+much faster to write and read for large numbers of crops.
 
 Example usage:
     python run_classifier.py \
@@ -22,7 +23,9 @@ Example usage:
 import argparse
 import json
 import os
-from typing import Any, Callable, Optional, Sequence, Tuple
+import time
+from typing import (Any, Callable, Dict, Iterable, Optional, Sequence, Set,
+                    Tuple)
 
 import pandas as pd
 import PIL
@@ -32,7 +35,7 @@ import torchvision as tv
 from torchvision.datasets.folder import default_loader
 from tqdm import tqdm
 
-from classification import train_classifier
+from classification import classifier_outputs, train_classifier
 
 
 class SimpleDataset(torch.utils.data.Dataset):
@@ -64,6 +67,18 @@ class SimpleDataset(torch.utils.data.Dataset):
         return len(self.img_files)
 
 
+def create_transform(img_size: int) -> Callable[[PIL.Image.Image], Any]:
+    """Returns the transform from a crop to the classifier's input tensor."""
+    return tv.transforms.Compose([
+        # resizes smaller edge to img_size
+        tv.transforms.Resize(img_size, interpolation=PIL.Image.BICUBIC),
+        tv.transforms.CenterCrop(img_size),
+        tv.transforms.ToTensor(),
+        tv.transforms.Normalize(mean=train_classifier.MEANS,
+                                std=train_classifier.STDS, inplace=True)
+    ])
+
+
 def create_loader(cropped_images_dir: str,
                   detections_json_path: Optional[str],
                   img_size: int,
@@ -93,26 +108,28 @@ def create_loader(cropped_images_dir: str,
             js = json.load(f)
         detections = {img['file']: img for img in js['images']}
 
+        # list each directory of crops once, rather than checking whether each
+        # crop exists, which is slow for millions of crops (especially on
+        # network drives)
+        dir_contents: Dict[str, Set[str]] = {}
+
         for img_file, info_dict in tqdm(detections.items()):
             if 'detections' not in info_dict:
                 continue
             for i in range(len(info_dict['detections'])):
                 crop_filename = img_file + f'___crop{i:02d}_mdv4.1.jpg'
-                crop_path = os.path.join(cropped_images_dir, crop_filename)
-                if os.path.exists(crop_path):
+                crop_dir, crop_name = os.path.split(
+                    os.path.join(cropped_images_dir, crop_filename))
+                if crop_dir not in dir_contents:
+                    try:
+                        dir_contents[crop_dir] = set(os.listdir(crop_dir))
+                    except FileNotFoundError:
+                        dir_contents[crop_dir] = set()
+                if crop_name in dir_contents[crop_dir]:
                     crop_files.append(crop_filename)
 
-    transform = tv.transforms.Compose([
-        # resizes smaller edge to img_size
-        tv.transforms.Resize(img_size, interpolation=PIL.Image.BICUBIC),
-        tv.transforms.CenterCrop(img_size),
-        tv.transforms.ToTensor(),
-        tv.transforms.Normalize(mean=train_classifier.MEANS,
-                                std=train_classifier.STDS, inplace=True)
-    ])
-
     dataset = SimpleDataset(img_files=crop_files, images_dir=cropped_images_dir,
-                            transform=transform)
+                            transform=create_transform(img_size))
     assert len(dataset) > 0
     loader = torch.utils.data.DataLoader(
         dataset, batch_size=batch_size, num_workers=num_workers,
@@ -122,12 +139,13 @@ def create_loader(cropped_images_dir: str,
 
 def main(model_path: str,
          cropped_images_dir: str,
-         output_csv_path: str,
+         output_path: str,
          detections_json_path: Optional[str],
          classifier_categories_json_path: Optional[str],
          img_size: int,
          batch_size: int,
-         num_workers: int) -> None:
+         num_workers: int,
+         probs_dtype: str = 'float32') -> None:
     """Main function."""
     # evaluating with accimage is much faster than Pillow or Pillow-SIMD
     tv.set_image_backend('accimage')
@@ -149,48 +167,77 @@ def main(model_path: str,
     model = torch.jit.load(model_path)
     model, device = train_classifier.prep_device(model)
 
-    test_epoch(model, loader, device=device, label_names=label_names,
-               output_csv_path=output_csv_path)
+    start = time.time()
+    num_crops = test_epoch(model, loader, device=device,
+                           label_names=label_names, output_path=output_path,
+                           probs_dtype=probs_dtype)
+    elapsed = time.time() - start
+    print(f'Classified {num_crops} crops in {elapsed:.1f}s '
+          f'({num_crops / elapsed:.1f} crops/s)')
 
 
 def test_epoch(model: torch.nn.Module,
-               loader: torch.utils.data.DataLoader,
+               loader: Iterable[Tuple[torch.Tensor, Sequence[str]]],
                device: torch.device,
                label_names: Optional[Sequence[str]],
-               output_csv_path: str) -> None:
+               output_path: str,
+               probs_dtype: str = 'float32') -> int:
     """Runs for 1 epoch.
 
-    Writes results to the output CSV in batches.
+    Writes results in batches, either to a CSV file (if output_path ends in
+    .csv or .csv.gz) or to a directory of npy shards.
 
     Args:
         model: torch.nn.Module
-        loader: torch.utils.data.DataLoader
+        loader: torch.utils.data.DataLoader, or any iterable of
+            (inputs, crop paths) batches
         device: torch.device
         label_names: optional list of str, label names
-        output_csv_path: str
+        output_path: str, path to output CSV file or shards directory
+        probs_dtype: str, 'float32' or 'float16', dtype of probabilities
+            written to npy shards
+
+    Returns: int, number of crops classified
     """
     # set dropout and BN layers to eval mode
     model.eval()
 
+    write_csv = classifier_outputs.is_csv_path(output_path)
+    writer = None
     header = True
     mode = 'w'  # new file on first write
+    num_crops = 0
 
     with torch.no_grad():
         for inputs, img_files in tqdm(loader):
             inputs = inputs.to(device, non_blocking=True)
             outputs = model(inputs)
-            probs = torch.nn.functional.softmax(outputs, dim=1).cpu().numpy()
+            probs = torch.nn.functional.softmax(outputs, dim=1)
 
             if label_names is None:
                 label_names = [str(i) for i in range(probs.shape[1])]
 
-            df = pd.DataFrame(data=probs, columns=label_names,
-                              index=pd.Index(img_files, name='path'))
-            df.to_csv(output_csv_path, index=True, header=header, mode=mode)
+            if write_csv:
+                df = pd.DataFrame(data=probs.cpu().numpy(), columns=label_names,
+                                  index=pd.Index(img_files, name='path'))
+                df.to_csv(output_path, index=True, header=header, mode=mode)
+
+                if header:
+                    header = False
+                    mode = 'a'
+            else:
+                if writer is None:
+                    writer = classifier_outputs.ShardedOutputsWriter(
+                        output_path, label_names=label_names, dtype=probs_dtype)
+                # convert on the device, so we copy less data to the CPU
+                probs = probs.to(getattr(torch, probs_dtype))
+                writer.write(img_files, probs.cpu().numpy())
 
-            if header:
-                header = False
-                mode = 'a'
+            num_crops += len(img_files)
+
+    if writer is not None:
+        writer.close()
+    return num_crops
 
 
 def _parse_args() -> argparse.Namespace:
@@ -207,7 +254,9 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         'output',
         help='path to save CSV file with classifier results (can use .csv.gz '
-             'extension for compression)')
+             'extension for compression), or if the path does not end in .csv '
+             'or .csv.gz, path to a directory in which to save results as npy '
+             'shards')
     parser.add_argument(
         '-d', '--detections-json',
         help='path to detections JSON file, used to filter paths within '
@@ -226,6 +275,10 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         '--num-workers', type=int, default=8,
         help='# of workers for data loading')
+    parser.add_argument(
+        '--probs-dtype', choices=['float32', 'float16'], default='float32',
+        help='dtype of probabilities saved in npy shards, ignored for CSV '
+             'output')
     return parser.parse_args()
 
 
@@ -233,9 +286,10 @@ if __name__ == '__main__':
     args = _parse_args()
     main(model_path=args.model,
          cropped_images_dir=args.crops_dir,
-         output_csv_path=args.output,
+         output_path=args.output,
          detections_json_path=args.detections_json,
          classifier_categories_json_path=args.classifier_categories,
          img_size=args.image_size,
          batch_size=args.batch_size,
-         num_workers=args.num_workers)
+         num_workers=args.num_workers,
+         probs_dtype=args.probs_dtype)
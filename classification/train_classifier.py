@@ -8,6 +8,15 @@ non-functional.
 During training, start tensorboard from within the classification/ directory:
     tensorboard --logdir run --bind_all --samples_per_plugin scalars=0,images=0
 
+To read crops from shards packed by crop_shards.py, rather than from individual
+files in cropped_images_dir, pass --crop-shards-dir.
+
+The val and test splits are resized and center-cropped the same way every
+epoch. To decode them only once, pass --eval-cache-dir: on the first pass, the
+resized and cropped images are saved as uint8 arrays to a memory-mapped file in
+that directory, and later epochs (and evaluate_model.py) read them from there.
+The file takes (# images) * (image size)^2 * 3 bytes per split.
+
 Example usage:
     python train_classifier.py run_idfg /ssd/crops_sq \
         -m "efficientnet-b0" --pretrained --finetune --label-weighted \
@@ -16,8 +25,8 @@ Example usage:
         --logdir run_idfg
 """
 import argparse
-from collections import defaultdict
 from datetime import datetime
+import hashlib
 import json
 import os
 from typing import (Any, Callable, Dict, List, Mapping, MutableMapping,
@@ -25,16 +34,15 @@ from typing import (Any, Callable, Dict, List, Mapping, MutableMapping,
 
 import numpy as np
 import PIL.Image
-import sklearn.metrics
 import torch
 from torch.utils import tensorboard
 import torchvision as tv
 from torchvision.datasets.folder import default_loader
 import tqdm
 
-from classification import efficientnet, evaluate_model
+from classification import crop_shards, efficientnet, evaluate_model
 from classification.train_utils import (
-    HeapItem, recall_from_confusion_matrix, add_to_heap, fig_to_img,
+    HeapItem, recall_from_confusion_matrix, fig_to_img,
     imgs_with_confidences, load_dataset_csv, prefix_all_keys)
 from visualization import plot_utils
 
@@ -46,6 +54,10 @@ from visualization import plot_utils
 MEANS = np.asarray([0.485, 0.456, 0.406])
 STDS = np.asarray([0.229, 0.224, 0.225])
 
+# update the progress bar description every this many batches, which requires
+# copying metrics from the device
+DESC_UPDATE_INTERVAL = 20
+
 VALID_MODELS = sorted(
     set(efficientnet.VALID_MODELS) |
     {'resnet101', 'resnet152', 'resnet18', 'resnet34', 'resnet50'})
@@ -69,6 +81,80 @@ class AverageMeter:
         self.avg = self.sum / self.count
 
 
+class DecodedImageCache:
+    """Caches fixed-size decoded images as uint8 arrays in a memory-mapped
+    file, so that each image is only decoded and transformed once, even across
+    processes (e.g., DataLoader workers) and runs.
+
+    The cache consists of 2 .npy files:
+        <cache_path>.npy: uint8, shape [num_imgs, img_size, img_size, 3]
+        <cache_path>.filled.npy: uint8, shape [num_imgs], 1 if image i has been
+            saved to the cache, 0 otherwise
+    """
+
+    def __init__(self, cache_path: str, num_imgs: int, img_size: int):
+        """Creates a DecodedImageCache, creating the cache files if they do
+        not already exist.
+        """
+        self.imgs_path = cache_path + '.npy'
+        self.filled_path = cache_path + '.filled.npy'
+        self.shape = (num_imgs, img_size, img_size, 3)
+        if not os.path.exists(self.filled_path):
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)),
+                        exist_ok=True)
+            imgs = np.lib.format.open_memmap(
+                self.imgs_path, mode='w+', dtype=np.uint8, shape=self.shape)
+            del imgs
+            # create the "filled" file last, so the cache is only used if both
+            # files were created
+            filled = np.lib.format.open_memmap(
+                self.filled_path + '.tmp', mode='w+', dtype=np.uint8,
+                shape=(num_imgs,))
+            del filled
+            os.replace(self.filled_path + '.tmp', self.filled_path)
+        self._imgs: Optional[np.ndarray] = None
+        self._filled: Optional[np.ndarray] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_imgs'] = None
+        state['_filled'] = None
+        return state
+
+    def get(self, index: int, load_fn: Callable[[], Any]) -> np.ndarray:
+        """Returns image [index] from the cache. If it isn't cached yet, calls
+        load_fn() to get it as a PIL image or array of shape
+        [img_size, img_size, 3], and saves it to the cache.
+        """
+        if self._imgs is None or self._filled is None:
+            self._imgs = np.load(self.imgs_path, mmap_mode='r+')
+            self._filled = np.load(self.filled_path, mmap_mode='r+')
+        imgs, filled = self._imgs, self._filled
+        assert imgs.shape == self.shape
+        if filled[index]:
+            return np.array(imgs[index])
+        img = np.asarray(load_fn(), dtype=np.uint8)
+        imgs[index] = img
+        filled[index] = 1
+        return img
+
+
+def get_decoded_image_cache_path(cache_dir: str, split: str, img_size: int,
+                                 img_source: str, img_files: Sequence[str]
+                                 ) -> str:
+    """Returns the path (without extension) of the DecodedImageCache for a
+    split. The path includes a hash of the image source (directory of crops
+    or of shards) and the list of images, so that a cache is never used for a
+    different list of images.
+    """
+    h = hashlib.sha1(os.path.abspath(img_source).encode('utf-8'))
+    for img_file in img_files:
+        h.update(img_file.encode('utf-8'))
+        h.update(b'\n')
+    return os.path.join(cache_dir,
+                        f'{split}_{img_size}px_{h.hexdigest()[:16]}')
+
+
 class SimpleDataset(torch.utils.data.Dataset):
     """A simple dataset that simply returns images and labels."""
 
@@ -78,14 +164,28 @@ class SimpleDataset(torch.utils.data.Dataset):
                  sample_weights: Optional[Sequence[float]] = None,
                  img_base_dir: str = '',
                  transform: Optional[Callable[[PIL.Image.Image], Any]] = None,
-                 target_transform: Optional[Callable[[Any], Any]] = None):
-        """Creates a SimpleDataset."""
+                 target_transform: Optional[Callable[[Any], Any]] = None,
+                 img_cache: Optional[DecodedImageCache] = None,
+                 cache_transform: Optional[Callable[[PIL.Image.Image], Any]]
+                 = None):
+        """Creates a SimpleDataset.
+
+        If img_cache is given, images are transformed by cache_transform (which
+        must be deterministic, and output images of the cache's size) and
+        saved to img_cache on first use. Then transform is applied to the
+        cached uint8 arrays.
+        """
         self.img_files = img_files
         self.labels = labels
         self.sample_weights = sample_weights
         self.img_base_dir = img_base_dir
         self.transform = transform
         self.target_transform = target_transform
+        self.img_cache = img_cache
+        self.cache_transform = cache_transform
+        if img_cache is not None:
+            assert cache_transform is not None, \
+                'cache_transform is required if img_cache is given'
 
         self.len = len(img_files)
         assert len(labels) == self.len
@@ -100,7 +200,13 @@ class SimpleDataset(torch.utils.data.Dataset):
         Returns: tuple, (sample, target) or (sample, target, sample_weight)
         """
         img_file = self.img_files[index]
-        img = default_loader(os.path.join(self.img_base_dir, img_file))
+        if self.img_cache is not None:
+            cache_transform = self.cache_transform
+            assert cache_transform is not None
+            img = self.img_cache.get(
+                index, lambda: cache_transform(self.load_img(index)))
+        else:
+            img = self.load_img(index)
         if self.transform is not None:
             img = self.transform(img)
         target = self.labels[index]
@@ -110,10 +216,42 @@ class SimpleDataset(torch.utils.data.Dataset):
             return img, target, img_file, self.sample_weights[index]
         return img, target, img_file
 
+    def load_img(self, index: int) -> PIL.Image.Image:
+        """Loads image [index] as a RGB PIL image."""
+        return default_loader(
+            os.path.join(self.img_base_dir, self.img_files[index]))
+
     def __len__(self) -> int:
         return self.len
 
 
+class ShardedDataset(SimpleDataset):
+    """A SimpleDataset that reads images from shards packed by crop_shards.py,
+    instead of from individual files.
+    """
+
+    def __init__(self,
+                 img_files: Sequence[str],
+                 labels: Sequence[Any],
+                 crop_shards_dir: str,
+                 sample_weights: Optional[Sequence[float]] = None,
+                 transform: Optional[Callable[[PIL.Image.Image], Any]] = None,
+                 target_transform: Optional[Callable[[Any], Any]] = None,
+                 img_cache: Optional[DecodedImageCache] = None,
+                 cache_transform: Optional[Callable[[PIL.Image.Image], Any]]
+                 = None):
+        """Creates a ShardedDataset."""
+        super().__init__(img_files=img_files, labels=labels,
+                         sample_weights=sample_weights, transform=transform,
+                         target_transform=target_transform,
+                         img_cache=img_cache, cache_transform=cache_transform)
+        self.shards = crop_shards.CropShards(crop_shards_dir, img_files)
+
+    def load_img(self, index: int) -> PIL.Image.Image:
+        """Loads image [index] as a RGB PIL image."""
+        return self.shards.load(index)
+
+
 def create_dataloaders(
         dataset_csv_path: str,
         label_index_json_path: str,
@@ -125,7 +263,9 @@ def create_dataloaders(
         weight_by_detection_conf: Union[bool, str],
         batch_size: int,
         num_workers: int,
-        augment_train: bool
+        augment_train: bool,
+        crop_shards_dir: Optional[str] = None,
+        eval_cache_dir: Optional[str] = None
         ) -> Tuple[Dict[str, torch.utils.data.DataLoader], List[str]]:
     """
     Args:
@@ -134,6 +274,12 @@ def create_dataloaders(
             list of labels
         splits_json_path: str, path to JSON file
         augment_train: bool, whether to shuffle/augment the training set
+        crop_shards_dir: optional str, path to shards packed by
+            crop_shards.py, if given then crops are read from the shards
+            instead of from cropped_images_dir
+        eval_cache_dir: optional str, path to directory in which to cache
+            resized and cropped images from the val and test splits, see
+            DecodedImageCache
 
     Returns:
         datasets: dict, maps split to DataLoader
@@ -164,6 +310,13 @@ def create_dataloaders(
         normalize
     ])
 
+    # when caching, test_transform is split into a deterministic part whose
+    # outputs are cached, and a part applied to the cached uint8 arrays
+    test_cache_transform = tv.transforms.Compose(
+        test_transform.transforms[:2])
+    test_cached_transform = tv.transforms.Compose(
+        test_transform.transforms[2:])
+
     dataloaders = {}
     for split, locs in split_to_locs.items():
         is_train = (split == 'train') and augment_train
@@ -185,12 +338,37 @@ def create_dataloaders(
             # for normal (non-weighted) shuffling
             sampler = torch.utils.data.SubsetRandomSampler(range(len(split_df)))
 
-        dataset = SimpleDataset(
-            img_files=split_df['path'].tolist(),
-            labels=split_df['label_index'].tolist(),
-            sample_weights=weights,
-            img_base_dir=cropped_images_dir,
-            transform=train_transform if is_train else test_transform)
+        img_files = split_df['path'].tolist()
+        transform = train_transform if is_train else test_transform
+        img_cache = None
+        if eval_cache_dir is not None and split != 'train':
+            cache_path = get_decoded_image_cache_path(
+                eval_cache_dir, split=split, img_size=img_size,
+                img_source=crop_shards_dir or cropped_images_dir,
+                img_files=img_files)
+            img_cache = DecodedImageCache(
+                cache_path, num_imgs=len(img_files), img_size=img_size)
+            transform = test_cached_transform
+
+        dataset: SimpleDataset
+        if crop_shards_dir is not None:
+            dataset = ShardedDataset(
+                img_files=img_files,
+                labels=split_df['label_index'].tolist(),
+                crop_shards_dir=crop_shards_dir,
+                sample_weights=weights,
+                transform=transform,
+                img_cache=img_cache,
+                cache_transform=test_cache_transform)
+        else:
+            dataset = SimpleDataset(
+                img_files=img_files,
+                labels=split_df['label_index'].tolist(),
+                sample_weights=weights,
+                img_base_dir=cropped_images_dir,
+                transform=transform,
+                img_cache=img_cache,
+                cache_transform=test_cache_transform)
         assert len(dataset) > 0
         dataloaders[split] = torch.utils.data.DataLoader(
             dataset, batch_size=batch_size, sampler=sampler,
@@ -298,11 +476,15 @@ def main(dataset_dir: str,
          num_workers: int,
          logdir: str,
          log_extreme_examples: int,
-         seed: Optional[int] = None) -> None:
+         seed: Optional[int] = None,
+         crop_shards_dir: Optional[str] = None,
+         eval_cache_dir: Optional[str] = None) -> None:
     """Main function."""
     # input validation
     assert os.path.exists(dataset_dir)
     assert os.path.exists(cropped_images_dir)
+    if crop_shards_dir is not None:
+        assert os.path.exists(crop_shards_dir)
     if isinstance(weight_by_detection_conf, str):
         assert os.path.exists(weight_by_detection_conf)
     if isinstance(pretrained, str):
@@ -342,7 +524,9 @@ def main(dataset_dir: str,
         weight_by_detection_conf=weight_by_detection_conf,
         batch_size=batch_size,
         num_workers=num_workers,
-        augment_train=True)
+        augment_train=True,
+        crop_shards_dir=crop_shards_dir,
+        eval_cache_dir=eval_cache_dir)
 
     writer = tensorboard.SummaryWriter(logdir)
 
@@ -523,18 +707,80 @@ def log_images_with_confidence(
                         global_step=epoch)
 
 
-def track_extreme_examples(tp_heaps: Dict[int, List[HeapItem]],
-                           fp_heaps: Dict[int, List[HeapItem]],
-                           fn_heaps: Dict[int, List[HeapItem]],
+class ExtremeExamples:
+    """Tracks, for each label, the k examples with the highest priority.
+
+    Priorities and example IDs are kept on-device in [num_classes, k] buffers,
+    and each batch is merged into the buffers with a single topk(), rather than
+    pushing each example onto a per-label heap. Only examples that enter a
+    buffer are copied to the CPU; their data is kept in a dict (see
+    run_epoch()), which may be shared by several ExtremeExamples objects.
+    """
+
+    def __init__(self, num_classes: int, k: int, device: torch.device):
+        self.priorities = torch.full((num_classes, k), -np.inf, device=device)
+        self.ids = torch.full((num_classes, k), -1, dtype=torch.int64,
+                              device=device)
+
+    def update(self, classes: torch.Tensor, priorities: torch.Tensor,
+               ids: torch.Tensor) -> torch.Tensor:
+        """Adds candidate examples to the buffers.
+
+        Args:
+            classes: torch.Tensor, shape [n], label of each candidate
+            priorities: torch.Tensor, shape [n], priority of each candidate
+            ids: torch.Tensor, shape [n], type int64, ID of each candidate
+
+        Returns: torch.Tensor, IDs of candidates that entered a buffer
+        """
+        num_classes, k = self.priorities.shape
+        n = len(classes)
+        if n == 0:
+            return ids
+        # [num_classes, n], each candidate's priority in its own label's row
+        batch_priorities = torch.full((num_classes, n), -np.inf,
+                                      device=priorities.device)
+        batch_priorities[classes, torch.arange(n, device=classes.device)] = (
+            priorities.to(batch_priorities.dtype))
+        all_priorities = torch.cat([self.priorities, batch_priorities], dim=1)
+        all_ids = torch.cat([self.ids, ids.expand(num_classes, n)], dim=1)
+
+        self.priorities, top_idx = all_priorities.topk(k, dim=1)
+        self.ids = all_ids.gather(1, top_idx)
+        self.ids[self.priorities == -np.inf] = -1
+        is_new = (top_idx >= k) & (self.ids >= 0)
+        return self.ids[is_new]
+
+    def referenced_ids(self) -> torch.Tensor:
+        """Returns the IDs of all examples currently in the buffers."""
+        return self.ids[self.ids >= 0]
+
+    def to_heaps(self, example_data: Mapping[int, List[Any]]
+                 ) -> Dict[int, List[HeapItem]]:
+        """Returns a dict mapping label_id to a list of HeapItems, for each
+        label with at least 1 example, with data from example_data.
+        """
+        heaps: Dict[int, List[HeapItem]] = {}
+        priorities = self.priorities.tolist()
+        for label, ids in enumerate(self.ids.tolist()):
+            items = [HeapItem(priority=priority, data=example_data[i])
+                     for priority, i in zip(priorities[label], ids) if i >= 0]
+            if len(items) > 0:
+                heaps[label] = items
+        return heaps
+
+
+def track_extreme_examples(trackers: Mapping[str, ExtremeExamples],
+                           example_data: Dict[int, List[Any]],
+                           first_id: int,
                            inputs: torch.Tensor,
                            labels: torch.Tensor,
                            img_files: Sequence[str],
-                           logits: torch.Tensor,
-                           k: int = 5) -> None:
-    """Updates the k most extreme true-positive (tp), false-positive (fp), and
+                           logits: torch.Tensor) -> None:
+    """Updates the most extreme true-positive (tp), false-positive (fp), and
     false-negative (fn) examples with examples from this batch.
 
-    Each HeapItem's data attribute is a tuple of:
+    Each example's data is a list of:
     - img: torch.Tensor, shape [3, H, W], type float16, values in [0, 1]
     - label: int
     - top3_conf: list of float
@@ -542,35 +788,78 @@ def track_extreme_examples(tp_heaps: Dict[int, List[HeapItem]],
     - img_file: str
 
     Args:
-        *_heaps: dict, maps label_id (int) to heap of HeapItems
+        trackers: dict, maps 'tp', 'fp', 'fn' to ExtremeExamples
+        example_data: dict, maps example ID to data, updated in-place
+        first_id: int, ID of the first example in this batch, examples in the
+            batch are numbered consecutively
         inputs: torch.Tensor, shape [batch_size, 3, H, W]
         labels: torch.Tensor, shape [batch_size]
         img_files: list of str
         logits: torch.Tensor, shape [batch_size, num_classes]
-        k: int, number of examples to track
     """
     with torch.no_grad():
-        inputs = inputs.detach().to(device='cpu', dtype=torch.float16)
-        labels_list = labels.tolist()  # new var name to satisfy mypy
-        batch_probs = torch.nn.functional.softmax(logits, dim=1).cpu()
-        zipped = zip(inputs, labels_list, batch_probs, img_files)  # all on CPU
-        for img, label, confs, img_file in zipped:
-            label_conf = confs[label].item()
-
-            top3_conf, top3_preds = confs.topk(3)
-            top3_conf = top3_conf.tolist()
-            top3_preds = top3_preds.tolist()
-
-            data = [img, label, top3_conf, top3_preds, img_file]
-            if top3_preds[0] == label:  # true positive
-                item = HeapItem(priority=label_conf - top3_conf[1], data=data)
-                add_to_heap(tp_heaps[label], item, k=k)
-            else:
-                # false positive for top3_pred[0]
-                # false negative for label
-                item = HeapItem(priority=top3_conf[0] - label_conf, data=data)
-                add_to_heap(fp_heaps[top3_preds[0]], item, k=k)
-                add_to_heap(fn_heaps[label], item, k=k)
+        batch_probs = torch.nn.functional.softmax(logits.detach(), dim=1)
+        top3_conf, top3_preds = batch_probs.topk(3, dim=1)
+        label_conf = batch_probs.gather(1, labels.view(-1, 1)).squeeze(1)
+        ids = torch.arange(first_id, first_id + len(labels),
+                           device=labels.device)
+
+        is_tp = (top3_preds[:, 0] == labels)
+        tp_priority = label_conf - top3_conf[:, 1]
+        # false positive for top3_pred[0], false negative for label
+        fp_priority = top3_conf[:, 0] - label_conf
+
+        new_ids = torch.cat([
+            trackers['tp'].update(labels[is_tp], tp_priority[is_tp],
+                                  ids[is_tp]),
+            trackers['fp'].update(top3_preds[~is_tp, 0], fp_priority[~is_tp],
+                                  ids[~is_tp]),
+            trackers['fn'].update(labels[~is_tp], fp_priority[~is_tp],
+                                  ids[~is_tp])
+        ]).unique()
+        if len(new_ids) == 0:
+            return
+
+        # copy only the new examples to the CPU
+        batch_idx = new_ids - first_id
+        imgs = inputs[batch_idx].detach().to(device='cpu',
+                                             dtype=torch.float16)
+        for img, i, label, confs, preds in zip(
+                imgs, batch_idx.tolist(), labels[batch_idx].tolist(),
+                top3_conf[batch_idx].tolist(), top3_preds[batch_idx].tolist()):
+            example_data[first_id + i] = [img, label, confs, preds,
+                                          img_files[i]]
+
+        # forget examples that have been pushed out of all buffers
+        referenced = set(torch.cat([
+            tracker.referenced_ids() for tracker in trackers.values()
+        ]).tolist())
+        for i in list(example_data.keys()):
+            if i not in referenced:
+                del example_data[i]
+
+
+def correct_counts(outputs: torch.Tensor, labels: torch.Tensor,
+                   weights: Optional[torch.Tensor] = None,
+                   top: Sequence[int] = (1,)) -> torch.Tensor:
+    """Like correct(), but returns the counts as a tensor on the same device
+    as outputs, so they can be accumulated without synchronizing with the
+    device.
+
+    Returns: torch.Tensor, shape [len(top)], (weighted) # of correct
+        predictions @ each k in top
+    """
+    with torch.no_grad():
+        # preds and labels both have shape [N, k]
+        _, preds = outputs.topk(k=max(top), dim=1, largest=True, sorted=True)
+        labels = labels.view(-1, 1).expand_as(preds)
+
+        corrects = preds.eq(labels).cumsum(dim=1)  # shape [N, k]
+        if weights is None:
+            corrects = corrects.sum(dim=0)  # shape [k]
+        else:
+            corrects = weights.matmul(corrects.to(weights.dtype))  # shape [k]
+        return corrects[[k - 1 for k in top]]
 
 
 def correct(outputs: torch.Tensor, labels: torch.Tensor,
@@ -586,18 +875,8 @@ def correct(outputs: torch.Tensor, labels: torch.Tensor,
 
     Returns: dict, maps k to (weighted) # of correct predictions @ each k
     """
-    with torch.no_grad():
-        # preds and labels both have shape [N, k]
-        _, preds = outputs.topk(k=max(top), dim=1, largest=True, sorted=True)
-        labels = labels.view(-1, 1).expand_as(preds)
-
-        corrects = preds.eq(labels).cumsum(dim=1)  # shape [N, k]
-        if weights is None:
-            corrects = corrects.sum(dim=0)  # shape [k]
-        else:
-            corrects = weights.matmul(corrects.to(weights.dtype))  # shape [k]
-        tops = {k: corrects[k - 1].item() for k in top}
-    return tops
+    corrects = correct_counts(outputs, labels, weights=weights, top=top)
+    return dict(zip(top, corrects.tolist()))
 
 
 def run_epoch(model: torch.nn.Module,
@@ -634,8 +913,9 @@ def run_epoch(model: torch.nn.Module,
                 only included if loss_fn is not None
             'acc_top{k}': float, accuracy@k over the entire epoch
         heaps: dict, keys are ['tp', 'fp', 'fn'], values are heap_dicts,
-            each heap_dict maps label_id (int) to a heap of <= 5 HeapItems with
-            data attribute (img, target, top3_conf, top3_preds, img_file)
+            each heap_dict maps label_id (int) to a list of <= k_extreme
+            HeapItems with data attribute
+            (img, target, top3_conf, top3_preds, img_file)
             - 'tp': priority is the difference between target confidence and
                 2nd highest confidence
             - 'fp': priority is the difference between highest confidence and
@@ -650,23 +930,21 @@ def run_epoch(model: torch.nn.Module,
     # if evaluating or finetuning, set dropout and BN layers to eval mode
     model.train(optimizer is not None and not finetune)
 
-    if loss_fn is not None:
-        losses = AverageMeter()
-    accuracies_topk = {k: AverageMeter() for k in top}  # acc@k
+    # metrics are accumulated on the device, and only copied to the CPU to
+    # update the progress bar every DESC_UPDATE_INTERVAL batches
+    loss_sum = torch.zeros((), device=device)
+    correct_sums = torch.zeros(len(top), device=device)
+    confusion_matrix = None  # created once we know the number of classes
+    num_examples = 0
 
     # for each label, track k_extreme most-confident and least-confident images
     if k_extreme > 0:
-        tp_heaps: Dict[int, List[HeapItem]] = defaultdict(list)
-        fp_heaps: Dict[int, List[HeapItem]] = defaultdict(list)
-        fn_heaps: Dict[int, List[HeapItem]] = defaultdict(list)
-
-    all_labels = np.zeros(len(loader.dataset), dtype=np.int32)
-    all_preds = np.zeros_like(all_labels)
-    end_i = 0
+        trackers: Dict[str, ExtremeExamples] = {}
+        example_data: Dict[int, List[Any]] = {}
 
     tqdm_loader = tqdm.tqdm(loader)
     with torch.set_grad_enabled(optimizer is not None):
-        for batch in tqdm_loader:
+        for batch_num, batch in enumerate(tqdm_loader):
             if weighted:
                 inputs, labels, img_files, weights = batch
                 weights = weights.to(device, non_blocking=True)
@@ -676,52 +954,73 @@ def run_epoch(model: torch.nn.Module,
                 weights = None
 
             inputs = inputs.to(device, non_blocking=True)
-
+            labels = labels.to(device, non_blocking=True)
             batch_size = labels.size(0)
-            start_i = end_i
-            end_i = start_i + batch_size
-            all_labels[start_i:end_i] = labels
 
-            desc = []
-            labels = labels.to(device, non_blocking=True)
             outputs = model(inputs)
-            all_preds[start_i:end_i] = outputs.detach().argmax(dim=1).cpu()
+            num_classes = outputs.size(1)
 
             if loss_fn is not None:
                 loss = loss_fn(outputs, labels)
                 if weights is not None:
                     loss *= weights
                 loss = loss.mean()
-                losses.update(loss.item(), n=batch_size)
-                desc.append(f'Loss {losses.val:.4f} ({losses.avg:.4f})')
+                loss_sum += loss.detach() * batch_size
             if optimizer is not None:
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
 
-            top_correct = correct(outputs, labels, weights=weights, top=top)
-            for k, acc in accuracies_topk.items():
-                acc.update(top_correct[k] * (100. / batch_size), n=batch_size)
-                desc.append(f'Acc@{k} {acc.val:.3f} ({acc.avg:.3f})')
-            tqdm_loader.set_description(' '.join(desc))
+            correct_sums += correct_counts(outputs, labels, weights=weights,
+                                           top=top)
 
-            if k_extreme > 0:
-                track_extreme_examples(tp_heaps, fp_heaps, fn_heaps, inputs,
-                                       labels, img_files, outputs, k=k_extreme)
+            # C[i, j] = # of samples with true label i, predicted as label j
+            preds = outputs.detach().argmax(dim=1)
+            batch_cm = torch.bincount(labels * num_classes + preds,
+                                      minlength=num_classes ** 2)
+            if confusion_matrix is None:
+                confusion_matrix = batch_cm
+            else:
+                confusion_matrix += batch_cm
 
-    num_classes = outputs.size(1)
-    confusion_matrix = sklearn.metrics.confusion_matrix(
-        all_labels, all_preds, labels=np.arange(num_classes))
+            if k_extreme > 0:
+                if len(trackers) == 0:
+                    trackers = {
+                        heap_type: ExtremeExamples(num_classes, k=k_extreme,
+                                                   device=device)
+                        for heap_type in ['tp', 'fp', 'fn']
+                    }
+                track_extreme_examples(trackers, example_data, num_examples,
+                                       inputs, labels, img_files, outputs)
+
+            num_examples += batch_size
+
+            if batch_num % DESC_UPDATE_INTERVAL == 0:
+                desc = []
+                if loss_fn is not None:
+                    desc.append(f'Loss {loss.item():.4f} '
+                                f'({loss_sum.item() / num_examples:.4f})')
+                accs = (correct_sums * (100. / num_examples)).tolist()
+                for k, acc in zip(top, accs):
+                    desc.append(f'Acc@{k} {acc:.3f}')
+                tqdm_loader.set_description(' '.join(desc))
+
+    assert confusion_matrix is not None, 'loader yielded no batches'
+    confusion_matrix = confusion_matrix.view(num_classes, num_classes)
 
     metrics = {}
     if loss_fn is not None:
-        metrics['loss'] = losses.avg
-    for k, acc in accuracies_topk.items():
-        metrics[f'acc_top{k}'] = acc.avg
+        metrics['loss'] = loss_sum.item() / num_examples
+    accs = (correct_sums * (100. / num_examples)).tolist()
+    for k, acc in zip(top, accs):
+        metrics[f'acc_top{k}'] = acc
     heaps = None
     if k_extreme > 0:
-        heaps = {'tp': tp_heaps, 'fp': fp_heaps, 'fn': fn_heaps}
-    return metrics, heaps, confusion_matrix
+        heaps = {
+            heap_type: tracker.to_heaps(example_data)
+            for heap_type, tracker in trackers.items()
+        }
+    return metrics, heaps, confusion_matrix.cpu().numpy()
 
 
 def _parse_args() -> argparse.Namespace:
@@ -781,6 +1080,15 @@ def _parse_args() -> argparse.Namespace:
     parser.add_argument(
         '--seed', type=int,
         help='random seed')
+    parser.add_argument(
+        '--crop-shards-dir',
+        help='path to directory of crops packed by crop_shards.py, if given '
+             'then crops are read from the shards instead of from '
+             'cropped_images_dir')
+    parser.add_argument(
+        '--eval-cache-dir',
+        help='path to directory in which to cache resized and cropped images '
+             'from the val and test splits, so they are only decoded once')
     return parser.parse_args()
 
 
@@ -803,4 +1111,6 @@ if __name__ == '__main__':
          num_workers=args.num_workers,
          logdir=args.logdir,
          log_extreme_examples=args.log_extreme_examples,
-         seed=args.seed)
+         seed=args.seed,
+         crop_shards_dir=args.crop_shards_dir,
+         eval_cache_dir=args.eval_cache_dir)
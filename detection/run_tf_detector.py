@@ -114,8 +114,9 @@ class ImagePathUtils:
 class TFDetector:
     """
     A detector model loaded at the time of initialization. It is intended to be used with
-    the MegaDetector (TF). The inference batch size is set to 1; code needs to be modified
-    to support larger batch sizes, including resizing appropriately.
+    the MegaDetector (TF). generate_detections_one_image() runs inference with a batch
+    size of 1; generate_detections_batch() stacks images of identical dimensions into
+    larger batches.
     """
 
     # Number of decimal places to round to for confidence and bbox coordinates
@@ -123,7 +124,8 @@ class TFDetector:
     COORD_DIGITS = 4
 
     # MegaDetector was trained with batch size of 1, and the resizing function is a part
-    # of the inference graph
+    # of the inference graph, so only images with the same dimensions can be stacked
+    # into one batch; this is the default for generate_detections_batch()
     BATCH_SIZE = 1
 
     # An enumeration of failure reasons
@@ -219,10 +221,6 @@ class TFDetector:
         np_im = np.asarray(image, np.uint8)
         im_w_batch_dim = np.expand_dims(np_im, axis=0)
 
-        # need to change the above line to the following if supporting a batch size > 1 and resizing to the same size
-        # np_images = [np.asarray(image, np.uint8) for image in images]
-        # images_stacked = np.stack(np_images, axis=0) if len(images) > 1 else np.expand_dims(np_images[0], axis=0)
-
         # performs inference
         (box_tensor_out, score_tensor_out, class_tensor_out) = self.tf_session.run(
             [self.box_tensor, self.score_tensor, self.class_tensor],
@@ -230,6 +228,44 @@ class TFDetector:
 
         return box_tensor_out, score_tensor_out, class_tensor_out
 
+    def _generate_detections_batch(self, images):
+        """Runs inference on a list of PIL images that all have the same dimensions."""
+        np_images = [np.asarray(image, np.uint8) for image in images]
+        images_stacked = np.stack(np_images, axis=0)
+
+        # performs inference; the batch dimension of each output matches images
+        (box_tensor_out, score_tensor_out, class_tensor_out) = self.tf_session.run(
+            [self.box_tensor, self.score_tensor, self.class_tensor],
+            feed_dict={self.image_tensor: images_stacked})
+
+        return box_tensor_out, score_tensor_out, class_tensor_out
+
+    @staticmethod
+    def _make_result(image_id, boxes, scores, classes, detection_threshold):
+        """Converts the model outputs for one image (with the batch dimension already
+        removed) to the API output format; see generate_detections_one_image().
+        """
+        detections_cur_image = []  # will be empty for an image with no confident detections
+        max_detection_conf = 0.0
+        for b, s, c in zip(boxes, scores, classes):
+            if s > detection_threshold:
+                detection_entry = {
+                    'category': str(int(c)),  # use string type for the numerical class label, not int
+                    'conf': truncate_float(float(s),  # cast to float for json serialization
+                                           precision=TFDetector.CONF_DIGITS),
+                    'bbox': TFDetector.__convert_coords(b)
+                }
+                detections_cur_image.append(detection_entry)
+                if s > max_detection_conf:
+                    max_detection_conf = s
+
+        return {
+            'file': image_id,
+            'max_detection_conf': truncate_float(float(max_detection_conf),
+                                                 precision=TFDetector.CONF_DIGITS),
+            'detections': detections_cur_image
+        }
+
     def generate_detections_one_image(self, image, image_id,
                                       detection_threshold=DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD):
         """Apply the detector to an image.
@@ -246,39 +282,81 @@ class TFDetector:
             - 'detections', which is a list of detection objects containing keys 'category', 'conf' and 'bbox'
             - 'failure'
         """
-        result = {
-            'file': image_id
-        }
         try:
             b_box, b_score, b_class = self._generate_detections_one_image(image)
 
-            # our batch size is 1; need to loop the batch dim if supporting batch size > 1
-            boxes, scores, classes = b_box[0], b_score[0], b_class[0]
-
-            detections_cur_image = []  # will be empty for an image with no confident detections
-            max_detection_conf = 0.0
-            for b, s, c in zip(boxes, scores, classes):
-                if s > detection_threshold:
-                    detection_entry = {
-                        'category': str(int(c)),  # use string type for the numerical class label, not int
-                        'conf': truncate_float(float(s),  # cast to float for json serialization
-                                               precision=TFDetector.CONF_DIGITS),
-                        'bbox': TFDetector.__convert_coords(b)
-                    }
-                    detections_cur_image.append(detection_entry)
-                    if s > max_detection_conf:
-                        max_detection_conf = s
-
-            result['max_detection_conf'] = truncate_float(float(max_detection_conf),
-                                                          precision=TFDetector.CONF_DIGITS)
-            result['detections'] = detections_cur_image
+            # our batch size is 1
+            result = TFDetector._make_result(image_id, b_box[0], b_score[0], b_class[0],
+                                             detection_threshold)
 
         except Exception as e:
-            result['failure'] = TFDetector.FAILURE_TF_INFER
+            result = {
+                'file': image_id,
+                'failure': TFDetector.FAILURE_TF_INFER
+            }
             print('TFDetector: image {} failed during inference: {}'.format(image_id, str(e)))
 
         return result
 
+    def generate_detections_batch(self, images, image_ids,
+                                  detection_threshold=DEFAULT_OUTPUT_CONFIDENCE_THRESHOLD,
+                                  batch_size=BATCH_SIZE, resize_to=None):
+        """Apply the detector to a list of images, with one inference call per batch.
+
+        A batch tensor has a single shape, so images are grouped into buckets by their
+        (width, height), and each bucket is run in chunks of at most batch_size images.
+        If resize_to is specified, every image is first resized to that (width, height)
+        so that all images share one bucket. Box coordinates are normalized, so they
+        remain valid for the original image, but note that resizing changes what the
+        model sees and may change the detections.
+
+        Args:
+            images: list of PIL Image objects
+            image_ids: list of str, in the same order as images; will be in the "file"
+                field of the output objects
+            detection_threshold: confidence above which to include the detection proposal
+            batch_size: int, maximum number of images per inference call
+            resize_to: optional tuple (width, height)
+
+        Returns: list of dict, one per image and in the same order as images, in the
+            format returned by generate_detections_one_image(). If an inference call
+            fails, every image in that batch gets a 'failure' entry.
+        """
+        assert len(images) == len(image_ids), 'images and image_ids need to be the same length'
+        assert batch_size > 0, 'batch_size needs to be > 0'
+
+        # (width, height) -> list of indices into images
+        buckets = {}
+        resized_images = []
+        for i_image, image in enumerate(images):
+            if resize_to is not None and image.size != tuple(resize_to):
+                image = viz_utils.resize_image(image, resize_to[0], resize_to[1])
+            resized_images.append(image)
+            buckets.setdefault(image.size, []).append(i_image)
+
+        results = [None] * len(images)
+        for indices in buckets.values():
+            for i_start in range(0, len(indices), batch_size):
+                batch_indices = indices[i_start:i_start + batch_size]
+                try:
+                    b_box, b_score, b_class = self._generate_detections_batch(
+                        [resized_images[i] for i in batch_indices])
+                except Exception as e:
+                    print('TFDetector: batch of {} images starting with {} failed during inference: {}'.format(
+                        len(batch_indices), image_ids[batch_indices[0]], str(e)))
+                    for i in batch_indices:
+                        results[i] = {
+                            'file': image_ids[i],
+                            'failure': TFDetector.FAILURE_TF_INFER
+                        }
+                    continue
+
+                for i_batch, i in enumerate(batch_indices):
+                    results[i] = TFDetector._make_result(image_ids[i], b_box[i_batch], b_score[i_batch],
+                                                         b_class[i_batch], detection_threshold)
+
+        return results
+
 
 #%% Main function
 
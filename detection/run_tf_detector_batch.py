@@ -15,12 +15,28 @@ are processed and final results file written to output_file,
 the temporary checkpoint file will be deleted. If you want to resume from a checkpoint,
 set the checkpoint file's path using --resume_from_checkpoint.
 
+By default, each checkpoint rewrites all results so far to a JSON file, which gets slow
+for long jobs. With --checkpoint_format jsonl, one JSON line is appended to the checkpoint
+file as each image finishes, and the file is flushed to disk every n images instead;
+--resume_from_checkpoint accepts either format.
+
 The `threshold` you can provide as an argument is the confidence threshold above which detections
 will be included in the output file.
 
-Has preliminary multiprocessing support for CPUs only; if a GPU is available, it will
-use the GPU instead of CPUs, and the --ncores option will be ignored.  Checkpointing
-is not supported when using multiprocessing.
+Use --batch_size to run more than one image per inference call. Images are grouped
+by their dimensions, since only images of the same size can be stacked into one batch;
+on CPU, this amortizes the per-call overhead of the TensorFlow session.
+
+Use --n_decode_threads to run in pipeline mode: a pool of threads reads and decodes
+images into a bounded queue while the main thread runs inference, so that the model
+does not sit idle waiting on disk or JPEG decoding. In this mode the time spent in each
+stage (read, decode, infer, serialize) is reported at the end.
+
+Has multiprocessing support for CPUs only; if a GPU is available, it will use the GPU
+instead of CPUs, and the --ncores option will be ignored. With --ncores > 1, each worker
+process loads the model once and takes small chunks of images (--chunk_size) as it
+becomes free; results stream back to the main process, which writes checkpoints and
+skips images already in --resume_from_checkpoint as in the single-process case.
 
 Sample invocation:
 
@@ -36,10 +52,15 @@ import sys
 import time
 import copy
 import warnings
-import itertools
+import queue
+import statistics
+import threading
 
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from functools import partial
+from io import BytesIO
 
 import humanfriendly
 from tqdm import tqdm
@@ -57,16 +78,106 @@ import tensorflow as tf
 print('TensorFlow version:', tf.__version__)
 print('tf.test.is_gpu_available:', tf.test.is_gpu_available())
 
+# Number of images per task handed to a worker process when using multiprocessing
+DEFAULT_CHUNK_SIZE = 50
+
+# Checkpoint paths ending with this extension are written by appending one JSON line per image
+JSONL_CHECKPOINT_EXTENSION = '.jsonl'
+
+
+#%% Classes
+
+class ImageSizeBucketQueue:
+    """
+    Holds loaded images until enough images with the same dimensions are available to
+    fill an inference batch. The total number of images held is bounded by max_pending;
+    when it is reached, the largest bucket is released even if it is not full.
+    """
+
+    def __init__(self, batch_size, max_pending=None):
+        """
+        Args
+        - batch_size: int, number of images per inference batch
+        - max_pending: int, maximum number of images to hold; defaults to 4 * batch_size
+        """
+        self.batch_size = batch_size
+        self.max_pending = max_pending if max_pending is not None else 4 * batch_size
+        assert self.max_pending >= self.batch_size, 'max_pending needs to be >= batch_size'
+
+        # (width, height) -> list of (im_file, image) tuples
+        self.buckets = defaultdict(list)
+        self.n_pending = 0
+
+    def put(self, im_file, image):
+        """Adds a loaded image; returns a list of (im_file, image) tuples ready to be run as
+        one batch, or None if no batch is ready yet.
+        """
+        bucket = self.buckets[image.size]
+        bucket.append((im_file, image))
+        self.n_pending += 1
+
+        if len(bucket) >= self.batch_size:
+            return self._pop(image.size)
+        if self.n_pending >= self.max_pending:
+            return self._pop(max(self.buckets, key=lambda size: len(self.buckets[size])))
+        return None
+
+    def drain(self):
+        """Yields all remaining (possibly partial) batches."""
+        for size in list(self.buckets.keys()):
+            yield self._pop(size)
+
+    def _pop(self, size):
+        batch = self.buckets.pop(size)
+        self.n_pending -= len(batch)
+        return batch
+
+
+class StageTimer:
+    """
+    Accumulates the time spent in each stage of processing (e.g. 'read', 'decode',
+    'infer', 'serialize'). Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        # stage name -> list of elapsed seconds
+        self.times = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, stage, elapsed):
+        with self.lock:
+            self.times[stage].append(elapsed)
+
+    @contextmanager
+    def time(self, stage):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - start_time)
+
+    def print_summary(self):
+        """Prints the total and per-call time for each stage. Stages run on several
+        threads at once (read and decode) can have a total larger than the wall-clock time.
+        """
+        print('Time spent in each stage:')
+        with self.lock:
+            for stage, times in self.times.items():
+                print('- {}: {} in total over {} calls, {} per call on average'.format(
+                    stage, humanfriendly.format_timespan(sum(times)), len(times),
+                    humanfriendly.format_timespan(statistics.mean(times))))
+
 
 #%% Support functions for multiprocessing
 
-def process_images(im_files, tf_detector, confidence_threshold):
+def process_images(im_files, tf_detector, confidence_threshold, batch_size=1):
     """Runs the MegaDetector over a list of image files.
 
     Args
     - im_files: list of str, paths to image files
     - tf_detector: TFDetector (loaded model) or str (path to .pb model file)
     - confidence_threshold: float, only detections above this threshold are returned
+    - batch_size: int, number of images of the same size per inference call
 
     Returns
     - results: list of dict, each dict represents detections on one image
@@ -78,6 +189,9 @@ def process_images(im_files, tf_detector, confidence_threshold):
         elapsed = time.time() - start_time
         print('Loaded model (batch level) in {}'.format(humanfriendly.format_timespan(elapsed)))
 
+    if batch_size > 1:
+        return process_images_batched(im_files, tf_detector, confidence_threshold, batch_size)
+
     results = []
     for im_file in im_files:
         results.append(process_image(im_file, tf_detector, confidence_threshold))
@@ -97,145 +211,442 @@ def process_image(im_file, tf_detector, confidence_threshold):
         see the 'images' key in https://github.com/microsoft/CameraTraps/tree/master/api/batch_processing#batch-processing-api-output-format
     """
     print('Processing image {}'.format(im_file))
+    image = load_image_or_failure(im_file)
+    if isinstance(image, dict):
+        return image
+
     try:
-        image = viz_utils.load_image(im_file)
+        result = tf_detector.generate_detections_one_image(
+            image, im_file, detection_threshold=confidence_threshold)
     except Exception as e:
-        print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
+        print('Image {} cannot be processed. Exception: {}'.format(im_file, e))
         result = {
             'file': im_file,
-            'failure': TFDetector.FAILURE_IMAGE_OPEN
+            'failure': TFDetector.FAILURE_TF_INFER
         }
         return result
 
+    return result
+
+
+def load_image_or_failure(im_file):
+    """Loads an image file; returns the PIL image, or a failure result dict if the
+    image cannot be loaded.
+    """
     try:
-        result = tf_detector.generate_detections_one_image(
-            image, im_file, detection_threshold=confidence_threshold)
+        return viz_utils.load_image(im_file)
     except Exception as e:
-        print('Image {} cannot be processed. Exception: {}'.format(im_file, e))
+        print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
         result = {
             'file': im_file,
-            'failure': TFDetector.FAILURE_TF_INFER
+            'failure': TFDetector.FAILURE_IMAGE_OPEN
         }
         return result
 
-    return result
+
+def process_image_batch(batch, tf_detector, confidence_threshold):
+    """Runs the MegaDetector over a list of (im_file, image) tuples of loaded images,
+    all with the same dimensions, in one inference call.
+
+    Returns
+    - results: list of dict, in the same order as batch
+    """
+    print('Processing a batch of {} images starting with {}'.format(len(batch), batch[0][0]))
+    im_files = [im_file for im_file, _ in batch]
+    images = [image for _, image in batch]
+    return tf_detector.generate_detections_batch(
+        images, im_files, detection_threshold=confidence_threshold, batch_size=len(batch))
+
+
+def process_images_batched(im_files, tf_detector, confidence_threshold, batch_size,
+                           result_callback=None):
+    """Runs the MegaDetector over a list of image files, stacking images of the same
+    dimensions into batches of up to batch_size images.
+
+    Args
+    - im_files: iterable of str, paths to image files
+    - tf_detector: TFDetector, loaded model
+    - confidence_threshold: float, only detections above this threshold are returned
+    - batch_size: int, number of images of the same size per inference call
+    - result_callback: optional function called with each list of new results as
+        they become available, e.g. to write checkpoints
+
+    Returns
+    - results: list of dict, not necessarily in the order of im_files
+    """
+    results = []
+
+    def add_results(new_results):
+        results.extend(new_results)
+        if result_callback is not None:
+            result_callback(new_results)
+
+    bucket_queue = ImageSizeBucketQueue(batch_size)
+    for im_file in im_files:
+        image = load_image_or_failure(im_file)
+        if isinstance(image, dict):
+            add_results([image])
+            continue
+        batch = bucket_queue.put(im_file, image)
+        if batch is not None:
+            add_results(process_image_batch(batch, tf_detector, confidence_threshold))
+
+    for batch in bucket_queue.drain():
+        add_results(process_image_batch(batch, tf_detector, confidence_threshold))
+
+    return results
+
+
+def read_and_decode_image(im_file, stage_timer):
+    """Reads an image file into memory and decodes it, recording the time spent in the
+    'read' and 'decode' stages separately.
+
+    Returns: the PIL image, or a failure result dict if the image cannot be loaded
+    """
+    try:
+        with stage_timer.time('read'):
+            with open(im_file, 'rb') as f:
+                image_bytes = BytesIO(f.read())
+        with stage_timer.time('decode'):
+            image = viz_utils.load_image(image_bytes)
+    except Exception as e:
+        print('Image {} cannot be loaded. Exception: {}'.format(im_file, e))
+        return {
+            'file': im_file,
+            'failure': TFDetector.FAILURE_IMAGE_OPEN
+        }
+    return image
 
 
-def chunks_by_number_of_chunks(ls, n):
-    """Splits a list into n even chunks.
+def process_images_pipelined(im_files, tf_detector, confidence_threshold, batch_size=1,
+                             n_decode_threads=4, max_queued_images=None,
+                             result_callback=None, stage_timer=None):
+    """Runs the MegaDetector over a list of image files, with a pool of threads reading
+    and decoding images into a bounded queue while the calling thread runs inference.
+    PIL releases the GIL while decoding, so decoding overlaps with inference.
+
+    Args
+    - im_files: iterable of str, paths to image files
+    - tf_detector: TFDetector, loaded model
+    - confidence_threshold: float, only detections above this threshold are returned
+    - batch_size: int, number of images of the same size per inference call
+    - n_decode_threads: int, number of threads reading and decoding images
+    - max_queued_images: int, maximum number of decoded images waiting for inference;
+        defaults to twice the larger of batch_size and n_decode_threads
+    - result_callback: optional function called with each list of new results as
+        they become available, e.g. to write checkpoints
+    - stage_timer: optional StageTimer to record the time spent in each stage
+
+    Returns
+    - results: list of dict, not necessarily in the order of im_files
+    """
+    assert n_decode_threads > 0, 'n_decode_threads needs to be > 0'
+    if max_queued_images is None:
+        max_queued_images = 2 * max(batch_size, n_decode_threads)
+    if stage_timer is None:
+        stage_timer = StageTimer()
+
+    results = []
+
+    def add_results(new_results):
+        results.extend(new_results)
+        if result_callback is not None:
+            result_callback(new_results)
+
+    # Items are (im_file, image or failure dict); each decoder thread puts None when done
+    image_queue = queue.Queue(maxsize=max_queued_images)
+    im_file_iter = iter(im_files)
+    im_file_iter_lock = threading.Lock()
+
+    def decode_images():
+        while True:
+            with im_file_iter_lock:
+                im_file = next(im_file_iter, None)
+            if im_file is None:
+                image_queue.put(None)
+                return
+            image_queue.put((im_file, read_and_decode_image(im_file, stage_timer)))
+
+    decoder_threads = [threading.Thread(target=decode_images, daemon=True)
+                       for _ in range(n_decode_threads)]
+    for thread in decoder_threads:
+        thread.start()
+
+    bucket_queue = ImageSizeBucketQueue(batch_size) if batch_size > 1 else None
+    n_threads_finished = 0
+    while n_threads_finished < n_decode_threads:
+        # time the inference thread spends idle, waiting on reading and decoding
+        with stage_timer.time('wait'):
+            item = image_queue.get()
+        if item is None:
+            n_threads_finished += 1
+            continue
+
+        im_file, image = item
+        if isinstance(image, dict):
+            add_results([image])
+            continue
+
+        if bucket_queue is None:
+            print('Processing image {}'.format(im_file))
+            with stage_timer.time('infer'):
+                result = tf_detector.generate_detections_one_image(
+                    image, im_file, detection_threshold=confidence_threshold)
+            add_results([result])
+        else:
+            batch = bucket_queue.put(im_file, image)
+            if batch is not None:
+                with stage_timer.time('infer'):
+                    new_results = process_image_batch(batch, tf_detector, confidence_threshold)
+                add_results(new_results)
+
+    if bucket_queue is not None:
+        for batch in bucket_queue.drain():
+            with stage_timer.time('infer'):
+                new_results = process_image_batch(batch, tf_detector, confidence_threshold)
+            add_results(new_results)
+
+    for thread in decoder_threads:
+        thread.join()
+
+    return results
+
+
+# The TFDetector loaded by each worker process in the pool initializer
+worker_tf_detector = None
+
+
+def init_worker(model_file):
+    """Pool initializer; loads the model once per worker process."""
+    global worker_tf_detector
+    start_time = time.time()
+    worker_tf_detector = TFDetector(model_file)
+    elapsed = time.time() - start_time
+    print('Loaded model (worker {}) in {}'.format(os.getpid(), humanfriendly.format_timespan(elapsed)))
+
+
+def process_images_in_worker(im_files, confidence_threshold, batch_size=1):
+    """Runs the model loaded by init_worker() over a list of image files."""
+    return process_images(im_files, worker_tf_detector, confidence_threshold, batch_size=batch_size)
+
+
+def chunks_by_size(ls, chunk_size):
+    """Splits a list into chunks of chunk_size items; the last chunk may be shorter.
 
     Args
     - ls: list
-    - n: int, # of chunks
+    - chunk_size: int, # of items per chunk
+    """
+    for i in range(0, len(ls), chunk_size):
+        yield ls[i:i + chunk_size]
+
+
+def load_checkpoint(checkpoint_path):
+    """Loads the results saved in a checkpoint file, either a JSON file with an 'images'
+    field or a JSONL file with one result per line.
+
+    Returns
+    - results: list of dict, each dict represents detections on one image
+    """
+    if checkpoint_path.endswith(JSONL_CHECKPOINT_EXTENSION):
+        return list(read_jsonl_checkpoint(checkpoint_path))
+
+    with open(checkpoint_path) as f:
+        saved = json.load(f)
+    assert 'images' in saved, \
+        'The file saved as checkpoint does not have the correct fields; cannot be restored'
+    return saved['images']
+
+
+def read_jsonl_checkpoint(checkpoint_path):
+    """Yields the results in a JSONL checkpoint file one at a time. A truncated last line,
+    left by a crash in the middle of a write, is skipped.
     """
-    for i in range(0, n):
-        yield ls[i::n]
+    with open(checkpoint_path) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                print('Skipping a truncated line at the end of checkpoint {}'.format(checkpoint_path))
+                break
+            yield json.loads(line)
 
 
 #%% Main function
 
 def load_and_run_detector_batch(model_file, image_file_names, checkpoint_path=None,
                                 confidence_threshold=0, checkpoint_frequency=-1,
-                                results=None, n_cores=0):
+                                results=None, n_cores=0, batch_size=1,
+                                n_decode_threads=0, stage_timer=None,
+                                chunk_size=DEFAULT_CHUNK_SIZE):
     """
     Args
     - model_file: str, path to .pb model file
     - image_file_names: list of str, paths to image files
-    - checkpoint_path: str, path to JSON checkpoint file
+    - checkpoint_path: str, path to JSON checkpoint file; if it ends in .jsonl, each result
+        is appended to it as one JSON line, and the file is flushed to disk at each checkpoint
     - confidence_threshold: float, only detections above this threshold are returned
-    - checkpoint_frequency: int, write results to JSON checkpoint file every N images
+    - checkpoint_frequency: int, write results to checkpoint file every N images
     - results: list of dict, existing results loaded from checkpoint
-    - n_cores: int, # of CPU cores to use
+    - n_cores: int, # of CPU cores to use; if > 1, images are processed in chunks by a
+        pool of worker processes, each of which loads the model once
+    - batch_size: int, number of images of the same size per inference call
+    - n_decode_threads: int, if > 0, read and decode images on this many threads while
+        running inference (pipeline mode); only applies when not using multiprocessing
+    - stage_timer: optional StageTimer to record the time spent in each stage
+    - chunk_size: int, # of images per task handed to a worker process when n_cores > 1
 
     Returns
     - results: list of dict, each dict represents detections on one image
     """
+    if stage_timer is None:
+        stage_timer = StageTimer()
+
     if results is None:
         results = []
 
     already_processed = set([i['file'] for i in results])
 
-    if n_cores > 1 and tf.test.is_gpu_available():
-        print('Warning: multiple cores requested, but a GPU is available; parallelization across GPUs is not currently supported, defaulting to one GPU')
-
-    # If we're not using multiprocessing...
-    if n_cores <= 1 or tf.test.is_gpu_available():
+    # Does not count those already processed
+    count = 0
+
+    # Open for appending if we're writing a JSONL checkpoint
+    checkpoint_file = None
+    if checkpoint_path is not None and checkpoint_path.endswith(JSONL_CHECKPOINT_EXTENSION):
+        checkpoint_file = open(checkpoint_path, 'a')
+
+    def write_checkpoint():
+        print('Writing a new checkpoint after having processed {} images since last restart'.format(count))
+        with stage_timer.time('serialize'):
+            if checkpoint_file is not None:
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+            else:
+                with open(checkpoint_path, 'w') as f:
+                    json.dump({'images': results}, f)
 
-        # Load the detector
-        start_time = time.time()
-        tf_detector = TFDetector(model_file)
-        elapsed = time.time() - start_time
-        print('Loaded model in {}'.format(humanfriendly.format_timespan(elapsed)))
+    def add_results(new_results):
+        nonlocal count
+        for result in new_results:
+            results.append(result)
+            count += 1
+            if checkpoint_file is not None:
+                checkpoint_file.write(json.dumps(result) + '\n')
+            if checkpoint_frequency != -1 and count % checkpoint_frequency == 0:
+                write_checkpoint()
 
-        # Does not count those already processed
-        count = 0
+    try:
+        if n_cores > 1 and tf.test.is_gpu_available():
+            print('Warning: multiple cores requested, but a GPU is available; parallelization across GPUs is not currently supported, defaulting to one GPU')
 
-        for im_file in tqdm(image_file_names):
+        # If we're not using multiprocessing...
+        if n_cores <= 1 or tf.test.is_gpu_available():
 
-            # Will not add additional entries not in the starter checkpoint
-            if im_file in already_processed:
-                print('Bypassing image {}'.format(im_file))
-                continue
+            # Load the detector
+            start_time = time.time()
+            tf_detector = TFDetector(model_file)
+            elapsed = time.time() - start_time
+            print('Loaded model in {}'.format(humanfriendly.format_timespan(elapsed)))
 
-            count += 1
+            if batch_size > 1 or n_decode_threads > 0:
 
-            result = process_image(im_file, tf_detector, confidence_threshold)
-            results.append(result)
+                # Will not add additional entries not in the starter checkpoint
+                im_files_to_process = [im_file for im_file in image_file_names
+                                       if im_file not in already_processed]
+                print('Bypassing {} images already processed'.format(
+                    len(image_file_names) - len(im_files_to_process)))
 
-            # checkpoint
-            if checkpoint_frequency != -1 and count % checkpoint_frequency == 0:
-                print('Writing a new checkpoint after having processed {} images since last restart'.format(count))
-                with open(checkpoint_path, 'w') as f:
-                    json.dump({'images': results}, f)
+                if n_decode_threads > 0:
+                    process_images_pipelined(tqdm(im_files_to_process), tf_detector, confidence_threshold,
+                                             batch_size=batch_size, n_decode_threads=n_decode_threads,
+                                             result_callback=add_results, stage_timer=stage_timer)
+                else:
+                    process_images_batched(tqdm(im_files_to_process), tf_detector, confidence_threshold,
+                                           batch_size, result_callback=add_results)
 
-    else:
-        # when using multiprocessing, let the workers load the model
-        tf_detector = model_file
+            else:
 
-        print('Creating pool with {} cores'.format(n_cores))
+                for im_file in tqdm(image_file_names):
 
-        if len(already_processed) > 0:
-            print('Warning: when using multiprocessing, all images are reprocessed')
+                    # Will not add additional entries not in the starter checkpoint
+                    if im_file in already_processed:
+                        print('Bypassing image {}'.format(im_file))
+                        continue
 
-        pool = workerpool(n_cores)
+                    add_results([process_image(im_file, tf_detector, confidence_threshold)])
 
-        image_batches = list(chunks_by_number_of_chunks(image_file_names, n_cores))
-        results = pool.map(partial(process_images, tf_detector=tf_detector,
-                                   confidence_threshold=confidence_threshold), image_batches)
+        else:
 
-        results = list(itertools.chain.from_iterable(results))
+            # Will not add additional entries not in the starter checkpoint
+            im_files_to_process = [im_file for im_file in image_file_names
+                                   if im_file not in already_processed]
+            print('Bypassing {} images already processed'.format(
+                len(image_file_names) - len(im_files_to_process)))
+
+            # Small chunks are handed out to whichever worker is free, so a slow chunk does
+            # not hold up the others, and results come back in time for checkpointing
+            image_chunks = list(chunks_by_size(im_files_to_process, chunk_size))
+
+            print('Creating pool with {} cores, {} chunks of up to {} images'.format(
+                n_cores, len(image_chunks), chunk_size))
+
+            # each worker loads the model once, in the pool initializer
+            pool = workerpool(n_cores, initializer=init_worker, initargs=(model_file,))
+            try:
+                for chunk_results in tqdm(pool.imap_unordered(
+                        partial(process_images_in_worker, confidence_threshold=confidence_threshold,
+                                batch_size=batch_size),
+                        image_chunks), total=len(image_chunks)):
+                    add_results(chunk_results)
+            finally:
+                pool.close()
+                pool.join()
+
+    finally:
+        if checkpoint_file is not None:
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            checkpoint_file.close()
 
     # results may have been modified in place, but we also return it for backwards-compatibility.
     return results
 
 
 def write_results_to_file(results, output_file, relative_path_base=None):
-    """Writes list of detection results to JSON output file. Format matches
+    """Writes detection results to JSON output file. Format matches
     https://github.com/microsoft/CameraTraps/tree/master/api/batch_processing#batch-processing-api-output-format
 
+    The results are written one at a time, so they can come from a generator (e.g.
+    read_jsonl_checkpoint()) rather than a list held in memory.
+
     Args
-    - results: list of dict, each dict represents detections on one image
+    - results: iterable of dict, each dict represents detections on one image
     - output_file: str, path to JSON output file, should end in '.json'
     - relative_path_base: str, path to a directory as the base for relative paths
     """
-    if relative_path_base is not None:
-        results_relative = []
-        for r in results:
-            r_relative = copy.copy(r)
-            r_relative['file'] = os.path.relpath(r_relative['file'], start=relative_path_base)
-            results_relative.append(r_relative)
-        results = results_relative
-
-    final_output = {
-        'images': results,
-        'detection_categories': TFDetector.DEFAULT_DETECTOR_LABEL_MAP,
-        'info': {
-            'detection_completion_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
-            'format_version': '1.0'
-        }
+    def indent(s, n_spaces):
+        return s.replace('\n', '\n' + ' ' * n_spaces)
+
+    info = {
+        'detection_completion_time': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        'format_version': '1.0'
     }
+
+    # Same layout as json.dump(final_output, f, indent=1), with 'images' first
     with open(output_file, 'w') as f:
-        json.dump(final_output, f, indent=1)
+        f.write('{\n "images": [')
+        n_written = 0
+        for r in results:
+            if relative_path_base is not None:
+                r = copy.copy(r)
+                r['file'] = os.path.relpath(r['file'], start=relative_path_base)
+            f.write(',\n  ' if n_written > 0 else '\n  ')
+            f.write(indent(json.dumps(r, indent=1), 2))
+            n_written += 1
+        f.write('\n ]' if n_written > 0 else ']')
+        f.write(',\n "detection_categories": ')
+        f.write(indent(json.dumps(TFDetector.DEFAULT_DETECTOR_LABEL_MAP, indent=1), 1))
+        f.write(',\n "info": ')
+        f.write(indent(json.dumps(info, indent=1), 1))
+        f.write('\n}')
     print('Output file saved at {}'.format(output_file))
 
 
@@ -272,14 +683,38 @@ def main():
         type=int,
         default=-1,
         help='Write results to a temporary file every N images; default is -1, which disables this feature')
+    parser.add_argument(
+        '--checkpoint_format',
+        choices=['json', 'jsonl'],
+        default='json',
+        help='json rewrites all results at each checkpoint; jsonl appends one line per image and '
+             'flushes the file to disk at each checkpoint. Default is json')
     parser.add_argument(
         '--resume_from_checkpoint',
-        help='Path to a JSON checkpoint file to resume from, must be in same directory as output_file')
+        help='Path to a JSON or JSONL checkpoint file to resume from, must be in same directory as output_file')
     parser.add_argument(
         '--ncores',
         type=int,
         default=0,
-        help='Number of cores to use; only applies to CPU-based inference, does not support checkpointing when ncores > 1')
+        help='Number of cores to use; only applies to CPU-based inference')
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help='Number of images per task handed to a worker process when ncores > 1; default is {}'.format(
+            DEFAULT_CHUNK_SIZE))
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=TFDetector.BATCH_SIZE,
+        help='Number of images with the same dimensions to run per inference call; default is 1')
+    parser.add_argument(
+        '--n_decode_threads',
+        type=int,
+        default=0,
+        help='Number of threads reading and decoding images while inference runs; reports the '
+             'time spent in each stage at the end. Default is 0, which disables this feature. '
+             'Does not apply when ncores > 1')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -292,6 +727,9 @@ def main():
     assert args.output_file.endswith('.json'), 'output_file specified needs to end with .json'
     if args.checkpoint_frequency != -1:
         assert args.checkpoint_frequency > 0, 'Checkpoint_frequency needs to be > 0 or == -1'
+    assert args.batch_size > 0, 'batch_size needs to be > 0'
+    assert args.n_decode_threads >= 0, 'n_decode_threads needs to be >= 0'
+    assert args.chunk_size > 0, 'chunk_size needs to be > 0'
     if args.output_relative_filenames:
         assert os.path.isdir(args.image_file), 'image_file must be a directory when --output_relative_filenames is set'
 
@@ -304,11 +742,7 @@ def main():
     # still full paths.
     if args.resume_from_checkpoint:
         assert os.path.exists(args.resume_from_checkpoint), 'File at resume_from_checkpoint specified does not exist'
-        with open(args.resume_from_checkpoint) as f:
-            saved = json.load(f)
-        assert 'images' in saved, \
-            'The file saved as checkpoint does not have the correct fields; cannot be restored'
-        results = saved['images']
+        results = load_checkpoint(args.resume_from_checkpoint)
         print('Restored {} entries from the checkpoint'.format(len(results)))
     else:
         results = []
@@ -340,14 +774,23 @@ def main():
 
     # Test that we can write to the output_file's dir if checkpointing requested
     if args.checkpoint_frequency != -1:
-        checkpoint_path = os.path.join(output_dir, 'checkpoint_{}.json'.format(datetime.utcnow().strftime("%Y%m%d%H%M%S")))
+        checkpoint_extension = JSONL_CHECKPOINT_EXTENSION if args.checkpoint_format == 'jsonl' else '.json'
+        checkpoint_path = os.path.join(output_dir, 'checkpoint_{}{}'.format(
+            datetime.utcnow().strftime("%Y%m%d%H%M%S"), checkpoint_extension))
         with open(checkpoint_path, 'w') as f:
-            json.dump({'images': []}, f)
+            if args.checkpoint_format == 'jsonl':
+                # the new checkpoint also holds the restored results, since it is
+                # used to assemble the output file at the end
+                for result in results:
+                    f.write(json.dumps(result) + '\n')
+            else:
+                json.dump({'images': []}, f)
         print('The checkpoint file will be written to {}'.format(checkpoint_path))
     else:
         checkpoint_path = None
 
     start_time = time.time()
+    stage_timer = StageTimer()
 
     results = load_and_run_detector_batch(model_file=args.detector_file,
                                           image_file_names=image_file_names,
@@ -355,7 +798,11 @@ def main():
                                           confidence_threshold=args.threshold,
                                           checkpoint_frequency=args.checkpoint_frequency,
                                           results=results,
-                                          n_cores=args.ncores)
+                                          n_cores=args.ncores,
+                                          batch_size=args.batch_size,
+                                          n_decode_threads=args.n_decode_threads,
+                                          stage_timer=stage_timer,
+                                          chunk_size=args.chunk_size)
 
     elapsed = time.time() - start_time
     print('Finished inference in {}'.format(humanfriendly.format_timespan(elapsed)))
@@ -363,7 +810,14 @@ def main():
     relative_path_base = None
     if args.output_relative_filenames:
         relative_path_base = args.image_file
-    write_results_to_file(results, args.output_file, relative_path_base=relative_path_base)
+    if checkpoint_path and args.checkpoint_format == 'jsonl':
+        # stream the results back from the checkpoint rather than holding two copies
+        results = read_jsonl_checkpoint(checkpoint_path)
+    with stage_timer.time('serialize'):
+        write_results_to_file(results, args.output_file, relative_path_base=relative_path_base)
+
+    if args.n_decode_threads > 0:
+        stage_timer.print_summary()
 
     if checkpoint_path:
         os.remove(checkpoint_path)
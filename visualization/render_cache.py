@@ -0,0 +1,233 @@
+"""
+render_cache.py
+
+A content-addressed store of rendered images, so scripts that render
+detections on images (e.g. postprocess_batch_results.py and
+visualize_detector_output.py) can reuse an earlier rendering when the source
+image, the detections and the rendering options haven't changed.
+
+Entries are keyed on a hash of (source image path, source file size and mtime,
+detections, rendering options).  A cache hit is hard-linked (or copied, if
+hard links aren't supported) to the target path instead of re-rendering.  The
+cache is bounded in size; when it grows past its limit, the least recently used
+entries (by file mtime, which is updated on each hit) are deleted.
+"""
+
+#%% Imports
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from typing import Any, Dict, Optional, Tuple
+
+
+#%% Constants
+
+# Included in every key; change this when rendering output changes, to
+# invalidate existing caches
+RENDER_CACHE_VERSION = 1
+
+DEFAULT_RENDER_CACHE_MAX_SIZE_BYTES = 10 * 1024 ** 3
+
+# When evicting, delete entries until the cache is this fraction of its limit,
+# so we don't scan the cache on every subsequent store
+EVICTION_TARGET_FRACTION = 0.9
+
+
+#%% Classes
+
+class RenderCache:
+    """Size-bounded cache of rendered images in the folder cache_dir."""
+
+    def __init__(self, cache_dir: str,
+                 max_size_bytes: int = DEFAULT_RENDER_CACHE_MAX_SIZE_BYTES,
+                 size_bytes: Optional[int] = None):
+        """
+        [size_bytes] is the current size of the cache, if already known (e.g.
+        computed once by a parent process for its workers); otherwise the cache
+        folder is scanned the first time an entry is stored.
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size_bytes = size_bytes
+
+    def _list_entries(self):
+        """Returns a list of (path, mtime, size) for each cache entry."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for fn in files:
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # Deleted by another process
+                    continue
+                entries.append((path, st.st_mtime, st.st_size))
+        return entries
+
+    @property
+    def size_bytes(self) -> int:
+        """Returns the (estimated) total size of the cache entries."""
+        with self._lock:
+            return self._get_size_bytes()
+
+    def _get_size_bytes(self) -> int:
+        """Returns the size of the cache, scanning the folder if it isn't known
+        yet.  Must be called with _lock held.
+        """
+        if self._size_bytes is None:
+            self._size_bytes = sum(size for _, _, size in self._list_entries())
+        return self._size_bytes
+
+    def _entry_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def get_key(self, image_path: str, detections: Any,
+                render_options: Dict[str, Any]) -> Optional[str]:
+        """Returns the cache key for rendering [detections] on the local image
+        [image_path] with [render_options] (anything json-serializable), or None
+        if the image can't be cached (e.g. it's not a local file).
+        """
+        try:
+            st = os.stat(image_path)
+        except (OSError, ValueError):
+            return None
+        s = json.dumps([RENDER_CACHE_VERSION, os.path.abspath(image_path),
+                        st.st_size, st.st_mtime_ns, detections, render_options],
+                       sort_keys=True, default=str)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def fetch(self, key: Optional[str], target_path: str) -> bool:
+        """If [key] is in the cache, links or copies the cached image to
+        [target_path] and returns True; otherwise returns False.
+        """
+        if key is None:
+            return False
+        entry_path = self._entry_path(key, os.path.splitext(target_path)[1])
+        try:
+            _link_or_copy(entry_path, target_path)
+            # Mark this entry as recently used
+            os.utime(entry_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.n_misses += 1
+            return False
+        with self._lock:
+            self.n_hits += 1
+        return True
+
+    def save(self, image: Any, target_path: str, key: Optional[str]) -> None:
+        """Saves the rendered PIL image [image] to [target_path] and adds it to
+        the cache under [key].
+
+        Because cache hits are hard-linked, target_path may share its contents
+        with a cache entry, so the image is written to a new file that then
+        replaces target_path, rather than being written into target_path.
+        """
+        tmp_path = _get_tmp_path(target_path)
+        try:
+            image.save(tmp_path)
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.store(key, target_path)
+
+    def store(self, key: Optional[str], rendered_path: str) -> None:
+        """Adds the rendered image at [rendered_path] to the cache under [key]."""
+        if key is None:
+            return
+        entry_path = self._entry_path(key, os.path.splitext(rendered_path)[1])
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # If this replaces an existing entry, only the difference in size is added
+        try:
+            old_size = os.path.getsize(entry_path)
+        except FileNotFoundError:
+            old_size = 0
+        _link_or_copy(rendered_path, entry_path)
+        new_size = os.path.getsize(entry_path)
+
+        with self._lock:
+            if self._size_bytes is None:
+                # The scan already includes the new entry
+                size_bytes = self._get_size_bytes()
+            else:
+                size_bytes = self._size_bytes + new_size - old_size
+            self._size_bytes = size_bytes
+            if size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Deletes least recently used entries until the cache is within
+        EVICTION_TARGET_FRACTION of its size limit.
+        """
+        entries = sorted(self._list_entries(), key=lambda entry: entry[1])
+        size_bytes = sum(size for _, _, size in entries)
+        target_size_bytes = self.max_size_bytes * EVICTION_TARGET_FRACTION
+        for path, _, size in entries:
+            if size_bytes <= target_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size_bytes -= size
+        self._size_bytes = size_bytes
+
+
+#%% Functions
+
+def _get_tmp_path(path: str) -> str:
+    """Returns a unique temporary path in the same folder as [path], with the
+    same extension.
+    """
+    folder, fn = os.path.split(path)
+    return os.path.join(folder, '.tmp-{}-{}'.format(uuid.uuid4().hex[:8], fn))
+
+
+def _link_or_copy(source_path: str, target_path: str) -> None:
+    """Hard-links source_path to target_path, replacing target_path if it
+    exists; copies if hard links aren't supported (e.g. across filesystems).
+    Raises FileNotFoundError if source_path doesn't exist.
+    """
+    # Link or copy to a temporary name first, so target_path is replaced
+    # atomically and is never seen partially written
+    tmp_path = _get_tmp_path(target_path)
+    try:
+        os.link(source_path, tmp_path)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+
+
+# Caches by (folder, size limit), so each process scans each cache folder once
+_render_caches: Dict[Tuple[str, int], RenderCache] = {}
+_render_caches_lock = threading.Lock()
+
+
+def get_render_cache(cache_dir: Optional[str],
+                     max_size_bytes: int = DEFAULT_RENDER_CACHE_MAX_SIZE_BYTES,
+                     size_bytes: Optional[int] = None
+                     ) -> Optional[RenderCache]:
+    """Returns the RenderCache for [cache_dir] in this process, creating it if
+    necessary, or None if cache_dir is None or empty.  [size_bytes] is passed to
+    RenderCache if the cache is created here.
+    """
+    if cache_dir is None or len(cache_dir) == 0:
+        return None
+    with _render_caches_lock:
+        cache_key = (os.path.abspath(cache_dir), max_size_bytes)
+        if cache_key not in _render_caches:
+            _render_caches[cache_key] = RenderCache(cache_dir, max_size_bytes,
+                                                    size_bytes)
+        return _render_caches[cache_key]
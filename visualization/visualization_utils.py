@@ -7,7 +7,7 @@ Core rendering functions shared across visualization scripts
 #%% Constants and imports
 
 from io import BytesIO
-from typing import Union
+from typing import Tuple, Union
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -21,20 +21,8 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 #%% Functions
 
-def open_image(input_file: Union[str, BytesIO]) -> Image.Image:
-    """Opens an image in binary format using PIL.Image and converts to RGB mode.
-
-    This operation is lazy; image will not be actually loaded until the first
-    operation that needs to load it (for example, resizing), so file opening
-    errors can show up later.
-
-    Args:
-        input_file: str or BytesIO, either a path to an image file (anything
-            that PIL can open), or an image as a stream of bytes
-
-    Returns:
-        an PIL image object in RGB mode
-    """
+def _open_image_lazy(input_file: Union[str, BytesIO]) -> Image.Image:
+    """Opens an image with PIL.Image.open(), without loading or converting it."""
     if (isinstance(input_file, str)
             and input_file.startswith(('http://', 'https://'))):
         try:
@@ -45,6 +33,11 @@ def open_image(input_file: Union[str, BytesIO]) -> Image.Image:
             raise
     else:
         image = Image.open(input_file)
+    return image
+
+
+def _convert_image_to_rgb(image: Image.Image,
+                          input_file: Union[str, BytesIO]) -> Image.Image:
     if image.mode not in ('RGBA', 'RGB', 'L'):
         raise AttributeError(
             f'Image {input_file} uses unsupported mode {image.mode}')
@@ -54,6 +47,55 @@ def open_image(input_file: Union[str, BytesIO]) -> Image.Image:
     return image
 
 
+def open_image(input_file: Union[str, BytesIO]) -> Image.Image:
+    """Opens an image in binary format using PIL.Image and converts to RGB mode.
+
+    This operation is lazy; image will not be actually loaded until the first
+    operation that needs to load it (for example, resizing), so file opening
+    errors can show up later.
+
+    Args:
+        input_file: str or BytesIO, either a path to an image file (anything
+            that PIL can open), or an image as a stream of bytes
+
+    Returns:
+        an PIL image object in RGB mode
+    """
+    image = _open_image_lazy(input_file)
+    return _convert_image_to_rgb(image, input_file)
+
+
+def open_resized_image(input_file: Union[str, BytesIO], target_width: int,
+                       target_height: int = -1
+                       ) -> Tuple[Image.Image, Tuple[int, int]]:
+    """Opens an image and resizes it as in resize_image(), for rendering previews.
+
+    For JPEG images, uses PIL's draft mode, so the decoder downscales by 1/2, 1/4
+    or 1/8 in the DCT domain, to the smallest size that's still at least the
+    target size; only the remaining downscaling is done by resize_image().  This is
+    much faster than decoding large images at full resolution.
+
+    Args:
+        input_file: str or BytesIO, as in open_image()
+        target_width, target_height: int, as in resize_image()
+
+    Returns:
+        the resized PIL image in RGB mode, and the (width, height) of the original
+        image, e.g. to scale absolute box coordinates
+    """
+    image = _open_image_lazy(input_file)
+    original_size = image.size
+    target_size = _get_resized_size(original_size, target_width, target_height)
+
+    if (image.format == 'JPEG'
+            and target_size[0] < original_size[0]
+            and target_size[1] < original_size[1]):
+        image.draft(image.mode, target_size)
+
+    image = _convert_image_to_rgb(image, input_file)
+    return resize_image(image, target_size[0], target_size[1]), original_size
+
+
 def load_image(input_file: Union[str, BytesIO]) -> Image.Image:
     """Loads the image at input_file as a PIL Image into memory.
 
@@ -71,22 +113,21 @@ def load_image(input_file: Union[str, BytesIO]) -> Image.Image:
     return image
 
 
-def resize_image(image, target_width, target_height=-1):
+def _get_resized_size(size, target_width, target_height):
     """
-    Resizes a PIL image object to the specified width and height; does not resize
-    in place. If either width or height are -1, resizes with aspect ratio preservation.
-    If both are -1, returns the original image (does not copy in this case).
+    Returns the (width, height) that resize_image() will resize an image of the given
+    (width, height) to.
     """
 
     # Null operation
     if target_width == -1 and target_height == -1:
-        return image
+        return size
 
     elif target_width == -1 or target_height == -1:
 
         # Aspect ratio as width over height
         # ar = w / h
-        aspect_ratio = image.size[0] / image.size[1]
+        aspect_ratio = size[0] / size[1]
 
         if target_width != -1:
             # h = w / ar
@@ -95,6 +136,22 @@ def resize_image(image, target_width, target_height=-1):
             # w = ar * h
             target_width = int(aspect_ratio * target_height)
 
+    return target_width, target_height
+
+
+def resize_image(image, target_width, target_height=-1):
+    """
+    Resizes a PIL image object to the specified width and height; does not resize
+    in place. If either width or height are -1, resizes with aspect ratio preservation.
+    If both are -1, returns the original image (does not copy in this case).
+    """
+
+    # Null operation
+    if target_width == -1 and target_height == -1:
+        return image
+
+    target_width, target_height = _get_resized_size(image.size, target_width, target_height)
+
     resized_image = image.resize((target_width, target_height), Image.ANTIALIAS)
     return resized_image
 
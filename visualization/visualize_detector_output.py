@@ -17,6 +17,7 @@ from tqdm import tqdm
 
 from data_management.annotations.annotation_constants import (
     detector_bbox_category_id_to_name)  # here id is int
+from visualization import render_cache
 from visualization import visualization_utils as vis_utils
 
 
@@ -37,7 +38,9 @@ def visualize_detector_output(detector_output_path: str,
                               confidence: float = 0.8,
                               sample: int = -1,
                               output_image_width: int = 700,
-                              random_seed: Optional[int] = None) -> List[str]:
+                              random_seed: Optional[int] = None,
+                              render_cache_dir: Optional[str] = None
+                              ) -> List[str]:
     """Draw bounding boxes on images given the output of the detector.
 
     Args:
@@ -51,6 +54,9 @@ def visualize_detector_output(detector_output_path: str,
         output_image_width: int, width in pixels to resize images for display,
             set to -1 to use original image width
         random_seed: int, for deterministic image sampling when sample != -1
+        render_cache_dir: optional str, path to a folder in which to cache
+            annotated images, so local images whose detections are unchanged
+            since an earlier run aren't re-rendered
 
     Returns: list of str, paths to annotated images
     """
@@ -71,6 +77,12 @@ def visualize_detector_output(detector_output_path: str,
 
     os.makedirs(out_dir, exist_ok=True)
 
+    # only local images can be cached, since the cache key includes the source
+    # file's size and modification time
+    cache = None
+    if not is_azure:
+        cache = render_cache.get_render_cache(render_cache_dir)
+
     #%% Load detector output
 
     with open(detector_output_path) as f:
@@ -117,6 +129,11 @@ def visualize_detector_output(detector_output_path: str,
 
         # max_conf = entry['max_detection_conf']
 
+        annotated_img_name = image_id
+        for char in ['/', '\\', ':']:
+            annotated_img_name = annotated_img_name.replace(char, '~')
+        annotated_img_path = os.path.join(out_dir, f'anno_{annotated_img_name}')
+
         if is_azure:
             blob_uri = sas_blob_utils.build_blob_uri(
                 container_uri=images_dir, blob_name=image_id)
@@ -132,19 +149,29 @@ def visualize_detector_output(detector_output_path: str,
                 print(f'Image {image_id} not found in images_dir; skipped.')
                 continue
 
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.get_key(image_obj, entry['detections'], {
+                'output_image_width': output_image_width,
+                'confidence': confidence,
+                'label_map': detector_label_map})
+            if cache.fetch(cache_key, annotated_img_path):
+                annotated_img_paths.append(annotated_img_path)
+                num_saved += 1
+                continue
+
         # resize is for displaying them more quickly
-        image = vis_utils.resize_image(
-            vis_utils.open_image(image_obj), output_image_width)
+        image, _ = vis_utils.open_resized_image(image_obj, output_image_width)
 
         vis_utils.render_detection_bounding_boxes(
             entry['detections'], image, label_map=detector_label_map,
             confidence_threshold=confidence)
 
-        for char in ['/', '\\', ':']:
-            image_id = image_id.replace(char, '~')
-        annotated_img_path = os.path.join(out_dir, f'anno_{image_id}')
         annotated_img_paths.append(annotated_img_path)
-        image.save(annotated_img_path)
+        if cache is not None:
+            cache.save(image, annotated_img_path, cache_key)
+        else:
+            image.save(annotated_img_path)
         num_saved += 1
 
         if is_azure:
@@ -152,6 +179,8 @@ def visualize_detector_output(detector_output_path: str,
 
     print(f'Rendered detection results on {num_saved} images, '
           f'saved to {out_dir}.')
+    if cache is not None:
+        print(f'Reused {cache.n_hits} annotated images from the render cache.')
 
     return annotated_img_paths
 
@@ -199,6 +228,11 @@ def main() -> None:
     parser.add_argument(
         '-r', '--random_seed', type=int, default=None,
         help='Integer, for deterministic order of image sampling')
+    parser.add_argument(
+        '--render_cache_dir', type=str, default=None,
+        help='Path to a directory in which to cache annotated images, so '
+             'local images whose detections and rendering options are '
+             'unchanged since an earlier run are not re-rendered')
 
     if len(sys.argv[1:]) == 0:
         parser.print_help()
@@ -213,7 +247,8 @@ def main() -> None:
         is_azure=args.is_azure,
         sample=args.sample,
         output_image_width=args.output_image_width,
-        random_seed=args.random_seed)
+        random_seed=args.random_seed,
+        render_cache_dir=args.render_cache_dir)
 
 
 if __name__ == '__main__':